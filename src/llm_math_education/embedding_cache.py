@@ -0,0 +1,89 @@
+# Persistent, content-addressed cache of text embeddings.
+# See `embedding_utils.set_embedding_cache`.
+from __future__ import annotations
+
+import hashlib
+import sqlite3
+import threading
+from pathlib import Path
+
+import numpy as np
+
+DEFAULT_CACHE_FILENAME = "embedding_cache.sqlite"
+# SQLite limits the number of parameters in a single query
+MAX_LOOKUP_BATCH_SIZE = 500
+
+
+def get_text_hash(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class EmbeddingCache:
+    """SQLite-backed embedding cache, keyed on (embedding model, sha256 of the text).
+
+    Each text is looked up individually, so a batch that differs by one string only misses on that string.
+    Safe to share between threads.
+
+    ```python
+        cache = EmbeddingCache.in_dir(Path("embedding_dir"))
+        embedding_utils.set_embedding_cache(cache)
+    ```
+    """
+
+    def __init__(self, cache_filepath: Path):
+        self.cache_filepath = cache_filepath
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(cache_filepath, check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.execute(
+                """CREATE TABLE IF NOT EXISTS embedding (
+                    model TEXT NOT NULL,
+                    text_hash TEXT NOT NULL,
+                    embedding BLOB NOT NULL,
+                    PRIMARY KEY (model, text_hash)
+                )""",
+            )
+
+    @classmethod
+    def in_dir(cls, embedding_dir: Path) -> EmbeddingCache:
+        """Create a cache stored in the given directory, e.g. next to a `retrieval.RetrievalDb`'s files."""
+        return cls(embedding_dir / DEFAULT_CACHE_FILENAME)
+
+    def get_embeddings(self, texts: list[str], embedding_model: str) -> list[np.array | None]:
+        """Look up the given texts.
+
+        Args:
+            texts (list[str]): Texts to look up.
+            embedding_model (str): The model that produced the embeddings.
+
+        Returns:
+            list[np.array | None]: Embeddings in the same order as texts, with None for cache misses.
+        """
+        text_hashes = [get_text_hash(text) for text in texts]
+        found = {}
+        unique_hashes = list(set(text_hashes))
+        with self.lock:
+            for start in range(0, len(unique_hashes), MAX_LOOKUP_BATCH_SIZE):
+                batch = unique_hashes[start : start + MAX_LOOKUP_BATCH_SIZE]
+                rows = self.connection.execute(
+                    f"SELECT text_hash, embedding FROM embedding WHERE model = ? AND text_hash IN ({','.join('?' * len(batch))})",
+                    [embedding_model, *batch],
+                )
+                for text_hash, embedding in rows:
+                    found[text_hash] = np.frombuffer(embedding, dtype=np.float64)
+        return [found.get(text_hash) for text_hash in text_hashes]
+
+    def add_embeddings(self, texts: list[str], embeddings: list[np.array], embedding_model: str):
+        rows = [
+            (embedding_model, get_text_hash(text), np.asarray(embedding, dtype=np.float64).tobytes())
+            for text, embedding in zip(texts, embeddings)
+        ]
+        with self.lock, self.connection:
+            self.connection.executemany("INSERT OR REPLACE INTO embedding VALUES (?, ?, ?)", rows)
+
+    def __len__(self) -> int:
+        with self.lock:
+            return self.connection.execute("SELECT COUNT(*) FROM embedding").fetchone()[0]
+
+    def close(self):
+        self.connection.close()
@@ -1,33 +1,120 @@
+from __future__ import annotations
+
+import asyncio
+import collections
+import collections.abc
+import concurrent.futures
 import functools
+import itertools
+import logging
+import random
+import threading
+import time
 
 import numpy as np
 import openai
 import tiktoken
 
+from llm_math_education import embedding_cache as embedding_cache_module
+
 EMBEDDING_DIM = 1536
 MAX_TOKENS_PER_REQUEST = 8191
 EMBEDDING_MODEL = "text-embedding-ada-002"
 
+# retry settings for embedding requests; see `call_with_retry`
+MAX_RETRIES = 6
+INITIAL_BACKOFF_S = 1.0
+RETRYABLE_ERRORS = (
+    openai.error.RateLimitError,
+    openai.error.APIError,
+    openai.error.APIConnectionError,
+    openai.error.ServiceUnavailableError,
+    openai.error.Timeout,
+    openai.error.TryAgain,
+)
+
+# number of embeddings kept in memory by `aget_openai_embeddings`, like the lru_cache of `get_openai_embeddings_cached`
+ASYNC_MEMORY_CACHE_SIZE = 512
+# (embedding model, text) -> embedding, in least- to most-recently used order
+async_memory_cache: collections.OrderedDict[tuple[str, str], np.array] = collections.OrderedDict()
+async_memory_cache_lock = threading.Lock()
+
+# persistent cache consulted by `get_openai_embeddings` and `batch_embed_texts`; see `set_embedding_cache`
+embedding_cache: embedding_cache_module.EmbeddingCache | None = None
+
+
+def set_embedding_cache(cache: embedding_cache_module.EmbeddingCache | None):
+    """Set (or, with None, remove) the persistent embedding cache used for all embedding requests.
+
+    Args:
+        cache (embedding_cache.EmbeddingCache | None): The cache.
+    """
+    global embedding_cache
+    embedding_cache = cache
+
+
+@functools.cache
+def get_tokenizer() -> tiktoken.Encoding:
+    """Get the EMBEDDING_MODEL tokenizer. Cached."""
+    return tiktoken.encoding_for_model(EMBEDDING_MODEL)
 
-def get_token_counts(text_list: list[str]) -> list[int]:
+
+def get_token_counts(text_list: list[str], n_processes: int = 1) -> list[int]:
     """Given a list of texts, returns a list of the same length with the number of tokens from the EMBEDDING_MODEL tokenizer.
 
+    Texts are encoded with tiktoken's multithreaded batch encoder.
+
     Args:
         text_list (list[str]): Texts to tokenize.
+        n_processes (int, optional): If more than 1, split the texts across a pool of processes. Useful for very large corpora. Defaults to 1.
 
     Returns:
         list[int]: Token counts corresponding to text_list.
     """
-    tokenizer = tiktoken.encoding_for_model(EMBEDDING_MODEL)
-    token_counts = []
-    for string in text_list:
-        token_counts.append(len(tokenizer.encode(string)))
+    text_list = list(text_list)
+    if n_processes > 1 and len(text_list) > n_processes:
+        chunk_size = -(-len(text_list) // n_processes)
+        chunks = [text_list[start : start + chunk_size] for start in range(0, len(text_list), chunk_size)]
+        with concurrent.futures.ProcessPoolExecutor(max_workers=n_processes) as executor:
+            return [n_tokens for token_counts in executor.map(get_token_counts, chunks) for n_tokens in token_counts]
+    tokenizer = get_tokenizer()
+    token_counts = [len(tokens) for tokens in tokenizer.encode_ordinary_batch(text_list)]
     return token_counts
 
 
 def get_openai_embeddings(texts: list[str], embedding_model: str = EMBEDDING_MODEL) -> list[np.array]:
     """Given the list of texts, query the openai Embedding API, returning the embeddings in a list of numpy arrays.
-    Note: calls through to a cahced function.
+    Note: calls through to a cached function.
+    If a persistent cache is set (see `set_embedding_cache`), only texts missing from it are sent to the API.
+
+    Args:
+        texts (list[str]): List of texts to embed.
+        embedding_model (str, optional): Embedding model to use. Defaults to EMBEDDING_MODEL.
+
+    Returns:
+        list[np.array]: Embeddings, in the same order as the given texts.
+    """
+    if embedding_cache is None:
+        return get_openai_embeddings_cached(tuple(texts), embedding_model=embedding_model)
+    embedding_list = embedding_cache.get_embeddings(texts, embedding_model)
+    missing_texts = list({text: None for text, embedding in zip(texts, embedding_list) if embedding is None})
+    if len(missing_texts) > 0:
+        missing_embeddings = get_openai_embeddings_cached(tuple(missing_texts), embedding_model=embedding_model)
+        embedding_cache.add_embeddings(missing_texts, missing_embeddings, embedding_model)
+        missing_embedding_map = dict(zip(missing_texts, missing_embeddings))
+        embedding_list = [
+            embedding if embedding is not None else missing_embedding_map[text]
+            for text, embedding in zip(texts, embedding_list)
+        ]
+    return embedding_list
+
+
+async def aget_openai_embeddings(texts: list[str], embedding_model: str = EMBEDDING_MODEL) -> list[np.array]:
+    """Async variant of `get_openai_embeddings`, awaiting the openai Embedding API.
+
+    Recently embedded texts are kept in memory (see ASYNC_MEMORY_CACHE_SIZE), so a query embedded once,
+    e.g. to check `retrieval_strategies.CachedRetrievalStrategy`, isn't requested again when a retrieval strategy embeds it.
+    Also consults the persistent cache if set, in a worker thread so that SQLite never blocks the event loop.
 
     Args:
         texts (list[str]): List of texts to embed.
@@ -36,37 +123,202 @@ def get_openai_embeddings(texts: list[str], embedding_model: str = EMBEDDING_MOD
     Returns:
         list[np.array]: Embeddings, in the same order as the given texts.
     """
-    return get_openai_embeddings_cached(tuple(texts), embedding_model=embedding_model)
+    with async_memory_cache_lock:
+        embedding_list = [async_memory_cache.get((embedding_model, text)) for text in texts]
+        for text, embedding in zip(texts, embedding_list):
+            if embedding is not None:
+                async_memory_cache.move_to_end((embedding_model, text))
+    if embedding_cache is not None and any(embedding is None for embedding in embedding_list):
+        persistent_embedding_list = await asyncio.to_thread(embedding_cache.get_embeddings, texts, embedding_model)
+        embedding_list = [
+            embedding if embedding is not None else persistent_embedding
+            for embedding, persistent_embedding in zip(embedding_list, persistent_embedding_list)
+        ]
+    missing_texts = list({text: None for text, embedding in zip(texts, embedding_list) if embedding is None})
+    if len(missing_texts) > 0:
+        result = await openai.Embedding.acreate(input=missing_texts, engine=embedding_model)
+        missing_embeddings = [np.array(d["embedding"]) for d in result.data]
+        if embedding_cache is not None:
+            await asyncio.to_thread(embedding_cache.add_embeddings, missing_texts, missing_embeddings, embedding_model)
+        with async_memory_cache_lock:
+            for text, embedding in zip(missing_texts, missing_embeddings):
+                async_memory_cache[(embedding_model, text)] = embedding
+            while len(async_memory_cache) > ASYNC_MEMORY_CACHE_SIZE:
+                async_memory_cache.popitem(last=False)
+        missing_embedding_map = dict(zip(missing_texts, missing_embeddings))
+        embedding_list = [
+            embedding if embedding is not None else missing_embedding_map[text]
+            for text, embedding in zip(texts, embedding_list)
+        ]
+    return embedding_list
 
 
 @functools.lru_cache(maxsize=512, typed=True)
 def get_openai_embeddings_cached(texts: tuple[str], embedding_model: str = EMBEDDING_MODEL) -> list[np.array]:
+    return request_openai_embeddings(list(texts), embedding_model=embedding_model)
+
+
+def request_openai_embeddings(texts: list[str], embedding_model: str = EMBEDDING_MODEL) -> list[np.array]:
+    """Query the openai Embedding API, without consulting any cache. See `get_openai_embeddings`."""
     result = openai.Embedding.create(input=texts, engine=embedding_model)
     embedding_list = [np.array(d["embedding"]) for d in result.data]
     return embedding_list
 
 
-def batch_embed_texts(input_text_list: list[str], n_tokens_list: list[int]) -> list[np.array]:
+def batch_embed_texts(
+    input_text_list: list[str],
+    n_tokens_list: list[int],
+    max_in_flight: int = 1,
+    embed_func: collections.abc.Callable[[list[str]], list[np.array]] | None = None,
+    embedding_model: str = EMBEDDING_MODEL,
+) -> list[np.array]:
     """Embed the given texts, respecting the API max tokens limit given MAX_TOKENS_PER_REQUEST.
 
+    If a persistent cache is set (see `set_embedding_cache`), cached texts are not re-embedded, and new embeddings are added to it.
+
     Args:
         input_text_list (list[str]): Texts to embed.
         n_tokens_list (list[int]): As returned by `get_token_counts`
+        max_in_flight (int, optional): Maximum number of concurrent embedding requests. Defaults to 1.
+        embed_func (Callable | None, optional): Embeds one batch of texts.
+            Defaults to None, meaning `request_openai_embeddings` with embedding_model.
+        embedding_model (str, optional): Model used for the embeddings, and their persistent cache key. Defaults to EMBEDDING_MODEL.
 
     Returns:
         list[np.array]: List of embeddings, stored in numpy arrays.
     """
+    embedding_list = [None] * len(input_text_list)
+    for inds, embeddings in iterate_batch_embeddings(
+        input_text_list,
+        n_tokens_list,
+        max_in_flight,
+        embed_func,
+        embedding_model,
+    ):
+        for i, embedding in zip(inds, embeddings):
+            embedding_list[i] = embedding
+    return embedding_list
+
+
+def iterate_batch_embeddings(
+    input_text_list: list[str],
+    n_tokens_list: list[int],
+    max_in_flight: int = 1,
+    embed_func: collections.abc.Callable[[list[str]], list[np.array]] | None = None,
+    embedding_model: str = EMBEDDING_MODEL,
+) -> collections.abc.Generator[tuple[list[int], list[np.array]]]:
+    """Embed the given texts in token-limited batches, yielding each batch as it finishes.
+
+    Up to max_in_flight requests run concurrently in a thread pool; batches are still yielded in input order.
+    Rate limit and transient API errors are retried with exponential backoff (see `call_with_retry`).
+    If a persistent cache is set, it is consulted once for all the texts, and each batch is added to it as it finishes,
+    so embed_func needn't (and by default doesn't) use a cache itself.
+
+    Args:
+        input_text_list (list[str]): Texts to embed.
+        n_tokens_list (list[int]): As returned by `get_token_counts`
+        max_in_flight (int, optional): Maximum number of concurrent embedding requests. Defaults to 1.
+        embed_func (Callable | None, optional): Embeds one batch of texts.
+            Defaults to None, meaning `request_openai_embeddings` with embedding_model.
+        embedding_model (str, optional): Model used for the embeddings, and their persistent cache key. Defaults to EMBEDDING_MODEL.
+
+    Yields:
+        tuple[list[int], list[np.array]]: Indices into input_text_list and the corresponding embeddings.
+    """
+    if embed_func is None:
+        embed_func = functools.partial(request_openai_embeddings, embedding_model=embedding_model)
+    input_text_list = list(input_text_list)
+    n_tokens_list = list(n_tokens_list)
+    inds = list(range(len(input_text_list)))
+    if embedding_cache is not None:
+        # only texts missing from the persistent cache need to be batched
+        cached_embedding_list = embedding_cache.get_embeddings(input_text_list, embedding_model)
+        cached_inds = [i for i, embedding in enumerate(cached_embedding_list) if embedding is not None]
+        if len(cached_inds) > 0:
+            yield cached_inds, [cached_embedding_list[i] for i in cached_inds]
+        inds = [i for i, embedding in enumerate(cached_embedding_list) if embedding is None]
+    batches = get_token_limited_batches(inds, [n_tokens_list[i] for i in inds])
+    batch_texts = [[input_text_list[i] for i in batch] for batch in batches]
+
+    def embed_batch(texts: list[str]) -> list[np.array]:
+        embeddings = call_with_retry(embed_func, texts)
+        if embedding_cache is not None:
+            embedding_cache.add_embeddings(texts, embeddings, embedding_model)
+        return embeddings
+
+    if max_in_flight <= 1:
+        for batch, texts in zip(batches, batch_texts):
+            yield batch, embed_batch(texts)
+        return
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_in_flight) as executor:
+        futures = collections.deque()
+        for batch, texts in zip(batches, batch_texts):
+            if len(futures) >= max_in_flight:
+                finished_batch, future = futures.popleft()
+                yield finished_batch, future.result()
+            futures.append((batch, executor.submit(embed_batch, texts)))
+        while len(futures) > 0:
+            batch, future = futures.popleft()
+            yield batch, future.result()
+
+
+def get_token_limited_batches(inds: list[int], n_tokens_list: list[int]) -> list[list[int]]:
+    """Split the given indices into consecutive batches with at most MAX_TOKENS_PER_REQUEST tokens each.
+
+    A single text with more than MAX_TOKENS_PER_REQUEST tokens gets a batch of its own.
+
+    Args:
+        inds (list[int]): Indices to batch.
+        n_tokens_list (list[int]): Token counts corresponding to inds.
+
+    Returns:
+        list[list[int]]: Batches of indices.
+    """
+    batches = []
     curr_batch_token_count = 0
-    texts = []
-    embedding_list = []
-    for text, n_tokens in zip(input_text_list, n_tokens_list):
-        if curr_batch_token_count + n_tokens > MAX_TOKENS_PER_REQUEST:
-            embedding_list.extend(get_openai_embeddings(texts, EMBEDDING_MODEL))
-            texts = [text]
-            curr_batch_token_count = 0
+    batch = []
+    for ind, n_tokens in zip(inds, n_tokens_list):
+        if curr_batch_token_count + n_tokens > MAX_TOKENS_PER_REQUEST and len(batch) > 0:
+            batches.append(batch)
+            batch = [ind]
+            curr_batch_token_count = n_tokens
         else:
-            texts.append(text)
+            batch.append(ind)
             curr_batch_token_count += n_tokens
-    if len(texts) > 0:
-        embedding_list.extend(get_openai_embeddings(texts, EMBEDDING_MODEL))
-    return embedding_list
+    if len(batch) > 0:
+        batches.append(batch)
+    return batches
+
+
+def call_with_retry(
+    func: collections.abc.Callable,
+    *args,
+    max_retries: int | None = None,
+    initial_backoff_s: float | None = None,
+):
+    """Call func, retrying RETRYABLE_ERRORS with exponential backoff and jitter.
+
+    Args:
+        func (Callable): Function to call with the given args.
+        max_retries (int | None, optional): Defaults to None, meaning MAX_RETRIES.
+        initial_backoff_s (float | None, optional): Wait before the first retry; doubles after each retry.
+            Defaults to None, meaning INITIAL_BACKOFF_S.
+
+    Raises:
+        The last error, if every retry fails.
+    """
+    if max_retries is None:
+        max_retries = MAX_RETRIES
+    if initial_backoff_s is None:
+        initial_backoff_s = INITIAL_BACKOFF_S
+    for n_retries in itertools.count():
+        try:
+            return func(*args)
+        except RETRYABLE_ERRORS as ex:
+            if n_retries >= max_retries:
+                raise ex
+            logging.warning(
+                f"Embedding request failed ({ex.__class__.__name__}); retry {n_retries + 1} of {max_retries}."
+            )
+            backoff_s = initial_backoff_s * 2**n_retries
+            time.sleep(backoff_s * (1 + random.random()))
@@ -0,0 +1,129 @@
+# Sparse lexical (BM25) index over a `retrieval.RetrievalDb`'s texts.
+# Complements embedding search on exact vocabulary (e.g. "LCM", "GCF") and needs no network round-trip.
+from __future__ import annotations
+
+import hashlib
+import re
+from pathlib import Path
+
+import numpy as np
+import scipy.sparse
+
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+")
+
+
+def tokenize(text: str) -> list[str]:
+    """Lowercase alphanumeric terms; punctuation and whitespace are separators."""
+    return TOKEN_PATTERN.findall(text.lower())
+
+
+def get_texts_fingerprint(texts: list[str]) -> bytes:
+    """A short digest identifying the texts and their order, e.g. to check that a saved index matches them."""
+    digest = hashlib.blake2b(digest_size=16)
+    for text in texts:
+        encoded_text = text.encode()
+        # length-prefixed, so that different splits of the same characters differ
+        digest.update(len(encoded_text).to_bytes(8, "little"))
+        digest.update(encoded_text)
+    return digest.digest()
+
+
+class Bm25Index:
+    """Okapi BM25 scores, stored as a sparse document-term weight matrix.
+
+    The term-frequency saturation, length normalization, and idf are folded into the weights at build time,
+    so scoring a query is a single sparse matrix-vector product.
+    `texts_fingerprint` identifies the texts the index was built from (see `get_texts_fingerprint`).
+    """
+
+    def __init__(self, k1: float = 1.5, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self.vocabulary: dict[str, int] = {}
+        self.weight_mat: scipy.sparse.csr_matrix | None = None
+        self.texts_fingerprint: bytes | None = None
+
+    def build(self, texts: list[str]):
+        """Build the index over the given texts.
+
+        Args:
+            texts (list[str]): Documents, e.g. `RetrievalDb.texts`.
+        """
+        vocabulary = {}
+        term_inds = []
+        indptr = [0]
+        for text in texts:
+            for term in tokenize(text):
+                term_inds.append(vocabulary.setdefault(term, len(vocabulary)))
+            indptr.append(len(term_inds))
+        count_mat = scipy.sparse.csr_matrix(
+            (np.ones(len(term_inds), dtype=np.float32), np.array(term_inds, dtype=np.int32), np.array(indptr)),
+            shape=(len(texts), len(vocabulary)),
+        )
+        # duplicate (document, term) entries are summed into term frequencies
+        count_mat.sum_duplicates()
+
+        n_docs = len(texts)
+        doc_lengths = np.diff(np.array(indptr)).astype(np.float32)
+        mean_doc_length = doc_lengths.mean() if n_docs > 0 and doc_lengths.sum() > 0 else 1.0
+        doc_freqs = np.bincount(count_mat.indices, minlength=len(vocabulary))
+        idf = np.log1p((n_docs - doc_freqs + 0.5) / (doc_freqs + 0.5)).astype(np.float32)
+
+        term_freqs = count_mat.data
+        row_length_norms = np.repeat(
+            self.k1 * (1 - self.b + self.b * doc_lengths / mean_doc_length),
+            np.diff(count_mat.indptr),
+        )
+        count_mat.data = idf[count_mat.indices] * term_freqs * (self.k1 + 1) / (term_freqs + row_length_norms)
+        self.vocabulary = vocabulary
+        self.weight_mat = count_mat
+        self.texts_fingerprint = get_texts_fingerprint(texts)
+
+    def get_query_vector(self, query_str: str) -> scipy.sparse.csr_matrix:
+        """Sparse term counts of the query, over the index's vocabulary; unknown terms are dropped."""
+        term_inds = [self.vocabulary[term] for term in tokenize(query_str) if term in self.vocabulary]
+        return scipy.sparse.csr_matrix(
+            (
+                np.ones(len(term_inds), dtype=np.float32),
+                (np.array(term_inds, dtype=np.int32), np.zeros(len(term_inds), dtype=np.int32)),
+            ),
+            shape=(len(self.vocabulary), 1),
+        )
+
+    def compute_scores(self, query_str: str) -> np.array:
+        """BM25 scores of every document for the query.
+
+        Args:
+            query_str (str): The query.
+
+        Returns:
+            np.array: Scores of shape (n_docs,); larger is more relevant, and 0 means no terms in common.
+        """
+        return (self.weight_mat @ self.get_query_vector(query_str)).toarray().ravel()
+
+    def save(self, filepath: Path):
+        terms = np.empty(len(self.vocabulary), dtype=object)
+        for term, term_ind in self.vocabulary.items():
+            terms[term_ind] = term
+        with open(filepath, "wb") as outfile:
+            np.savez(
+                outfile,
+                data=self.weight_mat.data,
+                indices=self.weight_mat.indices,
+                indptr=self.weight_mat.indptr,
+                shape=np.array(self.weight_mat.shape),
+                terms=terms.astype(str),
+                params=np.array([self.k1, self.b]),
+                texts_fingerprint=np.frombuffer(self.texts_fingerprint or b"", dtype=np.uint8),
+            )
+
+    def load(self, filepath: Path):
+        with np.load(filepath) as state:
+            self.weight_mat = scipy.sparse.csr_matrix(
+                (state["data"], state["indices"], state["indptr"]),
+                shape=tuple(state["shape"]),
+            )
+            self.vocabulary = {term: term_ind for term_ind, term in enumerate(state["terms"].tolist())}
+            self.k1, self.b = state["params"].tolist()
+            # indexes saved without a fingerprint match no texts
+            self.texts_fingerprint = state["texts_fingerprint"].tobytes() if "texts_fingerprint" in state else None
@@ -2,17 +2,23 @@
 # docs: https://platform.openai.com/docs/api-reference/chat/create#logit_bias
 # help doc: https://help.openai.com/en/articles/5247780-using-logit-bias-to-define-token-probability
 # logit_bias takes at most 300 tokens: https://aidungeon.medium.com/controlling-gpt-3-with-logit-bias-55866d593292
+from __future__ import annotations
+
 import functools
 import importlib.resources
 import json
 import re
 import string as string_utils
-from collections import Counter
+from pathlib import Path
 
+import numpy as np
 import tiktoken
 
 from llm_math_education import resources
 
+NONSTOPWORD_TOKEN_TABLE_FILENAME = "nonstopword_token_table.npy"
+STOPWORD_TOKENS_FILENAME = "dolma_stopword_tokens.npy"
+
 
 @functools.cache
 def get_tokenizer(model_name: str = "gpt-3.5-turbo") -> tiktoken.Encoding:
@@ -35,12 +41,31 @@ def get_stopword_tokens():
 
 
 def load_stopword_tokens() -> set[int]:
+    """Load the stopword tokens from the compact binary resource, falling back to the JSON resource."""
+    resource_filepath = importlib.resources.files(resources) / STOPWORD_TOKENS_FILENAME
+    if resource_filepath.is_file():
+        with resource_filepath.open("rb") as infile:
+            return set(np.load(infile).tolist())
+    return load_stopword_tokens_json()
+
+
+def load_stopword_tokens_json() -> set[int]:
     resource_filepath = importlib.resources.files(resources) / "dolma_stopwords.json"
     with resource_filepath.open("r") as infile:
         stopwords_dict = json.load(infile)
     return set(stopwords_dict["stopword_tokens"])
 
 
+def save_stopword_tokens(filepath: Path):
+    """Save the JSON resource's stopword tokens as a sorted uint32 array. Used to create the resource loaded by `load_stopword_tokens`:
+
+    ```python
+        save_stopword_tokens(Path("src/llm_math_education/resources") / STOPWORD_TOKENS_FILENAME)
+    ```
+    """
+    np.save(filepath, np.array(sorted(load_stopword_tokens_json()), dtype=np.uint32))
+
+
 def create_stopword_token_set_from_word_list(word_list: list[str]) -> set[int]:
     """Create a set of stopword tokens from the given list of stop words.
     Used to create the default stopword resource loaded by `load_stopword_tokens`.
@@ -70,20 +95,95 @@ def create_stopword_token_set_from_word_list(word_list: list[str]) -> set[int]:
     return stopword_tokens
 
 
-def get_nonstopword_tokens(text: str) -> list[int]:
+def is_nonstopword_token(token: int, stopword_tokens: set[int]) -> bool:
+    """A token is kept for logit_bias if it is alphabetic (allowing spaces) and not a stopword."""
+    tokenizer = get_tokenizer()
+    return token not in stopword_tokens and re.fullmatch("[ A-Za-z]+", tokenizer.decode([token])) is not None
+
+
+def create_nonstopword_token_table() -> np.array:
+    """Create a boolean table over the tokenizer's vocabulary, True for tokens kept by `get_nonstopword_tokens`.
+    Used to create the default resource loaded by `load_nonstopword_token_table`:
+
+    ```python
+        save_nonstopword_token_table(Path("src/llm_math_education/resources") / NONSTOPWORD_TOKEN_TABLE_FILENAME)
+    ```
+
+    Returns:
+        np.array: Boolean array of shape (tokenizer.n_vocab,).
+    """
     tokenizer = get_tokenizer()
     stopword_tokens = get_stopword_tokens()
-    tokens = tokenizer.encode(text)
-    tokens = [
-        token
-        for token in tokens
-        if token not in stopword_tokens and re.fullmatch("[ A-Za-z]+", tokenizer.decode([token]))
-    ]
-    return tokens
+    table = np.zeros(tokenizer.n_vocab, dtype=bool)
+    for token in range(tokenizer.n_vocab):
+        try:
+            table[token] = is_nonstopword_token(token, stopword_tokens)
+        except KeyError:
+            # unused token id
+            continue
+    return table
+
+
+def save_nonstopword_token_table(filepath: Path):
+    table = create_nonstopword_token_table()
+    np.save(filepath, np.packbits(table))
+
+
+def load_nonstopword_token_table() -> np.array:
+    """Load the table shipped as a resource, creating it instead if it doesn't match the tokenizer."""
+    tokenizer = get_tokenizer()
+    resource_filepath = importlib.resources.files(resources) / NONSTOPWORD_TOKEN_TABLE_FILENAME
+    if resource_filepath.is_file():
+        with resource_filepath.open("rb") as infile:
+            packed_table = np.load(infile)
+        if len(packed_table) == (tokenizer.n_vocab + 7) // 8:
+            return np.unpackbits(packed_table, count=tokenizer.n_vocab).astype(bool)
+    return create_nonstopword_token_table()
+
+
+@functools.cache
+def get_nonstopword_token_table() -> np.array:
+    """Cached version of `load_nonstopword_token_table`."""
+    return load_nonstopword_token_table()
+
+
+def get_nonstopword_tokens(text: str) -> list[int]:
+    tokenizer = get_tokenizer()
+    tokens = np.array(tokenizer.encode(text), dtype=np.int32)
+    return filter_nonstopword_tokens(tokens).tolist()
+
+
+def filter_nonstopword_tokens(tokens: np.array) -> np.array:
+    """Remove stopword and non-alphabetic tokens from an array of tokens, with a single lookup into the token table."""
+    return tokens[get_nonstopword_token_table()[tokens]]
+
+
+def get_ragged_nonstopword_tokens(texts: list[str]) -> tuple[np.array, np.array]:
+    """Non-stopword tokens of each text, as a flat buffer and offsets, e.g. for `retrieval.RetrievalDb`.
+
+    Args:
+        texts (list[str]): Texts to tokenize.
+
+    Returns:
+        tuple[np.array, np.array]: int32 tokens, and int64 offsets of shape (len(texts) + 1,);
+            text i's tokens are `tokens[offsets[i] : offsets[i + 1]]`.
+    """
+    tokenizer = get_tokenizer()
+    token_lists = tokenizer.encode_batch(texts) if len(texts) > 0 else []
+    all_tokens = np.fromiter(
+        (token for token_list in token_lists for token in token_list),
+        dtype=np.int32,
+        count=sum(len(token_list) for token_list in token_lists),
+    )
+    all_offsets = np.concatenate([[0], np.cumsum([len(token_list) for token_list in token_lists], dtype=np.int64)])
+    is_kept = get_nonstopword_token_table()[all_tokens]
+    # after filtering, each offset moves back by the number of tokens dropped before it
+    kept_prefix_counts = np.concatenate([[0], np.cumsum(is_kept, dtype=np.int64)])
+    return all_tokens[is_kept], kept_prefix_counts[all_offsets]
 
 
 def get_logit_bias(
-    tokens: list[int],
+    tokens: list[int] | np.array,
     min_count: int = 2,
     n_tokens: int | None = None,
     max_tokens: int = 50,
@@ -97,8 +197,10 @@ def get_logit_bias(
     The most frequent token will always have a weight of max_bias in the resulting logit_bias.
     Bias defaults are generally inspired by this doc: https://help.openai.com/en/articles/5247780-using-logit-bias-to-define-token-probability
 
+    Tokens with equal counts are ordered by first occurrence, as with `collections.Counter.most_common`.
+
     Args:
-        tokens (list[int]): The list of tokens, e.g. after having stopword tokens removed.
+        tokens (list[int] | np.array): The tokens, e.g. after having stopword tokens removed.
         min_count (int, optional): Defaults to 2.
         n_tokens (int | None, optional): Defaults to None.
         max_tokens (int, optional): Defaults to 50.
@@ -108,20 +210,26 @@ def get_logit_bias(
     Returns:
         dict[int, float]: The logit_bias dict that can be passed to the logit_bias parameter accepted by the OpenAI API.
     """
+    tokens = np.asarray(tokens, dtype=np.int32)
     if len(tokens) == 0:
         return {}
-    logit_bias = {}
-    c = Counter(tokens).most_common(max_tokens)
-    max_count = c[0][1]  # count of most-frequently-occurring token
-    if max_count >= min_count:
-        for token, count in c:
-            if count < min_count:
-                continue
-            bias = min_bias + (max_bias - min_bias) * (count / max_count)
-            logit_bias[token] = bias
-            if n_tokens is not None and len(logit_bias) >= n_tokens:
-                break
-    return logit_bias
+    unique_tokens, first_inds, counts = np.unique(tokens, return_index=True, return_counts=True)
+    # rank by count, then by first occurrence; the rank key is unique, so ties are broken deterministically
+    rank_keys = counts.astype(np.int64) * (len(tokens) + 1) - first_inds
+    k = min(max_tokens, len(unique_tokens))
+    top_inds = np.argpartition(-rank_keys, k - 1)[:k] if k < len(unique_tokens) else np.arange(len(unique_tokens))
+    top_inds = top_inds[np.argsort(-rank_keys[top_inds])]
+    top_counts = counts[top_inds]
+    max_count = top_counts[0]  # count of most-frequently-occurring token
+    if max_count < min_count:
+        return {}
+    is_selected = top_counts >= min_count
+    # at least one token is kept, even if n_tokens < 1
+    n_kept = None if n_tokens is None else max(n_tokens, 1)
+    top_inds = top_inds[is_selected][:n_kept]
+    top_counts = top_counts[is_selected][:n_kept]
+    biases = min_bias + (max_bias - min_bias) * (top_counts / max_count)
+    return dict(zip(unique_tokens[top_inds].tolist(), biases.tolist()))
 
 
 def get_logit_bias_from_slot(
@@ -149,3 +257,70 @@ def get_logit_bias_from_slot(
     text = "\n".join(texts)
     tokens = get_nonstopword_tokens(text)
     return get_logit_bias(tokens, **kwargs)
+
+
+@functools.lru_cache(maxsize=256)
+def get_text_nonstopword_tokens(text: str) -> np.array:
+    """Non-stopword tokens of the text, as a read-only int32 array. Cached, so repeated slot fills aren't re-encoded."""
+    tokenizer = get_tokenizer()
+    tokens = filter_nonstopword_tokens(np.array(tokenizer.encode(text), dtype=np.int32))
+    tokens.flags.writeable = False
+    return tokens
+
+
+def get_slot_tokens(
+    recent_slot_fill_dict: list[dict[str, str]],
+    slot_map: dict[str, object] | None = None,
+) -> list[dict[str, np.array]]:
+    """Tokenize the slot fills for `get_logit_bias_from_slot_tokens`.
+
+    Args:
+        recent_slot_fill_dict (list[dict[str, str]]): See `prompt_utils.PromptManager`.
+        slot_map (dict[str, object] | None, optional): The slot map that produced the fills.
+            Fills created by a `retrieval.DbInfo` use the db's stored per-row tokens (see `DbInfo.get_fill_nonstopword_tokens`)
+            instead of the tokenizer. Defaults to None, meaning every fill is tokenized.
+
+    Returns:
+        list[dict[str, np.array]]: Non-stopword tokens for each slot fill.
+    """
+    slot_map = {} if slot_map is None else slot_map
+    recent_slot_fill_tokens = []
+    for slot_fill_dict in recent_slot_fill_dict:
+        slot_fill_tokens = {}
+        for key, value in slot_fill_dict.items():
+            tokens = None
+            if hasattr(slot_map.get(key), "get_fill_nonstopword_tokens"):
+                tokens = slot_map[key].get_fill_nonstopword_tokens(value)
+            slot_fill_tokens[key] = tokens if tokens is not None else get_text_nonstopword_tokens(value)
+        recent_slot_fill_tokens.append(slot_fill_tokens)
+    return recent_slot_fill_tokens
+
+
+def get_logit_bias_from_slot_tokens(
+    recent_slot_fill_tokens: list[dict[str, np.array]],
+    include: list[str] | None = None,
+    exclude: list[str] = [],
+    **kwargs,
+) -> dict[int, float]:
+    """Like `get_logit_bias_from_slot`, but given already-tokenized slot fills (see `get_slot_tokens`).
+
+    Each slot text is tokenized separately, rather than joined and re-tokenized,
+    so results can differ from `get_logit_bias_from_slot` in tokens that span the boundary between texts.
+
+    Args:
+        recent_slot_fill_tokens (list[dict[str, np.array]]): Non-stopword tokens for each slot fill.
+        include (list[str] | None, optional): Slots to consider. Defaults to None, meaning all slots are included.
+        exclude (list[str], optional): Slots to ignore. Defaults to [].
+
+    Returns:
+        dict[int, float]: logit_bias
+    """
+    token_arrays = [
+        tokens
+        for slot_fill_tokens in recent_slot_fill_tokens
+        for key, tokens in slot_fill_tokens.items()
+        if (include is None or key in include) and key not in exclude
+    ]
+    if len(token_arrays) == 0:
+        return {}
+    return get_logit_bias(np.concatenate(token_arrays), **kwargs)
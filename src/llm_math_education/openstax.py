@@ -1,14 +1,27 @@
 # Utilities for parsing OpenStax textbooks into a structured form
 # See README.md for code example
+from __future__ import annotations
+
+import concurrent.futures
+import email.utils
+import json
 import re
+import threading
 import time
 from pathlib import Path
 
 import bs4
 import pandas as pd
 import requests
+import requests.adapters
 
+# minimum mean interval between requests, i.e. the default rate limit
 RETRIEVAL_DELAY_S = 0.25
+MAX_CONCURRENT_REQUESTS = 4
+MANIFEST_FILENAME = "manifest.json"
+# responses worth retrying, and the initial backoff when the server doesn't send a Retry-After header
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+RETRY_BACKOFF_S = 0.5
 
 
 def get_subsection_dataframe(textbook_data: list[dict]):
@@ -42,18 +55,35 @@ def parse_all_textbook_sections(textbook_data: list[dict]) -> pd.DataFrame:
     return textbook_data
 
 
-def cache_openstax_textbook_contents(url: str, outdir: Path, overwrite: bool = False):
-    intro_filepath = outdir / "intro.html"
-    if intro_filepath.exists() and not overwrite:
-        with open(intro_filepath) as infile:
-            html_doc = infile.read()
-        soup = bs4.BeautifulSoup(html_doc, "html.parser")
-    else:
-        data = requests.get(url)
-        html_doc = data.content.decode()
-        soup = bs4.BeautifulSoup(html_doc, "html.parser")
-        with open(intro_filepath, "w") as outfile:
-            outfile.write(soup.prettify())
+def cache_openstax_textbook_contents(
+    url: str,
+    outdir: Path,
+    overwrite: bool = False,
+    max_workers: int = MAX_CONCURRENT_REQUESTS,
+    requests_per_s: float = 1 / RETRIEVAL_DELAY_S,
+    fetcher: OpenStaxFetcher | None = None,
+) -> list[dict]:
+    """Download the textbook's table of contents and pages into outdir, parsing each page.
+
+    Pages are fetched concurrently by an `OpenStaxFetcher`. Pages already in outdir are reused,
+    so an interrupted download resumes where it stopped.
+
+    Args:
+        url (str): URL of the textbook's first page, e.g. "https://openstax.org/books/prealgebra-2e/pages/1-introduction".
+        outdir (Path): Directory for the cached pages and manifest.
+        overwrite (bool, optional): If True, re-request cached pages, skipping those the server reports as unchanged.
+            Defaults to False.
+        max_workers (int, optional): Maximum number of concurrent requests. Defaults to MAX_CONCURRENT_REQUESTS.
+        requests_per_s (float, optional): Sustained request rate across all workers. Defaults to 1 / RETRIEVAL_DELAY_S.
+        fetcher (OpenStaxFetcher | None, optional): Fetcher to use instead of creating one. Defaults to None.
+
+    Returns:
+        list[dict]: One dict per chapter section, with the "chapter", "section", "href", and parsed "soup".
+    """
+    if fetcher is None:
+        fetcher = OpenStaxFetcher(outdir, max_workers=max_workers, requests_per_s=requests_per_s)
+    html_doc = fetcher.fetch(url, "intro.html", overwrite=overwrite)
+    soup = bs4.BeautifulSoup(html_doc, "html.parser")
     toc = soup.find_all(attrs={"class": "os-text"})
     assert len(toc) > 0, "Unexpected table-of-contents structure."
 
@@ -84,25 +114,213 @@ def cache_openstax_textbook_contents(url: str, outdir: Path, overwrite: bool = F
                 "href": href,
             },
         )
-    # retrieve textbook data page by page
+    # retrieve textbook data, several pages at a time
     root_url = url.split("pages")[0] + "pages/"
-    for i, chapter_data in enumerate(textbook_data):
-        part_filepath = outdir / f"part{i}.html"
-        if part_filepath.exists() and not overwrite:
-            with open(part_filepath) as infile:
-                html_doc = infile.read()
-            soup = bs4.BeautifulSoup(html_doc, "html.parser")
-        else:
-            data = requests.get(root_url + chapter_data["href"])
-            html_doc = data.content.decode()
-            soup = bs4.BeautifulSoup(html_doc, "html.parser")
-            with open(part_filepath, "w") as outfile:
-                outfile.write(soup.prettify())
-            time.sleep(RETRIEVAL_DELAY_S)
-        chapter_data["soup"] = soup
+    html_docs = fetcher.fetch_all(
+        [(root_url + chapter_data["href"], f"part{i}.html") for i, chapter_data in enumerate(textbook_data)],
+        overwrite=overwrite,
+    )
+    for chapter_data, html_doc in zip(textbook_data, html_docs):
+        chapter_data["soup"] = bs4.BeautifulSoup(html_doc, "html.parser")
     return textbook_data
 
 
+class TokenBucket:
+    """Thread-safe token-bucket rate limiter.
+
+    Tokens accrue at rate per second, up to capacity; `acquire` blocks until a token is available.
+    Unlike a fixed sleep after each request, waiting overlaps with requests in flight.
+    `pause` holds back every caller, e.g. when the server asks clients to slow down.
+    """
+
+    def __init__(self, rate: float, capacity: float = 1.0):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.last_update = time.monotonic()
+        self.paused_until = self.last_update
+        self.lock = threading.Lock()
+
+    def update_tokens(self):
+        # last_update may be in the future during a pause, in which case no tokens accrue until then
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.last_update) * self.rate)
+        self.last_update = now
+
+    def acquire(self):
+        with self.lock:
+            self.update_tokens()
+            # reserve a token now, waiting outside the lock if it hasn't accrued yet
+            self.tokens -= 1
+            wait_s = -self.tokens / self.rate if self.tokens < 0 else 0.0
+        if wait_s > 0:
+            time.sleep(wait_s)
+        # callers that reserved a token before a pause started still wait for it to end
+        while True:
+            with self.lock:
+                pause_s = self.paused_until - time.monotonic()
+            if pause_s <= 0:
+                return
+            time.sleep(pause_s)
+
+    def pause(self, delay_s: float):
+        """Block all callers for at least delay_s, after which tokens accrue from empty."""
+        with self.lock:
+            self.update_tokens()
+            self.paused_until = max(self.paused_until, time.monotonic() + delay_s)
+            self.tokens = min(self.tokens, 0.0)
+            self.last_update = max(self.last_update, self.paused_until)
+
+
+class OpenStaxFetcher:
+    """Concurrent, resumable page downloader used by `cache_openstax_textbook_contents`.
+
+    Requests share a pooled, keep-alive `requests.Session` and a `TokenBucket`, with at most max_workers in flight.
+    Failed requests (connection errors and RETRY_STATUS_CODES) are retried through the same `TokenBucket`,
+    which is paused for the server's Retry-After (or an exponential backoff), so retries never exceed requests_per_s.
+    Each saved page is recorded in a manifest in outdir, along with the server's ETag and Last-Modified headers.
+    Cached pages are reused without a request unless overwrite is set,
+    in which case the request is conditional and unchanged pages (HTTP 304) are read from disk.
+    """
+
+    def __init__(
+        self,
+        outdir: Path,
+        max_workers: int = MAX_CONCURRENT_REQUESTS,
+        requests_per_s: float = 1 / RETRIEVAL_DELAY_S,
+        timeout_s: float = 30.0,
+        max_retries: int = 3,
+        session: requests.Session | None = None,
+    ):
+        self.outdir = outdir
+        self.max_workers = max_workers
+        self.timeout_s = timeout_s
+        self.max_retries = max_retries
+        self.rate_limiter = TokenBucket(requests_per_s)
+        if session is None:
+            session = requests.Session()
+            # no adapter-level retries: those would bypass the rate limiter (see `get`)
+            adapter = requests.adapters.HTTPAdapter(pool_maxsize=max_workers)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+        self.session = session
+
+        self.manifest_filepath = self.outdir / MANIFEST_FILENAME
+        self.manifest_lock = threading.Lock()
+        self.manifest = self.load_manifest()
+
+    def load_manifest(self) -> dict[str, dict[str, str | None]]:
+        """Map of filename -> {"url", "etag", "last_modified"} for each completed page."""
+        if not self.manifest_filepath.exists():
+            return {}
+        with open(self.manifest_filepath) as infile:
+            return json.load(infile)
+
+    def save_manifest(self):
+        # write-then-rename, so an interrupted run never leaves a partial manifest
+        tmp_filepath = self.manifest_filepath.with_suffix(".tmp")
+        with open(tmp_filepath, "w") as outfile:
+            json.dump(self.manifest, outfile, indent=2)
+        tmp_filepath.replace(self.manifest_filepath)
+
+    def get(self, url: str, headers: dict[str, str]) -> requests.Response:
+        """GET url once the rate limiter allows, retrying up to max_retries times.
+
+        Returns:
+            requests.Response: The final response, which may still be an error.
+        """
+        for attempt in range(self.max_retries + 1):
+            self.rate_limiter.acquire()
+            try:
+                response = self.session.get(url, headers=headers, timeout=self.timeout_s)
+            except (requests.ConnectionError, requests.Timeout):
+                if attempt == self.max_retries:
+                    raise
+                self.rate_limiter.pause(RETRY_BACKOFF_S * 2**attempt)
+                continue
+            if response.status_code not in RETRY_STATUS_CODES or attempt == self.max_retries:
+                return response
+            retry_after_s = get_retry_after_s(response)
+            response.close()
+            self.rate_limiter.pause(retry_after_s if retry_after_s is not None else RETRY_BACKOFF_S * 2**attempt)
+
+    def fetch(self, url: str, filename: str, overwrite: bool = False) -> str:
+        """The page at url, cached in outdir as filename.
+
+        Args:
+            url (str): Page URL.
+            filename (str): Name of the cached page within outdir.
+            overwrite (bool, optional): If True, re-request a cached page, reusing it if unchanged. Defaults to False.
+
+        Returns:
+            str: The (prettified) HTML of the page.
+        """
+        filepath = self.outdir / filename
+        if filepath.exists() and not overwrite:
+            with open(filepath) as infile:
+                return infile.read()
+
+        with self.manifest_lock:
+            entry = self.manifest.get(filename)
+        headers = {}
+        if filepath.exists() and entry is not None and entry["url"] == url:
+            if entry.get("etag") is not None:
+                headers["If-None-Match"] = entry["etag"]
+            if entry.get("last_modified") is not None:
+                headers["If-Modified-Since"] = entry["last_modified"]
+        response = self.get(url, headers)
+        if response.status_code == 304:
+            with open(filepath) as infile:
+                return infile.read()
+        response.raise_for_status()
+        html_doc = bs4.BeautifulSoup(response.content.decode(), "html.parser").prettify()
+        self.outdir.mkdir(parents=True, exist_ok=True)
+        tmp_filepath = filepath.with_suffix(".tmp")
+        with open(tmp_filepath, "w") as outfile:
+            outfile.write(html_doc)
+        tmp_filepath.replace(filepath)
+        with self.manifest_lock:
+            self.manifest[filename] = {
+                "url": url,
+                "etag": response.headers.get("ETag"),
+                "last_modified": response.headers.get("Last-Modified"),
+            }
+            self.save_manifest()
+        return html_doc
+
+    def fetch_all(self, url_filenames: list[tuple[str, str]], overwrite: bool = False) -> list[str]:
+        """Fetch many pages concurrently. See `fetch`.
+
+        Pages completed before an error are saved and recorded, so a retry only fetches the rest.
+
+        Args:
+            url_filenames (list[tuple[str, str]]): (url, filename) pairs.
+            overwrite (bool, optional): Defaults to False.
+
+        Returns:
+            list[str]: The HTML of each page, in the order given.
+        """
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = [executor.submit(self.fetch, url, filename, overwrite) for url, filename in url_filenames]
+            return [future.result() for future in futures]
+
+
+def get_retry_after_s(response: requests.Response) -> float | None:
+    """Seconds to wait according to the response's Retry-After header (delay-seconds or HTTP-date), if any."""
+    retry_after = response.headers.get("Retry-After")
+    if retry_after is None:
+        return None
+    try:
+        return max(0.0, float(retry_after))
+    except ValueError:
+        pass
+    try:
+        retry_at = email.utils.parsedate_to_datetime(retry_after)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, retry_at.timestamp() - time.time())
+
+
 def parse_section(section):
     header_tags = ["title", "h1", "h2", "h3", "h4", "h5"]
     content_tags = [None, "strong", "em", "b", "li", "span", "a", "sup", "u"]
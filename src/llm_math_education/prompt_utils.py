@@ -1,10 +1,20 @@
 from __future__ import annotations
 
+import collections.abc
+import functools
 import re
+import string
 
 from llm_math_education import embedding_utils, retrieval_strategies
 
 VALID_ROLES: list[str] = ["user", "assistant", "system"]
+# chat format overhead, see https://github.com/openai/openai-cookbook/blob/main/examples/How_to_count_tokens_with_tiktoken.ipynb
+TOKENS_PER_MESSAGE: int = 3
+TOKENS_PER_NAME: int = 1
+TOKENS_PER_REPLY: int = 3
+CONTEXT_SUMMARY_PREFIX: str = "Summary of the earlier conversation:\n"
+# number of distinct message contents to keep compiled templates for
+TEMPLATE_CACHE_SIZE: int = 1024
 
 
 class PromptSelector:
@@ -85,8 +95,22 @@ class PromptManager:
         self.stored_messages: list[dict[str, str]] = []
         self.most_recent_slot_fill_dict: dict[str, str] = {}
         self.recent_slot_fill_dict: list[dict[str, str]] = []
+        # token counts of message contents, maintained incrementally
+        self.intro_token_counts: list[int] = []
+        self.stored_token_counts: list[int] = []
+        self.stored_token_count: int = 0
+        self.stored_overhead_token_count: int = 0
+        # context window over the stored messages, see set_context_window
+        self.max_context_tokens: int | None = None
+        self.summarizer: collections.abc.Callable[[list[dict[str, str]], str | None], str] | None = None
+        self.n_pinned_stored_messages: int = 0
+        self._reset_context_window()
 
     def set_intro_messages(self, intro_messages: list[dict[str, str]]) -> PromptManager:
+        if intro_messages != self.intro_messages or len(self.intro_token_counts) != len(intro_messages):
+            self.intro_token_counts = embedding_utils.get_token_counts(
+                [message["content"] for message in intro_messages],
+            )
         self.intro_messages = intro_messages
         return self
 
@@ -97,14 +121,127 @@ class PromptManager:
     def get_retrieval_strategy(self) -> retrieval_strategies.RetrievalStrategy:
         return self.retrieval_strategy
 
-    def add_stored_message(self, message: dict[str, str]) -> PromptManager:
+    def set_context_window(
+        self,
+        max_context_tokens: int | None,
+        summarizer: collections.abc.Callable[[list[dict[str, str]], str | None], str] | None = None,
+    ) -> PromptManager:
+        """Limit the messages build_query returns for the stored conversation to a token budget.
+
+        The intro messages are always kept, followed by the most recent messages that fit in the budget.
+        Evicted messages are never re-added, so each build_query only considers newly stored messages.
+
+        Args:
+            max_context_tokens (int | None): Token budget, including chat format overhead. None to disable.
+            summarizer (Callable[[list[dict[str, str]], str | None], str] | None, optional): If provided, called with newly evicted messages and the previous summary (or None), returning an updated summary. The summary is included as a system message after the intro messages. Defaults to None.
+        """
+        self.max_context_tokens = max_context_tokens
+        self.summarizer = summarizer
+        self._reset_context_window()
+        return self
+
+    def _reset_context_window(self):
+        self.context_window_start: int = self.n_pinned_stored_messages
+        self.context_window_end: int = self.n_pinned_stored_messages
+        self.context_window_token_count: int = 0
+        self.context_summary: str | None = None
+        self.context_summary_token_count: int = 0
+
+    def _get_stored_message_token_count(self, ind: int) -> int:
+        return self.stored_token_counts[ind] + PromptManager.get_message_overhead_token_count(self.stored_messages[ind])
+
+    def _update_context_window(self):
+        """Advance the context window over any newly stored messages, evicting the oldest as needed."""
+        pinned_token_count = sum(
+            self._get_stored_message_token_count(i)
+            for i in range(min(self.n_pinned_stored_messages, len(self.stored_messages)))
+        )
+        for i in range(self.context_window_end, len(self.stored_messages)):
+            self.context_window_token_count += self._get_stored_message_token_count(i)
+        self.context_window_end = max(self.context_window_end, len(self.stored_messages))
+        budget = self.max_context_tokens - pinned_token_count - TOKENS_PER_REPLY
+        while self.context_window_token_count + self.context_summary_token_count > budget:
+            evicted_messages = []
+            while (
+                self.context_window_token_count + self.context_summary_token_count > budget
+                and self.context_window_start < len(self.stored_messages) - 1
+            ):
+                evicted_messages.append(self.stored_messages[self.context_window_start])
+                self.context_window_token_count -= self._get_stored_message_token_count(self.context_window_start)
+                self.context_window_start += 1
+            if len(evicted_messages) == 0 or self.summarizer is None:
+                break
+            self.context_summary = self.summarizer(evicted_messages, self.context_summary)
+            summary_message = self._get_context_summary_message()
+            self.context_summary_token_count = embedding_utils.get_token_counts([summary_message["content"]])[
+                0
+            ] + PromptManager.get_message_overhead_token_count(summary_message)
+
+    def _get_context_summary_message(self) -> dict[str, str]:
+        return {
+            "role": "system",
+            "content": CONTEXT_SUMMARY_PREFIX + self.context_summary,
+        }
+
+    def get_context_window_messages(self, messages: list[dict[str, str]]) -> list[dict[str, str]]:
+        """Given messages corresponding to the stored messages, select the ones in the context window.
+
+        Args:
+            messages (list[dict[str, str]]): Messages corresponding one-to-one to stored_messages, e.g. as built by build_query.
+
+        Returns:
+            list[dict[str, str]]: The intro messages, the summary message (if any), and the most recent messages.
+        """
+        if self.max_context_tokens is None:
+            return messages
+        assert len(messages) == len(self.stored_messages), "Expected messages corresponding to the stored messages."
+        self._update_context_window()
+        window_messages = messages[: self.n_pinned_stored_messages]
+        if self.context_summary is not None:
+            window_messages.append(self._get_context_summary_message())
+        window_messages.extend(messages[self.context_window_start :])
+        return window_messages
+
+    def add_stored_message(self, message: dict[str, str], n_tokens: int | None = None) -> PromptManager:
+        """Store the message, e.g. an assistant response.
+
+        Args:
+            message (dict[str, str]): The message to store.
+            n_tokens (int | None, optional): Token count of the message content, if already known. Defaults to None, meaning the content is tokenized.
+        """
         self.stored_messages.append(message)
+        self._add_stored_token_count(message, n_tokens)
         return self
 
     def clear_stored_messages(self) -> PromptManager:
         self.stored_messages.clear()
+        self.stored_token_counts.clear()
+        self.stored_token_count = 0
+        self.stored_overhead_token_count = 0
+        self.n_pinned_stored_messages = 0
+        self._reset_context_window()
         return self
 
+    def _add_stored_token_count(self, message: dict[str, str], n_tokens: int | None = None):
+        if n_tokens is None:
+            n_tokens = embedding_utils.get_token_counts([message["content"]])[0]
+        self.stored_token_counts.append(n_tokens)
+        self.stored_token_count += n_tokens
+        self.stored_overhead_token_count += PromptManager.get_message_overhead_token_count(message)
+
+    def _sync_stored_token_counts(self):
+        """Recount if stored_messages was modified directly rather than through this PromptManager."""
+        if len(self.stored_token_counts) == len(self.stored_messages):
+            return
+        self.stored_token_counts = embedding_utils.get_token_counts(
+            [message["content"] for message in self.stored_messages]
+        )
+        self.stored_token_count = sum(self.stored_token_counts)
+        self.stored_overhead_token_count = sum(
+            PromptManager.get_message_overhead_token_count(message) for message in self.stored_messages
+        )
+        self._reset_context_window()
+
     def build_query(
         self,
         user_query: str | None = None,
@@ -118,18 +255,65 @@ class PromptManager:
             previous_messages (list[dict[str, str]] | None, optional): If provided, will continue a conversation. Defaults to None.
             query_for_retrieval_context (str | None, optional): If provided, this is used for any RetrievalStrategies that require querying. Defaults to None, meaning the user_query or the most recent user message will be used.
 
+        If a context window is set (see `set_context_window`) and previous_messages are the stored messages, older messages are trimmed from the result.
+
         Raises:
             KeyError: If the given RetrievalStrategy doesn't fill all the identified slots in the prompts.
 
         Returns:
             list[dict[str, str]]: List of messages, to pass to the OpenAI API.
         """
+        query_builder = self._iterate_query_retrievals(user_query, previous_messages, query_for_retrieval_context)
+        try:
+            retrieval_args = next(query_builder)
+            while True:
+                retrieval_args = query_builder.send(self.retrieval_strategy.do_retrieval(*retrieval_args))
+        except StopIteration as stop:
+            return stop.value
+
+    async def abuild_query(
+        self,
+        user_query: str | None = None,
+        previous_messages: list[dict[str, str]] | None = None,
+        query_for_retrieval_context: str | None = None,
+    ) -> list[dict[str, str]]:
+        """Async variant of `build_query`, awaiting the RetrievalStrategy's `ado_retrieval`.
+
+        Concurrent calls should use separate PromptManagers, as the stored messages are updated.
+        """
+        query_builder = self._iterate_query_retrievals(user_query, previous_messages, query_for_retrieval_context)
+        try:
+            retrieval_args = next(query_builder)
+            while True:
+                retrieval_args = query_builder.send(await self.retrieval_strategy.ado_retrieval(*retrieval_args))
+        except StopIteration as stop:
+            return stop.value
+
+    def _iterate_query_retrievals(
+        self,
+        user_query: str | None,
+        previous_messages: list[dict[str, str]] | None,
+        query_for_retrieval_context: str | None,
+    ) -> collections.abc.Generator[tuple[list[str], str, list[dict[str, str]]], dict[str, str], list[dict[str, str]]]:
+        """Implements build_query, yielding arguments for each needed retrieval and expecting the slot_fill_dict to be sent back.
+
+        This lets `build_query` and `abuild_query` share an implementation.
+        """
         if previous_messages is None:
             previous_messages = self.stored_messages
+        is_stored_conversation = previous_messages is self.stored_messages
+        self._sync_stored_token_counts()
+        # messages newly stored by this query, and their token counts if unaffected by slot filling
+        new_stored_messages = []
+        new_stored_token_counts = []
         if len(previous_messages) == 0:
             # this is a new query
             messages = [message.copy() for message in self.intro_messages]
-            self.stored_messages.extend(messages)
+            new_stored_messages.extend(messages)
+            new_stored_token_counts.extend(self.intro_token_counts)
+            if len(self.stored_messages) == 0:
+                self.n_pinned_stored_messages = len(messages)
+                self._reset_context_window()
         else:
             # not a new query,
             # so include the previous messages as context
@@ -140,19 +324,17 @@ class PromptManager:
                 "content": user_query,
             }
             messages.append(user_message)
-            self.stored_messages.append(user_message)
+            new_stored_messages.append(user_message)
+            new_stored_token_counts.append(None)
 
         should_remove_user_query_message = False
         if query_for_retrieval_context is None:
             query_for_retrieval_context = ""
         for message in messages[::-1]:
-            expected_slots = PromptManager.identify_slots(message["content"])
+            template = get_prompt_template(message["content"])
+            expected_slots = template.slots
             if len(expected_slots) > 0:
-                slot_fill_dict = self.retrieval_strategy.do_retrieval(
-                    expected_slots,
-                    query_for_retrieval_context,
-                    messages,
-                )
+                slot_fill_dict = yield expected_slots, query_for_retrieval_context, messages
                 self.most_recent_slot_fill_dict = slot_fill_dict
                 self.recent_slot_fill_dict.append(slot_fill_dict)
                 assert len(slot_fill_dict) == len(expected_slots), "Unexpected fill provided."
@@ -161,9 +343,13 @@ class PromptManager:
                     slot_fill_dict["user_query"] = user_query
                     should_remove_user_query_message = True
                 try:
-                    message["content"] = message["content"].format(**slot_fill_dict)
+                    message["content"] = template.render(slot_fill_dict)
                 except KeyError:
                     raise KeyError(f"Failed to fill {expected_slots} with {slot_fill_dict}.")
+                for i, stored_message in enumerate(new_stored_messages):
+                    if stored_message is message:
+                        # content changed, so will need to be counted
+                        new_stored_token_counts[i] = None
             else:
                 self.recent_slot_fill_dict.append({})
             if query_for_retrieval_context == "" and message["role"] == "user":
@@ -172,15 +358,47 @@ class PromptManager:
                 query_for_retrieval_context = message["content"]
         self.recent_slot_fill_dict = self.recent_slot_fill_dict[::-1]
         if should_remove_user_query_message:
-            self.stored_messages.pop()
+            new_stored_messages.pop()
+            new_stored_token_counts.pop()
             assert messages[-1]["content"] == user_query
             messages = messages[:-1]
+        self._store_new_messages(new_stored_messages, new_stored_token_counts)
+        if is_stored_conversation:
+            messages = self.get_context_window_messages(messages)
         return messages
 
+    def _store_new_messages(self, new_stored_messages: list[dict[str, str]], new_stored_token_counts: list[int | None]):
+        uncounted_inds = [i for i, n_tokens in enumerate(new_stored_token_counts) if n_tokens is None]
+        token_counts = embedding_utils.get_token_counts([new_stored_messages[i]["content"] for i in uncounted_inds])
+        for i, n_tokens in zip(uncounted_inds, token_counts):
+            new_stored_token_counts[i] = n_tokens
+        for message, n_tokens in zip(new_stored_messages, new_stored_token_counts):
+            self.add_stored_message(message, n_tokens)
+
     def compute_stored_token_counts(self) -> int:
-        token_counts = embedding_utils.get_token_counts([message["content"] for message in self.stored_messages])
-        total_token_count = sum(token_counts)
-        return total_token_count
+        """Total tokens in the contents of the stored messages, excluding chat format overhead.
+
+        Counts are maintained as messages are stored, so this does not re-tokenize.
+        """
+        self._sync_stored_token_counts()
+        return self.stored_token_count
+
+    def compute_stored_chat_token_count(self) -> int:
+        """Total tokens the stored messages use when sent to the chat API, including per-message and reply overhead.
+
+        Compare to the model's context window, e.g. before adding a new query.
+        """
+        self._sync_stored_token_counts()
+        if len(self.stored_messages) == 0:
+            return 0
+        return self.stored_token_count + self.stored_overhead_token_count + TOKENS_PER_REPLY
+
+    def get_message_overhead_token_count(message: dict[str, str]) -> int:
+        """Tokens the chat format adds for the given message, beyond its content."""
+        overhead_token_count = TOKENS_PER_MESSAGE + get_role_token_count(message["role"])
+        if "name" in message:
+            overhead_token_count += TOKENS_PER_NAME + embedding_utils.get_token_counts([message["name"]])[0]
+        return overhead_token_count
 
     def identify_slots(prompt_string: str) -> list[str]:
         """Uses a regex to identify missing slots in a prompt_string.
@@ -193,5 +411,50 @@ class PromptManager:
         Returns:
             list[str]: List of identified slots.
         """
-        expected_slots = re.findall(r"{[^{} ]+}", prompt_string)
-        return sorted({slot[1:-1] for slot in expected_slots})
+        return list(get_prompt_template(prompt_string).slots)
+
+
+class PromptTemplate:
+    """A prompt string with format-style slots, parsed once so it can be rendered repeatedly.
+
+    Use `get_prompt_template` to share compiled templates, e.g. for intro messages that are rendered every turn.
+    """
+
+    def __init__(self, template_string: str):
+        self.template_string = template_string
+        expected_slots = re.findall(r"{[^{} ]+}", template_string)
+        self.slots: list[str] = sorted({slot[1:-1] for slot in expected_slots})
+        # (literal_text, field_name) pairs; None if rendering needs the full str.format machinery
+        self.segments: list[tuple[str, str | None]] | None = []
+        try:
+            for literal_text, field_name, format_spec, conversion in string.Formatter().parse(template_string):
+                if field_name is not None and (format_spec or conversion or not field_name.isidentifier()):
+                    self.segments = None
+                    break
+                self.segments.append((literal_text, field_name))
+        except ValueError:
+            # malformed template; str.format will raise when rendering
+            self.segments = None
+
+    def render(self, slot_fill_dict: dict[str, str]) -> str:
+        """Fill the slots, equivalent to `template_string.format(**slot_fill_dict)`.
+
+        Raises:
+            KeyError: If a slot is missing from slot_fill_dict.
+        """
+        if self.segments is None:
+            return self.template_string.format(**slot_fill_dict)
+        return "".join(
+            literal_text if field_name is None else literal_text + format(slot_fill_dict[field_name], "")
+            for literal_text, field_name in self.segments
+        )
+
+
+@functools.lru_cache(maxsize=TEMPLATE_CACHE_SIZE)
+def get_prompt_template(template_string: str) -> PromptTemplate:
+    return PromptTemplate(template_string)
+
+
+@functools.cache
+def get_role_token_count(role: str) -> int:
+    return embedding_utils.get_token_counts([role])[0]
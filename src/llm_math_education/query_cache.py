@@ -0,0 +1,149 @@
+# Bounded cache of retrieval results, keyed on the query string or on a nearby query embedding.
+# See `retrieval_strategies.CachedRetrievalStrategy`.
+from __future__ import annotations
+
+import collections
+import collections.abc
+import threading
+import time
+
+import numpy as np
+
+from llm_math_education import embedding_utils
+
+
+class SemanticQueryCache:
+    """LRU cache of values (e.g. slot fill dicts) for queries, with optional time-to-live.
+
+    Lookups first try an exact match on the key, then the most similar cached query embedding
+    within similarity_threshold (cosine similarity). Cached embeddings are stored in a single matrix,
+    so a near-duplicate lookup is one matrix-vector product. Safe to share between threads.
+    """
+
+    def __init__(
+        self,
+        max_entries: int = 1024,
+        ttl_s: float | None = None,
+        similarity_threshold: float = 0.97,
+        embedding_dim: int = embedding_utils.EMBEDDING_DIM,
+    ):
+        if max_entries < 1:
+            raise ValueError(
+                f"max_entries must be at least 1, not {max_entries}; to disable caching, don't wrap the strategy."
+            )
+        self.max_entries = max_entries
+        self.ttl_s = ttl_s
+        self.similarity_threshold = similarity_threshold
+        self.lock = threading.Lock()
+        # key -> (embedding row, creation time, value), in least- to most-recently used order
+        self.entries: collections.OrderedDict[tuple, tuple[int | None, float, object]] = collections.OrderedDict()
+        self.embedding_mat = np.zeros((max_entries, embedding_dim), dtype=np.float32)
+        # key of the entry using each embedding row, or None if the row is free
+        self.row_keys: list[tuple | None] = [None] * max_entries
+        self.free_rows: list[int] = list(range(max_entries))[::-1]
+        self.n_exact_hits = 0
+        self.n_similar_hits = 0
+        self.n_misses = 0
+        self.n_evictions = 0
+
+    def get(self, key: tuple) -> object | None:
+        """The value cached for exactly this key, or None."""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and not self._is_expired(entry):
+                self.entries.move_to_end(key)
+                self.n_exact_hits += 1
+                return entry[2]
+            if entry is not None:
+                self._remove(key)
+            return None
+
+    def get_similar(
+        self, query_embedding: np.array, key_filter: collections.abc.Callable[[tuple], bool]
+    ) -> object | None:
+        """The value cached for the most similar query embedding, if within the similarity threshold.
+
+        Args:
+            query_embedding (np.array): Embedding of the query.
+            key_filter (Callable[[tuple], bool]): Only entries whose keys pass this filter are considered.
+
+        Returns:
+            object | None: The cached value, or None on a miss.
+        """
+        query_embedding = np.asarray(query_embedding, dtype=np.float32).ravel()
+        query_embedding = query_embedding / max(np.linalg.norm(query_embedding), 1e-12)
+        with self.lock:
+            similarities = self.embedding_mat @ query_embedding
+            for row in np.argsort(-similarities):
+                if similarities[row] < self.similarity_threshold:
+                    break
+                key = self.row_keys[row]
+                if key is None or not key_filter(key):
+                    continue
+                entry = self.entries[key]
+                if self._is_expired(entry):
+                    self._remove(key)
+                    continue
+                self.entries.move_to_end(key)
+                self.n_similar_hits += 1
+                return entry[2]
+            self.n_misses += 1
+            return None
+
+    def add(self, key: tuple, value: object, query_embedding: np.array | None = None):
+        """Cache the value, evicting the least recently used entry if full.
+
+        Args:
+            key (tuple): Exact-match key.
+            value (object): Value to cache.
+            query_embedding (np.array | None, optional): If provided, the value can also be found by similar embeddings. Defaults to None.
+        """
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+            while len(self.entries) >= self.max_entries:
+                self._remove(next(iter(self.entries)))
+                self.n_evictions += 1
+            row = None
+            if query_embedding is not None:
+                row = self.free_rows.pop()
+                query_embedding = np.asarray(query_embedding, dtype=np.float32).ravel()
+                self.embedding_mat[row] = query_embedding / max(np.linalg.norm(query_embedding), 1e-12)
+                self.row_keys[row] = key
+            self.entries[key] = (row, time.monotonic(), value)
+
+    def record_miss(self):
+        """Count a miss for a lookup that didn't reach get_similar, e.g. with no query embedding available."""
+        with self.lock:
+            self.n_misses += 1
+
+    def clear(self):
+        with self.lock:
+            for key in list(self.entries.keys()):
+                self._remove(key)
+
+    def _remove(self, key: tuple):
+        row, _, _ = self.entries.pop(key)
+        if row is not None:
+            self.embedding_mat[row] = 0
+            self.row_keys[row] = None
+            self.free_rows.append(row)
+
+    def _is_expired(self, entry: tuple[int | None, float, object]) -> bool:
+        return self.ttl_s is not None and time.monotonic() - entry[1] > self.ttl_s
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def get_stats(self) -> dict[str, float]:
+        """Hit and miss counts, and the overall hit rate."""
+        n_hits = self.n_exact_hits + self.n_similar_hits
+        n_lookups = n_hits + self.n_misses
+        return {
+            "exact_hits": self.n_exact_hits,
+            "similar_hits": self.n_similar_hits,
+            "misses": self.n_misses,
+            "evictions": self.n_evictions,
+            "entries": len(self.entries),
+            "hit_rate": n_hits / n_lookups if n_lookups > 0 else 0.0,
+        }
@@ -1,13 +1,28 @@
 from __future__ import annotations
 
+import collections
 import collections.abc
+import hashlib
+import logging
+import threading
 from pathlib import Path
 
 import numpy as np
 import pandas as pd
-import scipy
 
-from llm_math_education import embedding_utils
+from llm_math_education import (
+    embedding_utils,
+    lexical_index,
+    logit_bias,
+    retrieval_index,
+)
+
+# number of candidates to partially sort before growing the candidate set
+DEFAULT_TOP_K = 32
+# number of fill strings memoized per DbInfo; see `DbInfo.get_fill_string_from_query_embedding`
+DEFAULT_FILL_MEMO_SIZE = 128
+# upper bound on the (n_queries, n_texts) distance matrix materialized at once by batch_search
+MAX_DISTANCE_MATRIX_SIZE = 2**24
 
 
 class RetrievalDb:
@@ -27,6 +42,24 @@ class RetrievalDb:
         # `load()` is called during construction if df is not provided
         assert "text_col" in retrieval_db.df.columns
     ```
+
+    When sharing embeddings across processes, pass `mmap_mode="r"`:
+    the embedding matrices are memory-mapped rather than read into private memory,
+    so the OS page cache holds a single copy.
+    The float32 search matrix is written next to the embeddings on the first such load, if it isn't already saved.
+
+    Only the float32 search matrix (`normalized_embedding_mat`) is held in memory,
+    and not even that if the index doesn't need it (see `retrieval_index.RetrievalIndex.needs_resident_embeddings`),
+    in which case it is saved next to the embeddings and memory-mapped.
+    The raw saved matrix (`embedding_mat`, usually float64) is memory-mapped read-only when first accessed,
+    so it costs no private memory but reading it goes to disk (or the page cache).
+    Prefer `normalized_embedding_mat` for anything on the query path.
+
+    By default, search is exact (`retrieval_index.BruteForceIndex`).
+    For large dbs, pass an approximate index, which is built on first use and saved next to the embeddings:
+    ```python
+        retrieval_db = RetrievalDb(Path("embedding_dir"), "db_name", "text_col", index=retrieval_index.IvfIndex(n_probe=8))
+    ```
     """
 
     def __init__(
@@ -36,24 +69,35 @@ class RetrievalDb:
         embed_col: str,
         df: pd.DataFrame | None = None,
         n_tokens_col: str = "n_tokens",
+        mmap_mode: str | None = None,
+        index: retrieval_index.RetrievalIndex | None = None,
+        embedding_model: str = embedding_utils.EMBEDDING_MODEL,
     ):
         self.embedding_dir = embedding_dir
         self.db_name = db_name
+        self.embedding_model = embedding_model
+        # incremented whenever the texts, embeddings, or index change, invalidating anything derived from them
+        self.generation = 0
+        self.mmap_mode = mmap_mode
+        self.index = index if index is not None else retrieval_index.BruteForceIndex()
+        self._embedding_mat = None
 
         self.df_filepath = self.embedding_dir / f"{self.db_name}_df.parquet"
         self.embedding_filepath = self.embedding_dir / f"{self.db_name}_embed.npy"
+        self.normalized_embedding_filepath = self.embedding_dir / f"{self.db_name}_embed_normalized.npy"
+        self.lexical_index_filepath = self.embedding_dir / f"{self.db_name}_bm25_index.npz"
+        self.token_array_filepath = self.embedding_dir / f"{self.db_name}_nonstopword_tokens.npz"
 
         self.embed_col = embed_col
+        self.n_tokens_col = n_tokens_col
+        # fingerprint of the texts in the parquet file, if known; see `is_df_saved`
+        self.saved_texts_fingerprint: bytes | None = None
         if df is None:
             self.load()
         else:
             self.df = df
             self.normalize_strings()
-        assert self.embed_col in self.df.columns
-
-        self.n_tokens_col = n_tokens_col
-        if n_tokens_col not in self.df.columns:
-            self.compute_token_counts()
+            self.prepare_columns()
 
     def normalize_strings(self):
         self.df[self.embed_col] = self.df[self.embed_col].map(normalize_text)
@@ -62,31 +106,321 @@ class RetrievalDb:
         token_counts = embedding_utils.get_token_counts(self.df[self.embed_col])
         self.df[self.n_tokens_col] = token_counts
 
-    def create_embeddings(self):
-        embedding_list = embedding_utils.batch_embed_texts(self.df[self.embed_col], self.df[self.n_tokens_col])
-        self.embedding_mat = np.concatenate([e.reshape(1, -1) for e in embedding_list], axis=0)
-        np.save(self.embedding_filepath, self.embedding_mat)
+    def prepare_columns(self):
+        """Compute token counts if needed, and cache the text and token count columns outside of pandas.
+
+        `texts` and `n_tokens` are what the retrieval hot paths read; call this again after modifying `df`.
+        """
+        assert self.embed_col in self.df.columns
+        if self.n_tokens_col not in self.df.columns:
+            self.compute_token_counts()
+        self.texts: list[str] = self.df[self.embed_col].tolist()
+        self.n_tokens: np.array = self.df[self.n_tokens_col].to_numpy()
+        self.generation += 1
+        # built from texts on first use; see get_lexical_index and get_nonstopword_token_arrays
+        self.lexical_index: lexical_index.Bm25Index | None = None
+        self.nonstopword_tokens: np.array | None = None
+        self.nonstopword_token_offsets: np.array | None = None
+        self._texts_fingerprint: bytes | None = None
+
+    def get_texts_fingerprint(self) -> bytes:
+        """Identifies the current texts, so files derived from them can be checked against `df` rather than the parquet file."""
+        if self._texts_fingerprint is None:
+            self._texts_fingerprint = lexical_index.get_texts_fingerprint(self.texts)
+        return self._texts_fingerprint
+
+    def is_df_saved(self) -> bool:
+        """True if the current texts are those in the parquet file, so files derived from them can be saved next to it."""
+        return self.saved_texts_fingerprint is not None and self.saved_texts_fingerprint == self.get_texts_fingerprint()
+
+    def create_embeddings(self, dtype: np.dtype = np.float64, max_in_flight: int = 1):
+        """Embed the texts in `embed_col` with `embedding_model` and save them to disk.
+
+        Each batch of embeddings is written into the `.npy` file as it arrives,
+        rather than being held in memory until every batch is done.
+
+        Args:
+            dtype (np.dtype, optional): On-disk dtype of the saved embeddings. Defaults to np.float64.
+            max_in_flight (int, optional): Maximum number of concurrent embedding requests. Defaults to 1.
+        """
+        # drop any mapping of the old file before it is overwritten
+        self._embedding_mat = None
+        embedding_mat = None
+        for inds, embeddings in embedding_utils.iterate_batch_embeddings(
+            self.texts,
+            self.n_tokens,
+            max_in_flight=max_in_flight,
+            embedding_model=self.embedding_model,
+        ):
+            if embedding_mat is None:
+                embedding_mat = np.lib.format.open_memmap(
+                    self.embedding_filepath,
+                    mode="w+",
+                    dtype=dtype,
+                    shape=(len(self.texts), len(embeddings[0])),
+                )
+            embedding_mat[inds] = np.stack(embeddings)
+        if embedding_mat is None:
+            np.save(self.embedding_filepath, np.empty((0, embedding_utils.EMBEDDING_DIM), dtype=dtype))
+        else:
+            embedding_mat.flush()
+            del embedding_mat
+        self.save_normalized_embeddings()
+        self.load_search_mat()
+        self.set_index(self.index, rebuild=True)
 
     def save_df(self):
         self.df.to_parquet(self.df_filepath)
+        self.saved_texts_fingerprint = self.get_texts_fingerprint()
+
+    def save_normalized_embeddings(self):
+        """Save the float32 search matrix next to `embedding_filepath`, so later loads can skip normalization.
+
+        Rows are normalized from `embedding_mat` in chunks, so no full-size copy is held in memory.
+        The file is written under a temporary name and then renamed, so processes mapping the old file are unaffected.
+        """
+        embedding_mat = self.embedding_mat
+        tmp_filepath = self.normalized_embedding_filepath.with_suffix(".tmp")
+        if embedding_mat.shape[0] == 0:
+            with open(tmp_filepath, "wb") as outfile:
+                np.save(outfile, np.empty(embedding_mat.shape, dtype=np.float32))
+        else:
+            normalized_embedding_mat = np.lib.format.open_memmap(
+                tmp_filepath,
+                mode="w+",
+                dtype=np.float32,
+                shape=embedding_mat.shape,
+            )
+            for start in range(0, embedding_mat.shape[0], retrieval_index.ROW_CHUNK_SIZE):
+                end = start + retrieval_index.ROW_CHUNK_SIZE
+                normalized_embedding_mat[start:end] = normalize_embeddings(embedding_mat[start:end])
+            normalized_embedding_mat.flush()
+            del normalized_embedding_mat
+        tmp_filepath.replace(self.normalized_embedding_filepath)
 
     def load(self):
         if not self.df_filepath.exists():
             raise ValueError(f"Trying to load a dataframe from non-existent path: {self.df_filepath}")
         self.df = pd.read_parquet(self.df_filepath)
-        self.embedding_mat = np.load(self.embedding_filepath)
+        self.prepare_columns()
+        self.saved_texts_fingerprint = self.get_texts_fingerprint()
+        self.load_embeddings()
+
+    def load_embeddings(self):
+        self._embedding_mat = None
+        self.load_search_mat()
+        self.set_index(self.index)
+
+    def load_search_mat(self):
+        """Set `normalized_embedding_mat` from the saved search matrix, if current, and by normalizing otherwise.
+
+        If memory-mapping (see `get_search_mmap_mode`), a missing or stale search matrix is saved first
+        so that it can be mapped, unless `embedding_dir` isn't writable.
+        """
+        mmap_mode = self.get_search_mmap_mode()
+        if mmap_mode is not None and not self.is_current(self.normalized_embedding_filepath):
+            try:
+                self.save_normalized_embeddings()
+            except OSError as ex:
+                logging.warning(f"Failed to save the search matrix for {self.db_name}, so it won't be mapped: {ex}")
+        if self.is_current(self.normalized_embedding_filepath):
+            self.normalized_embedding_mat = np.load(self.normalized_embedding_filepath, mmap_mode=mmap_mode)
+            self.generation += 1
+        else:
+            self.prepare_search_mat()
+
+    def get_search_mmap_mode(self) -> str | None:
+        """mmap_mode for the search matrix: `mmap_mode` if set, and read-only if the index doesn't need it resident."""
+        if self.mmap_mode is None and not self.index.needs_resident_embeddings():
+            return "r"
+        return self.mmap_mode
+
+    @property
+    def embedding_mat(self) -> np.array:
+        """The saved embeddings, memory-mapped on first access rather than kept in memory alongside the search matrix."""
+        if self._embedding_mat is None:
+            if not self.embedding_filepath.exists():
+                raise AttributeError(
+                    f"No embeddings saved at {self.embedding_filepath}; call create_embeddings() first."
+                )
+            self._embedding_mat = np.load(self.embedding_filepath, mmap_mode=self.mmap_mode or "r")
+        return self._embedding_mat
+
+    def is_current(self, derived_filepath: Path) -> bool:
+        """True if a file derived from the embeddings exists and is at least as new as the embedding file."""
+        if not derived_filepath.exists():
+            return False
+        return derived_filepath.stat().st_mtime >= self.embedding_filepath.stat().st_mtime
+
+    def get_index_filepath(self, index: retrieval_index.RetrievalIndex) -> Path:
+        """Where the index is saved; indexes built with different settings are saved separately."""
+        return self.embedding_dir / f"{self.db_name}_{index.get_build_key()}_index.npz"
+
+    def set_index(self, index: retrieval_index.RetrievalIndex, rebuild: bool = False):
+        """Use the given index for search, loading it from disk if previously built or building and saving it otherwise.
+
+        Args:
+            index (retrieval_index.RetrievalIndex): The index.
+            rebuild (bool, optional): If True, rebuild even if a saved index exists. Defaults to False.
+        """
+        if index.is_persistent():
+            index_filepath = self.get_index_filepath(index)
+            if not rebuild and self.is_current(index_filepath):
+                index.load(index_filepath)
+            else:
+                index.build(self.normalized_embedding_mat)
+                index.save(index_filepath)
+        else:
+            index.build(self.normalized_embedding_mat)
+        self.index = index
+        self.generation += 1
+        if isinstance(self.normalized_embedding_mat, np.memmap) != (self.get_search_mmap_mode() is not None):
+            # e.g. switching to an index that doesn't need the search matrix resident
+            self.load_search_mat()
+
+    def get_lexical_index(self, save: bool = True) -> lexical_index.Bm25Index:
+        """The BM25 index over the texts, loaded from next to the parquet file if built from the same texts, and built otherwise.
+
+        Args:
+            save (bool, optional): If True, save a newly built index next to the parquet file,
+                if the texts match it (see `is_df_saved`). Defaults to True.
+        """
+        if self.lexical_index is None:
+            index = lexical_index.Bm25Index()
+            if self.lexical_index_filepath.exists():
+                index.load(self.lexical_index_filepath)
+            # e.g. df was modified after loading, or differs from the saved parquet file
+            if index.texts_fingerprint != self.get_texts_fingerprint():
+                index.build(self.texts)
+                if save and self.is_df_saved():
+                    index.save(self.lexical_index_filepath)
+            self.lexical_index = index
+        return self.lexical_index
+
+    def get_nonstopword_token_arrays(self, save: bool = True) -> tuple[np.array, np.array]:
+        """Non-stopword tokens of every text, as a flat int32 buffer and row offsets into it.
+
+        Row i's tokens are `tokens[offsets[i] : offsets[i + 1]]`.
+        Loaded from next to the parquet file if built from the same texts, and built otherwise;
+        see `logit_bias.get_ragged_nonstopword_tokens`.
+
+        Args:
+            save (bool, optional): If True, save newly built arrays next to the parquet file,
+                if the texts match it (see `is_df_saved`). Defaults to True.
+
+        Returns:
+            tuple[np.array, np.array]: The tokens, and offsets of shape (len(texts) + 1,).
+        """
+        if self.nonstopword_tokens is None:
+            tokens, offsets = None, None
+            texts_fingerprint = self.get_texts_fingerprint()
+            if self.token_array_filepath.exists():
+                with np.load(self.token_array_filepath) as state:
+                    if "texts_fingerprint" in state and state["texts_fingerprint"].tobytes() == texts_fingerprint:
+                        tokens, offsets = state["tokens"], state["offsets"]
+            if offsets is None:
+                tokens, offsets = logit_bias.get_ragged_nonstopword_tokens(self.texts)
+                if save and self.is_df_saved():
+                    with open(self.token_array_filepath, "wb") as outfile:
+                        np.savez(
+                            outfile,
+                            tokens=tokens,
+                            offsets=offsets,
+                            texts_fingerprint=np.frombuffer(texts_fingerprint, dtype=np.uint8),
+                        )
+            self.nonstopword_tokens, self.nonstopword_token_offsets = tokens, offsets
+        return self.nonstopword_tokens, self.nonstopword_token_offsets
+
+    def get_rows_nonstopword_tokens(self, inds: np.array) -> np.array:
+        """The stored non-stopword tokens of the given rows, concatenated in order. No tokenizer call.
+
+        Args:
+            inds (np.array): Row positions in `df`.
+
+        Returns:
+            np.array: int32 tokens.
+        """
+        tokens, offsets = self.get_nonstopword_token_arrays()
+        inds = np.asarray(inds, dtype=np.intp)
+        starts = offsets[inds]
+        lengths = offsets[inds + 1] - starts
+        # the position of each output token within its row, shifted to that row's start in the buffer
+        row_output_starts = np.cumsum(lengths) - lengths
+        positions = np.arange(lengths.sum()) + np.repeat(starts - row_output_starts, lengths)
+        return tokens[positions]
+
+    def compute_lexical_scores(self, query_str: str) -> np.array:
+        """BM25 scores (larger is more relevant) between the query and every text in the db. No embedding needed."""
+        return self.get_lexical_index().compute_scores(normalize_text(query_str))
+
+    def prepare_search_mat(self):
+        """Store a unit-normalized, contiguous float32 copy of `embedding_mat`.
+
+        Row norms are computed once here rather than on every query,
+        so cosine distance becomes a single matrix-vector product.
+        """
+        self.normalized_embedding_mat = normalize_embeddings(self.embedding_mat)
+        self.generation += 1
+
+    def __getstate__(self) -> dict:
+        # when memory-mapped, pickle only the filepaths (e.g. for `st.cache_data`) rather than copies of the matrices
+        state = self.__dict__.copy()
+        state["_embedding_mat"] = None
+        if isinstance(state.get("normalized_embedding_mat"), np.memmap):
+            state.pop("normalized_embedding_mat")
+        return state
+
+    def __setstate__(self, state: dict):
+        self.__dict__.update(state)
+        self._embedding_mat = None
+        if "normalized_embedding_mat" not in state and self.embedding_filepath.exists():
+            self.load_search_mat()
 
     def compute_embedding_distances(self, query_embedding: np.array) -> np.array:
-        if query_embedding.shape[0] != 1:
-            query_embedding = query_embedding.reshape(1, -1)
-        distances = scipy.spatial.distance.cdist(query_embedding, self.embedding_mat, metric="cosine")[0]
+        """Cosine distances between the query and every text in the db.
+
+        Args:
+            query_embedding (np.array): Embedding of shape (d,) or (1, d).
+
+        Returns:
+            np.array: Cosine distances (in [0, 2], smaller is closer), one per row of `df`.
+                Rows not scored by an approximate index have distance np.inf.
+        """
+        return self.compute_embedding_distances_batch(query_embedding.reshape(1, -1))[0]
+
+    def compute_embedding_distances_batch(self, query_embeddings: np.array) -> np.array:
+        """Cosine distances for a batch of queries, as a single matrix-matrix product.
+
+        Args:
+            query_embeddings (np.array): Embeddings of shape (n_queries, d).
+
+        Returns:
+            np.array: Distances of shape (n_queries, len(df)).
+        """
+        query_embeddings = normalize_embeddings(query_embeddings)
+        distances = self.index.compute_distances(query_embeddings, self.normalized_embedding_mat)
         return distances
 
     def compute_string_distances(self, query_str: str) -> np.array:
-        embedding_list = embedding_utils.get_openai_embeddings([normalize_text(query_str)])
-        query_embedding = embedding_list[0]
+        query_embedding = self.compute_query_embedding(query_str)
         return self.compute_embedding_distances(query_embedding)
 
+    def compute_query_embedding(self, query_str: str) -> np.array:
+        """Embed the query with this db's embedding_model. The result can be shared by dbs with the same model."""
+        embedding_list = embedding_utils.get_openai_embeddings(
+            [normalize_text(query_str)],
+            embedding_model=self.embedding_model,
+        )
+        return embedding_list[0]
+
+    async def acompute_query_embedding(self, query_str: str) -> np.array:
+        """Async variant of `compute_query_embedding`."""
+        embedding_list = await embedding_utils.aget_openai_embeddings(
+            [normalize_text(query_str)],
+            embedding_model=self.embedding_model,
+        )
+        return embedding_list[0]
+
     def iterate_query_embeddings(
         self,
         query_embedding_list: collections.abc.Iterable[np.array],
@@ -94,16 +428,217 @@ class RetrievalDb:
         for query_embedding in query_embedding_list:
             yield self.compute_embedding_distances(query_embedding)
 
+    def embed_strings(self, query_str_list: list[str]) -> np.array:
+        """Embed many query strings, batching the API calls under `embedding_utils.MAX_TOKENS_PER_REQUEST`.
+
+        Args:
+            query_str_list (list[str]): Query strings.
+
+        Returns:
+            np.array: Embeddings of shape (len(query_str_list), d).
+        """
+        query_str_list = [normalize_text(query_str) for query_str in query_str_list]
+        n_tokens_list = embedding_utils.get_token_counts(query_str_list)
+        embedding_list = embedding_utils.batch_embed_texts(
+            query_str_list,
+            n_tokens_list,
+            embedding_model=self.embedding_model,
+        )
+        return np.stack(embedding_list)
+
+    def batch_search(
+        self,
+        queries: list[str] | np.array,
+        k: int = 5,
+        query_chunk_size: int | None = None,
+    ) -> tuple[np.array, np.array]:
+        """Find the top k texts for each of many queries.
+
+        Distances are computed chunk by chunk, so at most query_chunk_size queries' distances are in memory at once.
+
+        Args:
+            queries (list[str] | np.array): Query strings, or query embeddings of shape (n_queries, d).
+            k (int, optional): Number of texts to retrieve per query. Defaults to 5.
+            query_chunk_size (int | None, optional): Queries per chunk.
+                Defaults to None, meaning as many as fit in MAX_DISTANCE_MATRIX_SIZE.
+
+        Returns:
+            tuple[np.array, np.array]: Indices into `df` and corresponding distances, both of shape (n_queries, k).
+        """
+        if isinstance(queries, np.ndarray):
+            query_embeddings = queries.reshape(-1, queries.shape[-1])
+        else:
+            query_embeddings = self.embed_strings(queries)
+        if query_chunk_size is None:
+            query_chunk_size = max(1, MAX_DISTANCE_MATRIX_SIZE // max(len(self.df), 1))
+        k = min(k, len(self.df))
+        n_queries = query_embeddings.shape[0]
+        top_k_indices = np.empty((n_queries, k), dtype=np.intp)
+        top_k_distances = np.empty((n_queries, k), dtype=np.float32)
+        for start in range(0, n_queries, query_chunk_size):
+            end = start + query_chunk_size
+            distances = self.compute_embedding_distances_batch(query_embeddings[start:end])
+            chunk_indices = get_top_k_indices(distances, k)
+            top_k_indices[start:end] = chunk_indices
+            top_k_distances[start:end] = np.take_along_axis(distances, chunk_indices, axis=1)
+        return top_k_indices, top_k_distances
+
+    def get_top_k_indices(self, distances: np.array, k: int = 5) -> np.array:
+        """Indices of the k closest texts, sorted by distance.
+
+        Only the k candidates are sorted, so this is cheaper than a full argsort for k << len(distances).
+
+        Args:
+            distances (np.array): Distances, as returned by `compute_embedding_distances`.
+            k (int, optional): Number of indices to return. Defaults to 5.
+
+        Returns:
+            np.array: Up to k indices into `df`.
+        """
+        return get_top_k_indices(distances, k)
+
+    def get_top_indices_within_budget(
+        self,
+        distances: np.array,
+        max_tokens: int,
+        max_texts: int | None = None,
+    ) -> np.array:
+        """The closest texts that fit in the token budget, stopping at the first text that doesn't fit.
+
+        Token counts of the top k candidates are summed with a single cumsum; k doubles only if the budget isn't used up.
+
+        Args:
+            distances (np.array): 1D distances, as returned by `compute_embedding_distances`.
+            max_tokens (int): Token budget.
+            max_texts (int | None, optional): Maximum number of texts. Defaults to None, meaning no limit.
+
+        Returns:
+            np.array: Indices into `df`, in ascending order of distance.
+        """
+        return get_top_indices_within_budget(distances, self.n_tokens, max_tokens, max_texts)
+
     def get_top_df(self, distances: np.array, k: int = 5) -> pd.DataFrame:
-        sort_inds = np.argsort(distances)
-        top_k_indices = sort_inds[:k]
+        top_k_indices = self.get_top_k_indices(distances, k)
         top_k_scores = distances[top_k_indices]
         assert top_k_indices.shape == top_k_scores.shape
         return self.df.iloc[top_k_indices]
 
 
-def get_distance_sort_indices(distances: np.array) -> np.array:
-    return np.argsort(distances)
+def get_top_k_indices(distances: np.array, k: int) -> np.array:
+    """Partial sort: argpartition to find the k smallest distances, then sort only those k.
+
+    Works along the last axis, so a 2D array of distances produces a row of indices per query.
+
+    Args:
+        distances (np.array): Distances, where smaller is more relevant.
+        k (int): Number of indices to return.
+
+    Returns:
+        np.array: Indices of the (up to) k smallest distances, in ascending order of distance.
+    """
+    n = distances.shape[-1]
+    if k >= n:
+        return np.argsort(distances, axis=-1)
+    if k <= 0:
+        return np.empty(distances.shape[:-1] + (0,), dtype=np.intp)
+    candidate_inds = np.argpartition(distances, k - 1, axis=-1)[..., :k]
+    candidate_distances = np.take_along_axis(distances, candidate_inds, axis=-1)
+    order = np.argsort(candidate_distances, axis=-1)
+    return np.take_along_axis(candidate_inds, order, axis=-1)
+
+
+def get_top_indices_within_budget(
+    distances: np.array,
+    n_tokens: np.array,
+    max_tokens: int,
+    max_texts: int | None = None,
+) -> np.array:
+    """The closest texts that fit in the token budget. See `RetrievalDb.get_top_indices_within_budget`.
+
+    Args:
+        distances (np.array): 1D distances.
+        n_tokens (np.array): Token counts, of the same shape as distances.
+        max_tokens (int): Token budget.
+        max_texts (int | None, optional): Maximum number of texts. Defaults to None, meaning no limit.
+
+    Returns:
+        np.array: Indices into distances, in ascending order of distance.
+    """
+    n = len(distances)
+    if max_texts is None:
+        max_texts = n
+    k = min(max_texts, DEFAULT_TOP_K)
+    while True:
+        top_k_indices = get_top_k_indices(distances, k)
+        top_k_indices = top_k_indices[np.isfinite(distances[top_k_indices])]
+        cumulative_token_counts = np.cumsum(n_tokens[top_k_indices])
+        n_fit = min(np.searchsorted(cumulative_token_counts, max_tokens, side="right"), max_texts)
+        if n_fit < len(top_k_indices) or n_fit == max_texts or len(top_k_indices) < k or k >= n:
+            return top_k_indices[:n_fit]
+        k *= 2
+
+
+def get_distance_sort_indices(distances: np.array, k: int | None = None) -> np.array:
+    if k is None:
+        return np.argsort(distances)
+    return get_top_k_indices(distances, k)
+
+
+def iterate_distance_sort_indices(
+    distances: np.array,
+    initial_k: int = DEFAULT_TOP_K,
+) -> collections.abc.Generator[int]:
+    """Yield indices in ascending order of distance, sorting only as many candidates as are consumed.
+
+    Starts with the top initial_k and doubles k whenever the caller needs more,
+    so a token-budget loop that stops early never pays for a full sort.
+
+    Args:
+        distances (np.array): 1D distances, where smaller is more relevant.
+        initial_k (int, optional): Size of the first candidate set. Defaults to DEFAULT_TOP_K.
+
+    Yields:
+        int: Indices into distances, excluding any with non-finite distance.
+    """
+    n = len(distances)
+    is_yielded = np.zeros(n, dtype=bool)
+    k = max(initial_k, 1)
+    while True:
+        top_k_indices = get_top_k_indices(distances, k)
+        # ties at the partition boundary can reorder across rounds, so skip anything already yielded
+        new_indices = top_k_indices[~is_yielded[top_k_indices]]
+        is_yielded[new_indices] = True
+        # non-finite distances (e.g. rows an approximate index didn't score) sort last and are never yielded
+        is_finite = np.isfinite(distances[new_indices])
+        yield from new_indices[is_finite]
+        if k >= n or not is_finite.all():
+            break
+        k *= 2
+
+
+def normalize_embeddings(embedding_mat: np.array) -> np.array:
+    """L2-normalize each row, returning a C-contiguous float32 matrix.
+
+    Zero rows are left as zeros (cosine distance 1 to everything).
+
+    Args:
+        embedding_mat (np.array): Matrix of shape (n, d).
+
+    Returns:
+        np.array: Matrix of shape (n, d) with unit-length rows.
+    """
+    embedding_mat = np.asarray(embedding_mat, dtype=np.float32)
+    norms = np.linalg.norm(embedding_mat, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return np.ascontiguousarray(embedding_mat / norms)
+
+
+def get_embedding_fingerprint(embedding: np.array) -> bytes:
+    """A short digest identifying the embedding's values."""
+    embedding = np.ascontiguousarray(embedding)
+    digest = hashlib.blake2b(embedding.tobytes(), digest_size=16)
+    digest.update(str(embedding.dtype).encode())
+    return digest.digest()
 
 
 def normalize_text(text: str) -> str:
@@ -127,6 +662,7 @@ class DbInfo:
         use_parent_text: bool = False,
         parent_group_cols: list[str] = [],
         parent_sort_cols: list[str] = [],
+        fill_memo_size: int = DEFAULT_FILL_MEMO_SIZE,
     ):
         self.db = db
         self.max_tokens = max_tokens
@@ -140,6 +676,120 @@ class DbInfo:
         self.parent_join_string = "\n"
         self.parent_group_cols = parent_group_cols
         self.parent_sort_cols = parent_sort_cols
+        self.parent_group_index = None
+        self.parent_group_index_generation = None
+        if self.use_parent_text:
+            self.build_parent_group_index()
+
+        # memoized fill strings, in least- to most-recently used order
+        self.fill_memo_size = fill_memo_size
+        self.fill_memo: collections.OrderedDict[tuple, str] = collections.OrderedDict()
+        # db rows used by recent fill strings; see get_fill_nonstopword_tokens
+        self.fill_rows_memo: collections.OrderedDict[str, np.array] = collections.OrderedDict()
+        self.fill_memo_lock = threading.Lock()
+
+    def build_parent_group_index(self):
+        self.parent_group_index = ParentGroupIndex(self.db, self.parent_group_cols, self.parent_sort_cols)
+        self.parent_group_index_generation = self.db.generation
+
+    def get_config(self) -> tuple:
+        """The settings that determine the fill string for a given query."""
+        return (
+            self.max_tokens,
+            self.max_texts,
+            self.prefix,
+            self.suffix,
+            self.join_string,
+            self.use_parent_text,
+            self.parent_join_string,
+            tuple(self.parent_group_cols),
+            tuple(self.parent_sort_cols),
+        )
+
+    def get_fill_string_from_query_embedding(self, query_embedding: np.array) -> str:
+        """Create the fill string for the query, memoizing the result.
+
+        The memo is keyed on a fingerprint of the query embedding, this DbInfo's configuration, and the db's generation,
+        so repeated queries skip the search, sort, and string assembly, while modified settings or a reloaded db are recomputed.
+
+        Args:
+            query_embedding (np.array): Query embedding, as used by `RetrievalDb.compute_embedding_distances`.
+
+        Returns:
+            str: The string to include in the prompt.
+        """
+        key = (
+            get_embedding_fingerprint(query_embedding),
+            self.get_config(),
+            id(self.db),
+            self.db.generation,
+        )
+        with self.fill_memo_lock:
+            fill_string = self.fill_memo.get(key)
+            if fill_string is not None:
+                self.fill_memo.move_to_end(key)
+                if fill_string in self.fill_rows_memo:
+                    self.fill_rows_memo.move_to_end(fill_string)
+                return fill_string
+        distances = self.db.compute_embedding_distances(query_embedding)
+        fill_string = self.get_fill_string_from_distances(distances)
+        if self.fill_memo_size > 0:
+            with self.fill_memo_lock:
+                self.fill_memo[key] = fill_string
+                while len(self.fill_memo) > self.fill_memo_size:
+                    self.fill_memo.popitem(last=False)
+        return fill_string
+
+    def clear_fill_memo(self):
+        with self.fill_memo_lock:
+            self.fill_memo.clear()
+            self.fill_rows_memo.clear()
+
+    def record_fill_rows(self, fill_string: str, rows: np.array):
+        if self.fill_memo_size > 0:
+            with self.fill_memo_lock:
+                self.fill_rows_memo[fill_string] = rows
+                self.fill_rows_memo.move_to_end(fill_string)
+                while len(self.fill_rows_memo) > self.fill_memo_size:
+                    self.fill_rows_memo.popitem(last=False)
+
+    def get_fill_nonstopword_tokens(self, fill_string: str) -> np.array | None:
+        """Non-stopword tokens of a fill string recently created by this DbInfo, from the db's stored per-row tokens.
+
+        Only the prefix and suffix go through the (cached) tokenizer; see `RetrievalDb.get_nonstopword_token_arrays`.
+        Rows are tokenized separately, so tokens spanning the join between texts can differ from tokenizing the fill string.
+
+        Args:
+            fill_string (str): A fill string, e.g. from `get_fill_string_from_query_embedding`.
+
+        Returns:
+            np.array | None: int32 tokens, or None if the rows behind the fill string aren't known (e.g. evicted).
+        """
+        with self.fill_memo_lock:
+            rows = self.fill_rows_memo.get(fill_string)
+        if rows is None:
+            return None
+        return np.concatenate(
+            [
+                logit_bias.get_text_nonstopword_tokens(self.prefix),
+                self.db.get_rows_nonstopword_tokens(rows),
+                logit_bias.get_text_nonstopword_tokens(self.suffix),
+            ]
+        )
+
+    def __getstate__(self) -> dict:
+        # e.g. for `st.cache_data`; the memos are not pickled
+        state = self.__dict__.copy()
+        state.pop("fill_memo", None)
+        state.pop("fill_rows_memo", None)
+        state.pop("fill_memo_lock", None)
+        return state
+
+    def __setstate__(self, state: dict):
+        self.__dict__.update(state)
+        self.fill_memo = collections.OrderedDict()
+        self.fill_rows_memo = collections.OrderedDict()
+        self.fill_memo_lock = threading.Lock()
 
     def copy(self, **kwargs) -> DbInfo:
         """Create a copy of this DbInfo, overriding the keyword args with new values if provided.
@@ -161,28 +811,56 @@ class DbInfo:
         Returns:
             str: The string to include in the prompt.
         """
-        sort_inds = get_distance_sort_indices(distances)
+        if not self.use_parent_text:
+            inds = self.db.get_top_indices_within_budget(distances, self.max_tokens, self.max_texts)
+            return self.get_fill_string_from_indices(inds)
+        parent_rows_list = self.get_parent_rows_from_distances(distances)
+        texts = [self.parent_join_string.join(self.db.texts[row] for row in rows) for rows in parent_rows_list]
+        fill_string = self.prefix + self.join_string.join(texts) + self.suffix
+        rows = np.concatenate(parent_rows_list) if len(parent_rows_list) > 0 else np.empty(0, dtype=np.intp)
+        self.record_fill_rows(fill_string, rows)
+        return fill_string
+
+    def get_fill_string_from_indices(self, inds: np.array) -> str:
+        """The fill string for the given texts, recording the rows used (see `get_fill_nonstopword_tokens`).
+
+        Args:
+            inds (np.array): Row positions in the db's df, in fill order.
+
+        Returns:
+            str: The string to include in the prompt.
+        """
+        texts = [self.db.texts[ind] for ind in inds]
+        fill_string = self.prefix + self.join_string.join(texts) + self.suffix
+        self.record_fill_rows(fill_string, np.asarray(inds, dtype=np.intp))
+        return fill_string
+
+    def get_parent_texts_from_distances(self, distances: np.array) -> list[str]:
+        return [
+            self.parent_join_string.join(self.db.texts[row] for row in rows)
+            for rows in self.get_parent_rows_from_distances(distances)
+        ]
+
+    def get_parent_rows_from_distances(self, distances: np.array) -> list[np.array]:
+        """Rows of each parent to include, in order of relevance; see `get_parent_rows`."""
+        sort_inds = iterate_distance_sort_indices(distances, initial_k=min(self.max_texts, DEFAULT_TOP_K))
         used_inds = set()
-        texts = []
+        parent_rows_list = []
         total_tokens = 0
         for ind in sort_inds:
             if ind in used_inds:
                 continue
-            if self.use_parent_text:
-                token_budget = self.max_tokens - total_tokens
-                text, n_tokens, new_used_inds = self.get_parent_text(ind, token_budget)
-                used_inds.update(new_used_inds)
-            else:
-                text, n_tokens = self.get_single_text(ind)
-                used_inds.add(ind)
-            if total_tokens + n_tokens > self.max_tokens:
+            token_budget = self.max_tokens - total_tokens
+            parent_rows = self.get_parent_rows(ind, token_budget)
+            if parent_rows is None:
                 break
+            rows, n_tokens = parent_rows
+            used_inds.update(rows.tolist())
             total_tokens += n_tokens
-            texts.append(text)
-            if len(texts) >= self.max_texts:
+            parent_rows_list.append(rows)
+            if len(parent_rows_list) >= self.max_texts:
                 break
-        fill_string = self.prefix + self.join_string.join(texts) + self.suffix
-        return fill_string
+        return parent_rows_list
 
     def get_single_text(self, ind: int):
         """Given a index, return the text and corresponding number of tokens from the RetrievalDb.
@@ -190,9 +868,8 @@ class DbInfo:
         Args:
             ind (int): _description_
         """
-        row = self.db.df.iloc[ind]
-        text = row[self.db.embed_col]
-        n_tokens = row[self.db.n_tokens_col]
+        text = self.db.texts[ind]
+        n_tokens = self.db.n_tokens[ind]
         return text, n_tokens
 
     def get_parent_text(self, ind: int, token_budget: int):
@@ -205,38 +882,74 @@ class DbInfo:
         Args:
             ind (int): Most semantically relevant index to retrieve parents of.
         """
-        df = self.db.df
-        row = df.iloc[ind]
-        and_cond = np.ones(len(df), dtype=bool)
-        for col in self.parent_group_cols:
-            cond = df[col] == row[col]
-            and_cond = np.logical_and(and_cond, cond)
-        parent = df[and_cond]
-        if self.parent_sort_cols is not None and len(self.parent_sort_cols) > 1:
-            parent = parent.sort_values(by=self.parent_sort_cols)
-        # include a variable amount of context based on the given token_budget
-        # preference ranking implemented here:
-        #  - all docs
-        #  - up to token_budget docs from target_ind - 0
-        total_tokens = parent[self.db.n_tokens_col].sum()
-        if row[self.db.n_tokens_col] > token_budget:
+        parent_rows = self.get_parent_rows(ind, token_budget)
+        if parent_rows is None:
             # simple case: NOTHING will fit in the token budget!
             return None
-        elif total_tokens <= token_budget:
-            # simple case: if all tokens in budget, no extra work
-            rows = parent
-        else:
-            target_ind_val = df.index[ind]
-            before = parent.loc[:target_ind_val]
-            # see: https://stackoverflow.com/a/37872823
-            cumulative_token_counts = before.loc[::-1, self.db.n_tokens_col].cumsum()[::-1]
-            rows = before[cumulative_token_counts <= token_budget]
-        assert len(rows) >= 1
-        new_used_inds = {df.index.get_loc(new_ind) for new_ind in rows.index}
+        rows, n_tokens = parent_rows
+        new_used_inds = set(rows.tolist())
         assert ind in new_used_inds
-        texts = rows[self.db.embed_col]
-        n_tokens_rows = rows[self.db.n_tokens_col]
-        text = self.parent_join_string.join(texts)
+        text = self.parent_join_string.join(self.db.texts[row] for row in rows)
         # note this will underestimate the true number of tokens, due to whatever parent_join_string is
-        n_tokens = n_tokens_rows.sum()
         return text, n_tokens, new_used_inds
+
+    def get_parent_rows(self, ind: int, token_budget: int) -> tuple[np.array, int] | None:
+        """Rows of the parent of the given row that fit in the token budget; see `ParentGroupIndex.get_parent_rows`."""
+        if self.parent_group_index is None or self.parent_group_index_generation != self.db.generation:
+            self.build_parent_group_index()
+        # include a variable amount of context based on the given token_budget
+        # preference ranking implemented here:
+        #  - all docs
+        #  - up to token_budget docs from target_ind - 0
+        return self.parent_group_index.get_parent_rows(ind, token_budget)
+
+
+class ParentGroupIndex:
+    """Precomputed "parent document" groups for a RetrievalDb, used by `DbInfo.get_parent_text`.
+
+    Rows are ordered by group and then (if more than one sort column is given) by parent_sort_cols,
+    with prefix sums of the token counts in that order,
+    so finding a row's parent is a lookup rather than a filter over the whole dataframe.
+    """
+
+    def __init__(self, db: RetrievalDb, parent_group_cols: list[str], parent_sort_cols: list[str] | None):
+        df = db.df
+        n_rows = len(df)
+        if len(parent_group_cols) > 0:
+            group_ids = df.groupby(parent_group_cols, sort=False, dropna=False).ngroup().to_numpy()
+        else:
+            group_ids = np.zeros(n_rows, dtype=np.intp)
+        if parent_sort_cols is not None and len(parent_sort_cols) > 1:
+            sort_df = pd.DataFrame({f"sort{i}": df[col].to_numpy() for i, col in enumerate(parent_sort_cols)})
+            sort_df.insert(0, "group", group_ids)
+            self.order = sort_df.sort_values(by=list(sort_df.columns), kind="stable").index.to_numpy()
+        else:
+            self.order = np.argsort(group_ids, kind="stable")
+        self.group_ids = group_ids
+        self.group_starts = np.searchsorted(group_ids[self.order], np.arange(group_ids.max(initial=-1) + 2))
+        self.positions = np.empty(n_rows, dtype=np.intp)
+        self.positions[self.order] = np.arange(n_rows)
+        self.n_tokens = db.n_tokens
+        self.token_prefix_sums = np.concatenate([[0], np.cumsum(self.n_tokens[self.order])])
+
+    def get_parent_rows(self, ind: int, token_budget: int) -> tuple[np.array, int] | None:
+        """Rows of the parent of the given row that fit in the token budget.
+
+        Args:
+            ind (int): Row position in the db's df.
+            token_budget (int): Maximum number of tokens.
+
+        Returns:
+            tuple[np.array, int] | None: Row positions in parent order and their total tokens,
+                or None if not even the given row fits.
+                The whole parent is returned if it fits; otherwise, the longest run of rows ending at ind.
+        """
+        if self.n_tokens[ind] > token_budget:
+            return None
+        group_id = self.group_ids[ind]
+        start, end = self.group_starts[group_id], self.group_starts[group_id + 1]
+        prefix_sums = self.token_prefix_sums
+        if prefix_sums[end] - prefix_sums[start] > token_budget:
+            end = self.positions[ind] + 1
+            start += np.searchsorted(prefix_sums[start:end], prefix_sums[end] - token_budget, side="left")
+        return self.order[start:end], prefix_sums[end] - prefix_sums[start]
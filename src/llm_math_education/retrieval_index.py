@@ -0,0 +1,384 @@
+# Nearest-neighbour indexes used by `retrieval.RetrievalDb` to compute query distances.
+# Indexes operate on the db's unit-normalized float32 embedding matrix (`RetrievalDb.normalized_embedding_mat`).
+# Approximate indexes only score a subset of the rows; rows that weren't scored get a distance of np.inf.
+from __future__ import annotations
+
+from pathlib import Path
+
+import numpy as np
+import scipy.sparse
+
+# rows per chunk when scanning or assigning rows, to bound temporary memory use
+ROW_CHUNK_SIZE = 4096
+
+
+class RetrievalIndex:
+    """General nearest-neighbour index interface."""
+
+    name: str = "index"
+
+    def build(self, normalized_embedding_mat: np.array):
+        raise ValueError("Not implemented.")
+
+    def compute_distances(self, query_embeddings: np.array, normalized_embedding_mat: np.array) -> np.array:
+        """Cosine distances between each query and the rows of normalized_embedding_mat.
+
+        Args:
+            query_embeddings (np.array): Unit-normalized queries of shape (n_queries, d).
+            normalized_embedding_mat (np.array): Unit-normalized embeddings of shape (n, d).
+
+        Returns:
+            np.array: Distances of shape (n_queries, n); np.inf for rows the index did not score.
+        """
+        raise ValueError("Not implemented.")
+
+    def save(self, filepath: Path):
+        raise ValueError("Not implemented.")
+
+    def load(self, filepath: Path):
+        raise ValueError("Not implemented.")
+
+    def is_persistent(self) -> bool:
+        """Whether this index has any state worth saving to disk."""
+        return True
+
+    def needs_resident_embeddings(self) -> bool:
+        """Whether queries read enough of normalized_embedding_mat that it should be held in memory.
+
+        If not, `retrieval.RetrievalDb` memory-maps it, so only the index's own state is resident.
+        """
+        return True
+
+    def get_build_key(self) -> str:
+        """Identifies the settings that determine the built state; see `retrieval.RetrievalDb.get_index_filepath`.
+
+        Query-time settings (e.g. n_probe) are excluded, so they can change without a rebuild.
+        """
+        return self.name
+
+
+class BruteForceIndex(RetrievalIndex):
+    """Exact search: scores every row with a single matrix product."""
+
+    name = "brute_force"
+
+    def build(self, normalized_embedding_mat: np.array):
+        pass
+
+    def compute_distances(self, query_embeddings: np.array, normalized_embedding_mat: np.array) -> np.array:
+        return 1 - query_embeddings @ normalized_embedding_mat.T
+
+    def is_persistent(self) -> bool:
+        return False
+
+
+class IvfIndex(RetrievalIndex):
+    """Inverted file index: rows are clustered with (spherical) k-means,
+    and only the rows in the n_probe clusters nearest to a query are scored.
+
+    Increase n_probe for higher recall at the cost of latency; n_probe == n_lists is exact search.
+    """
+
+    name = "ivf"
+
+    def __init__(self, n_lists: int | None = None, n_probe: int = 8, n_iter: int = 20, seed: int = 0):
+        """
+        Args:
+            n_lists (int | None, optional): Number of clusters, clamped to [1, n]. Defaults to None, meaning sqrt(n).
+            n_probe (int, optional): Number of clusters to scan per query, clamped to [1, n_lists]. Defaults to 8.
+            n_iter (int, optional): k-means iterations. Defaults to 20.
+            seed (int, optional): Random seed for k-means initialization. Defaults to 0.
+        """
+        self.n_lists = n_lists
+        self.n_probe = n_probe
+        self.n_iter = n_iter
+        self.seed = seed
+
+    def build(self, normalized_embedding_mat: np.array):
+        n_rows, dim = normalized_embedding_mat.shape
+        n_lists = self.n_lists if self.n_lists is not None else int(np.sqrt(n_rows))
+        n_lists = min(max(n_lists, 1), n_rows)
+        if n_rows == 0:
+            # nothing to cluster; every query gets no candidates
+            self.centroids = np.empty((0, dim), dtype=np.float32)
+            assignments = np.empty(0, dtype=np.intp)
+        else:
+            self.centroids = kmeans(normalized_embedding_mat, n_lists, self.n_iter, self.seed, spherical=True)
+            assignments = assign_to_centroids(normalized_embedding_mat, self.centroids, spherical=True)
+        self.list_indices = np.argsort(assignments, kind="stable")
+        self.list_offsets = np.searchsorted(assignments[self.list_indices], np.arange(len(self.centroids) + 1))
+        self.n_rows = n_rows
+
+    def get_build_key(self) -> str:
+        n_lists = self.n_lists if self.n_lists is not None else "auto"
+        return f"{self.name}_lists{n_lists}_iter{self.n_iter}_seed{self.seed}"
+
+    def get_candidate_indices(self, query_embedding: np.array) -> np.array:
+        """Row indices in the n_probe clusters closest to the query."""
+        if len(self.centroids) == 0:
+            return np.empty(0, dtype=np.intp)
+        n_probe = min(max(self.n_probe, 1), len(self.centroids))
+        centroid_similarities = self.centroids @ query_embedding
+        probe_lists = np.argpartition(-centroid_similarities, n_probe - 1)[:n_probe]
+        return np.concatenate(
+            [self.list_indices[self.list_offsets[i] : self.list_offsets[i + 1]] for i in probe_lists],
+        )
+
+    def score_candidates(
+        self,
+        query_embedding: np.array,
+        candidate_indices: np.array,
+        normalized_embedding_mat: np.array,
+    ) -> np.array:
+        return 1 - normalized_embedding_mat[candidate_indices] @ query_embedding
+
+    def compute_distances(self, query_embeddings: np.array, normalized_embedding_mat: np.array) -> np.array:
+        distances = np.full((query_embeddings.shape[0], self.n_rows), np.inf, dtype=np.float32)
+        for i, query_embedding in enumerate(query_embeddings):
+            candidate_indices = self.get_candidate_indices(query_embedding)
+            distances[i, candidate_indices] = self.score_candidates(
+                query_embedding,
+                candidate_indices,
+                normalized_embedding_mat,
+            )
+        return distances
+
+    def get_state(self) -> dict[str, np.array]:
+        return {
+            "centroids": self.centroids,
+            "list_indices": self.list_indices,
+            "list_offsets": self.list_offsets,
+            "n_rows": np.array(self.n_rows),
+        }
+
+    def set_state(self, state: dict[str, np.array]):
+        self.centroids = state["centroids"]
+        self.list_indices = state["list_indices"]
+        self.list_offsets = state["list_offsets"]
+        self.n_rows = int(state["n_rows"])
+
+    def save(self, filepath: Path):
+        with open(filepath, "wb") as outfile:
+            np.savez(outfile, **self.get_state())
+
+    def load(self, filepath: Path):
+        with np.load(filepath) as state:
+            self.set_state(dict(state))
+
+
+class IvfPqIndex(IvfIndex):
+    """IVF index that scores candidates with product-quantized codes instead of the full vectors.
+
+    Each row's residual from its cluster centroid is split into n_subvectors pieces,
+    and each piece is stored as the uint8 id of its nearest codeword.
+    Query scores are the centroid score plus a sum of lookups in a per-query (n_subvectors, n_codes) table of inner products.
+    """
+
+    name = "ivf_pq"
+
+    def __init__(self, n_subvectors: int = 16, n_codes: int = 256, **kwargs):
+        """
+        Args:
+            n_subvectors (int, optional): Number of subvectors; must divide the embedding dimension. Defaults to 16.
+            n_codes (int, optional): Codewords per subvector, at most 256. Defaults to 256.
+            kwargs: Passed to `IvfIndex`.
+        """
+        super().__init__(**kwargs)
+        if n_codes > 256:
+            raise ValueError("At most 256 codes are supported, as codes are stored as uint8.")
+        self.n_subvectors = n_subvectors
+        self.n_codes = n_codes
+
+    def build(self, normalized_embedding_mat: np.array):
+        super().build(normalized_embedding_mat)
+        n_rows, dim = normalized_embedding_mat.shape
+        if dim % self.n_subvectors != 0:
+            raise ValueError(f"Embedding dimension {dim} is not divisible by n_subvectors {self.n_subvectors}.")
+        self.assignments = np.empty(n_rows, dtype=np.int32)
+        for i in range(len(self.centroids)):
+            self.assignments[self.list_indices[self.list_offsets[i] : self.list_offsets[i + 1]]] = i
+        if n_rows == 0:
+            self.codebooks = np.empty((self.n_subvectors, 0, dim // self.n_subvectors), dtype=np.float32)
+            self.codes = np.empty((0, self.n_subvectors), dtype=np.uint8)
+            return
+        # quantize the residual from each row's centroid, which is much finer-grained than the row itself
+        residuals = np.asarray(normalized_embedding_mat, dtype=np.float32) - self.centroids[self.assignments]
+        residual_subvectors = residuals.reshape(n_rows, self.n_subvectors, -1)
+        n_codes = min(self.n_codes, n_rows)
+        self.codebooks = np.stack(
+            [kmeans(residual_subvectors[:, j], n_codes, self.n_iter, self.seed) for j in range(self.n_subvectors)],
+        )
+        self.codes = np.stack(
+            [assign_to_centroids(residual_subvectors[:, j], self.codebooks[j]) for j in range(self.n_subvectors)],
+            axis=1,
+        ).astype(np.uint8)
+
+    def get_build_key(self) -> str:
+        return f"{super().get_build_key()}_sub{self.n_subvectors}_codes{self.n_codes}"
+
+    def needs_resident_embeddings(self) -> bool:
+        # candidates are scored from the codes alone
+        return False
+
+    def score_candidates(
+        self,
+        query_embedding: np.array,
+        candidate_indices: np.array,
+        normalized_embedding_mat: np.array,
+    ) -> np.array:
+        # q.x == q.centroid + q.residual
+        centroid_similarities = self.centroids @ query_embedding
+        query_subvectors = query_embedding.reshape(self.n_subvectors, -1)
+        lookup_table = np.einsum("mkd,md->mk", self.codebooks, query_subvectors)
+        candidate_codes = self.codes[candidate_indices]
+        residual_similarities = lookup_table[np.arange(self.n_subvectors), candidate_codes].sum(axis=1)
+        similarities = centroid_similarities[self.assignments[candidate_indices]] + residual_similarities
+        return 1 - similarities
+
+    def get_state(self) -> dict[str, np.array]:
+        state = super().get_state()
+        state["assignments"] = self.assignments
+        state["codebooks"] = self.codebooks
+        state["codes"] = self.codes
+        return state
+
+    def set_state(self, state: dict[str, np.array]):
+        super().set_state(state)
+        self.assignments = state["assignments"]
+        self.codebooks = state["codebooks"]
+        self.codes = state["codes"]
+        self.n_subvectors = self.codebooks.shape[0]
+
+
+class QuantizedIndex(RetrievalIndex):
+    """Scans a float16 or int8 copy of the embeddings, then re-ranks the best candidates against the full-precision rows.
+
+    int8 rows are stored with a per-row scale (max absolute value / 127).
+    Only the n_rerank best candidates touch the full-precision matrix,
+    so `retrieval.RetrievalDb` memory-maps it and keeps only the quantized matrix resident:
+    4x smaller than float32 for int8 (2x for float16), 8x (4x) smaller than the float64 embeddings.
+    """
+
+    def __init__(self, dtype: str = "int8", n_rerank: int = 256):
+        """
+        Args:
+            dtype (str, optional): "int8" or "float16". Defaults to "int8".
+            n_rerank (int, optional): Candidates to re-rank exactly per query; other rows get distance np.inf. Defaults to 256.
+        """
+        if dtype not in ["int8", "float16"]:
+            raise ValueError(f"Unsupported quantization dtype {dtype}.")
+        self.dtype = dtype
+        self.n_rerank = n_rerank
+        self.name = f"quantized_{dtype}"
+
+    def build(self, normalized_embedding_mat: np.array):
+        self.quantized_mat, self.scales = quantize(normalized_embedding_mat, self.dtype)
+
+    def needs_resident_embeddings(self) -> bool:
+        return False
+
+    def compute_approximate_similarities(self, query_embeddings: np.array) -> np.array:
+        """Inner products against the quantized matrix, of shape (n_queries, n)."""
+        n_rows = self.quantized_mat.shape[0]
+        query_embeddings = np.asarray(query_embeddings, dtype=np.float32)
+        similarities = np.empty((query_embeddings.shape[0], n_rows), dtype=np.float32)
+        # upcast in chunks, so the scan never materializes a full-precision copy of the matrix
+        for start in range(0, n_rows, ROW_CHUNK_SIZE):
+            chunk = self.quantized_mat[start : start + ROW_CHUNK_SIZE].astype(np.float32)
+            similarities[:, start : start + ROW_CHUNK_SIZE] = query_embeddings @ chunk.T
+        if self.scales is not None:
+            similarities *= self.scales
+        return similarities
+
+    def compute_distances(self, query_embeddings: np.array, normalized_embedding_mat: np.array) -> np.array:
+        approximate_distances = 1 - self.compute_approximate_similarities(query_embeddings)
+        distances = np.full(approximate_distances.shape, np.inf, dtype=np.float32)
+        candidate_indices = get_smallest_indices(approximate_distances, self.n_rerank)
+        for i, query_embedding in enumerate(query_embeddings):
+            # sorting the candidates keeps reads from a memory-mapped matrix sequential
+            candidates = np.sort(candidate_indices[i])
+            distances[i, candidates] = 1 - normalized_embedding_mat[candidates] @ query_embedding
+        return distances
+
+    def save(self, filepath: Path):
+        state = {"quantized_mat": self.quantized_mat}
+        if self.scales is not None:
+            state["scales"] = self.scales
+        with open(filepath, "wb") as outfile:
+            np.savez(outfile, **state)
+
+    def load(self, filepath: Path):
+        with np.load(filepath) as state:
+            self.quantized_mat = state["quantized_mat"]
+            self.scales = state["scales"] if "scales" in state else None
+
+
+def quantize(mat: np.array, dtype: str) -> tuple[np.array, np.array | None]:
+    """Quantize a matrix to float16, or to int8 with per-row scales.
+
+    Args:
+        mat (np.array): Matrix of shape (n, d).
+        dtype (str): "int8" or "float16".
+
+    Returns:
+        tuple[np.array, np.array | None]: The quantized matrix, and the float32 row scales (None for float16).
+            Rows are approximately recovered by `quantized_mat * scales[:, None]`.
+    """
+    if dtype == "float16":
+        return np.asarray(mat, dtype=np.float16), None
+    quantized_mat = np.empty(mat.shape, dtype=np.int8)
+    scales = np.empty(mat.shape[0], dtype=np.float32)
+    for start in range(0, mat.shape[0], ROW_CHUNK_SIZE):
+        chunk = np.asarray(mat[start : start + ROW_CHUNK_SIZE], dtype=np.float32)
+        chunk_scales = np.abs(chunk).max(axis=1) / 127
+        chunk_scales[chunk_scales == 0] = 1
+        quantized_mat[start : start + ROW_CHUNK_SIZE] = np.round(chunk / chunk_scales[:, None])
+        scales[start : start + ROW_CHUNK_SIZE] = chunk_scales
+    return quantized_mat, scales
+
+
+def get_smallest_indices(distances: np.array, k: int) -> np.array:
+    """Unordered indices of the k smallest values in each row."""
+    if k >= distances.shape[1]:
+        return np.broadcast_to(np.arange(distances.shape[1]), distances.shape)
+    return np.argpartition(distances, k - 1, axis=1)[:, :k]
+
+
+def assign_to_centroids(mat: np.array, centroids: np.array, spherical: bool = False) -> np.array:
+    """Index of the nearest centroid for each row of mat, by inner product if spherical and Euclidean distance otherwise."""
+    # argmin ||x - c||^2 == argmax (x.c - ||c||^2 / 2)
+    offsets = 0 if spherical else (centroids**2).sum(axis=1) / 2
+    assignments = np.empty(mat.shape[0], dtype=np.intp)
+    for start in range(0, mat.shape[0], ROW_CHUNK_SIZE):
+        scores = mat[start : start + ROW_CHUNK_SIZE] @ centroids.T - offsets
+        assignments[start : start + ROW_CHUNK_SIZE] = scores.argmax(axis=1)
+    return assignments
+
+
+def kmeans(mat: np.array, n_clusters: int, n_iter: int = 20, seed: int = 0, spherical: bool = False) -> np.array:
+    """Lloyd's k-means, returning float32 centroids of shape (n_clusters, d).
+
+    If spherical, centroids are re-normalized to unit length each iteration (i.e. clustering by cosine similarity).
+    Empty clusters are re-seeded with random rows.
+    """
+    rng = np.random.default_rng(seed)
+    mat = np.asarray(mat, dtype=np.float32)
+    n_clusters = min(n_clusters, mat.shape[0])
+    centroids = mat[rng.choice(mat.shape[0], size=n_clusters, replace=False)].copy()
+    for _ in range(n_iter):
+        assignments = assign_to_centroids(mat, centroids, spherical=spherical)
+        counts = np.bincount(assignments, minlength=n_clusters)
+        membership = scipy.sparse.csr_matrix(
+            (np.ones(len(assignments), dtype=np.float32), (assignments, np.arange(len(assignments)))),
+            shape=(n_clusters, len(assignments)),
+        )
+        sums = membership @ mat
+        is_empty = counts == 0
+        centroids[~is_empty] = sums[~is_empty] / counts[~is_empty, None]
+        if is_empty.any():
+            centroids[is_empty] = mat[rng.choice(mat.shape[0], size=is_empty.sum(), replace=False)]
+        if spherical:
+            norms = np.linalg.norm(centroids, axis=1, keepdims=True)
+            norms[norms == 0] = 1
+            centroids /= norms
+    return centroids
@@ -1,4 +1,14 @@
-from llm_math_education import retrieval
+from __future__ import annotations
+
+import asyncio
+import concurrent.futures
+import logging
+
+import numpy as np
+
+from llm_math_education import embedding_utils, query_cache, retrieval
+
+FUSION_METHODS = ["score", "rrf"]
 
 
 class RetrievalStrategy:
@@ -7,6 +17,15 @@ class RetrievalStrategy:
     def do_retrieval(self, expected_slots: list[str], user_query: str, previous_messages: list[dict[str, str]] = []):
         raise ValueError("Not implemented.")
 
+    async def ado_retrieval(
+        self,
+        expected_slots: list[str],
+        user_query: str,
+        previous_messages: list[dict[str, str]] = [],
+    ):
+        """Async variant of do_retrieval. By default, runs do_retrieval in a worker thread."""
+        return await asyncio.to_thread(self.do_retrieval, expected_slots, user_query, previous_messages)
+
 
 class NoRetrievalStrategy(RetrievalStrategy):
     """Fill all expected_slots with the empty string."""
@@ -14,6 +33,14 @@ class NoRetrievalStrategy(RetrievalStrategy):
     def do_retrieval(self, expected_slots: list[str], user_query: str, previous_messages: list[dict[str, str]] = []):
         return {expected_slot: "" for expected_slot in expected_slots}
 
+    async def ado_retrieval(
+        self,
+        expected_slots: list[str],
+        user_query: str,
+        previous_messages: list[dict[str, str]] = [],
+    ):
+        return self.do_retrieval(expected_slots, user_query, previous_messages)
+
 
 class StaticRetrievalStrategy(RetrievalStrategy):
     """Fill all expected_slots with a static string."""
@@ -25,6 +52,14 @@ class StaticRetrievalStrategy(RetrievalStrategy):
     def do_retrieval(self, expected_slots: list[str], user_query: str, previous_messages: list[dict[str, str]] = []):
         return {expected_slot: self.fill_string for expected_slot in expected_slots}
 
+    async def ado_retrieval(
+        self,
+        expected_slots: list[str],
+        user_query: str,
+        previous_messages: list[dict[str, str]] = [],
+    ):
+        return self.do_retrieval(expected_slots, user_query, previous_messages)
+
 
 class EmbeddingRetrievalStrategy(RetrievalStrategy):
     """Fill all expected_slots with up to max_token texts from the retrieval_db.
@@ -37,30 +72,43 @@ class EmbeddingRetrievalStrategy(RetrievalStrategy):
 
     def do_retrieval(self, expected_slots: list[str], user_query: str, previous_messages: list[dict[str, str]] = []):
         distances = self.db.compute_string_distances(user_query)
-        sort_inds = retrieval.get_distance_sort_indices(distances)
-        texts = []
-        total_tokens = 0
-        for ind in sort_inds:
-            row = self.db.df.iloc[ind]
-            n_tokens = row[self.db.n_tokens_col]
-            if total_tokens + n_tokens > self.max_tokens:
-                break
-            total_tokens += n_tokens
-            text = row[self.db.embed_col]
-            texts.append(text)
-        fill_string = "\n".join(texts)
+        fill_string = self.get_fill_string_from_distances(distances)
+        return {expected_slot: fill_string for expected_slot in expected_slots}
+
+    async def ado_retrieval(
+        self,
+        expected_slots: list[str],
+        user_query: str,
+        previous_messages: list[dict[str, str]] = [],
+    ):
+        query_embedding = await self.db.acompute_query_embedding(user_query)
+        distances = await asyncio.to_thread(self.db.compute_embedding_distances, query_embedding)
+        fill_string = self.get_fill_string_from_distances(distances)
         return {expected_slot: fill_string for expected_slot in expected_slots}
 
+    def get_fill_string_from_distances(self, distances) -> str:
+        inds = self.db.get_top_indices_within_budget(distances, self.max_tokens)
+        return "\n".join(self.db.texts[ind] for ind in inds)
+
 
 class MappedEmbeddingRetrievalStrategy(RetrievalStrategy):
     """Fill all expected_slots based on the entries in slot_map.
     If asked to fill a slot not in slot_map, will use nonmatching_fill instead.
-    slot_map can have either static strings or `retrieval.DbInfo`."""
+    slot_map can have either static strings or `retrieval.DbInfo`.
+
+    The query is embedded once per embedding model and shared by all DbInfo slots,
+    and the per-db searches run concurrently, in up to max_workers threads."""
 
-    def __init__(self, slot_map: dict[str, str | retrieval.DbInfo], nonmatching_fill: str = "") -> None:
+    def __init__(
+        self,
+        slot_map: dict[str, str | retrieval.DbInfo],
+        nonmatching_fill: str = "",
+        max_workers: int | None = None,
+    ) -> None:
         super().__init__()
         self.slot_map = slot_map
         self.nonmatching_fill = nonmatching_fill
+        self.max_workers = max_workers
         self._validate_slot_map()
 
     def _validate_slot_map(self):
@@ -78,16 +126,464 @@ class MappedEmbeddingRetrievalStrategy(RetrievalStrategy):
         self._validate_slot_map()
 
     def do_retrieval(self, expected_slots: list[str], user_query: str, previous_messages: list[dict[str, str]] = []):
+        fill_string_map, db_info_map = self._split_slots(expected_slots)
+        if len(db_info_map) > 0:
+            fill_string_map.update(self.get_db_fill_strings(db_info_map, user_query))
+        return {expected_slot: fill_string_map[expected_slot] for expected_slot in expected_slots}
+
+    async def ado_retrieval(
+        self,
+        expected_slots: list[str],
+        user_query: str,
+        previous_messages: list[dict[str, str]] = [],
+    ):
+        fill_string_map, db_info_map = self._split_slots(expected_slots)
+        if len(db_info_map) > 0:
+            fill_string_map.update(await self.aget_db_fill_strings(db_info_map, user_query))
+        return {expected_slot: fill_string_map[expected_slot] for expected_slot in expected_slots}
+
+    def _split_slots(self, expected_slots: list[str]) -> tuple[dict[str, str], dict[str, retrieval.DbInfo]]:
+        """Returns the fill strings for the static slots, and the DbInfos for the remaining slots."""
         fill_string_map = {}
+        db_info_map = {}
         for expected_slot in expected_slots:
             if expected_slot in self.slot_map:
                 db_info = self.slot_map[expected_slot]
                 if type(db_info) is str:
-                    fill_string = db_info
+                    fill_string_map[expected_slot] = db_info
                 else:
-                    distances = db_info.db.compute_string_distances(user_query)
-                    fill_string = db_info.get_fill_string_from_distances(distances)
+                    db_info_map[expected_slot] = db_info
             else:
-                fill_string = self.nonmatching_fill
-            fill_string_map[expected_slot] = fill_string
-        return fill_string_map
+                fill_string_map[expected_slot] = self.nonmatching_fill
+        return fill_string_map, db_info_map
+
+    def get_db_fill_strings(self, db_info_map: dict[str, retrieval.DbInfo], user_query: str) -> dict[str, str]:
+        """Fill each slot from its DbInfo, embedding the user_query once per embedding model.
+
+        Args:
+            db_info_map (dict[str, retrieval.DbInfo]): Map of slot to the DbInfo that fills it.
+            user_query (str): The query to search with.
+
+        Returns:
+            dict[str, str]: Map of slot to fill string.
+        """
+        unique_db_infos = get_unique_db_infos(db_info_map)
+        query_embedding_map = {}
+        for embedding_model, db in get_embedding_model_dbs(unique_db_infos).items():
+            query_embedding_map[embedding_model] = db.compute_query_embedding(user_query)
+
+        def get_fill_string(db_info: retrieval.DbInfo) -> str:
+            return get_db_info_fill_string(db_info, user_query, query_embedding_map)
+
+        if len(unique_db_infos) == 1:
+            fill_strings = [get_fill_string(unique_db_infos[0])]
+        else:
+            max_workers = self.max_workers if self.max_workers is not None else len(unique_db_infos)
+            with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+                fill_strings = list(executor.map(get_fill_string, unique_db_infos))
+        return get_slot_fill_strings(db_info_map, unique_db_infos, fill_strings)
+
+    async def aget_db_fill_strings(self, db_info_map: dict[str, retrieval.DbInfo], user_query: str) -> dict[str, str]:
+        """Async variant of get_db_fill_strings: awaits the query embeddings, then searches in worker threads."""
+        unique_db_infos = get_unique_db_infos(db_info_map)
+        embedding_model_dbs = get_embedding_model_dbs(unique_db_infos)
+        query_embeddings = await asyncio.gather(
+            *[db.acompute_query_embedding(user_query) for db in embedding_model_dbs.values()],
+        )
+        query_embedding_map = dict(zip(embedding_model_dbs.keys(), query_embeddings))
+        fill_strings = await asyncio.gather(
+            *[
+                asyncio.to_thread(get_db_info_fill_string, db_info, user_query, query_embedding_map)
+                for db_info in unique_db_infos
+            ],
+        )
+        return get_slot_fill_strings(db_info_map, unique_db_infos, fill_strings)
+
+
+class FusedEmbeddingRetrievalStrategy(MappedEmbeddingRetrievalStrategy):
+    """Fill the DbInfo slots in slot_map from a single token budget shared across their dbs.
+
+    Rather than each DbInfo filling its own max_tokens, the texts of all the dbs are ranked together
+    and the best texts that fit in max_tokens are selected, regardless of which db they come from.
+    Each DbInfo slot is then filled with the selected texts from its db, with the DbInfo's prefix, suffix, and join_string.
+    The DbInfos' own max_tokens and max_texts are not used.
+
+    Fusion methods:
+     - "score": rank by cosine distance, which is comparable across dbs embedded with the same model.
+     - "rrf": reciprocal rank fusion, ranking by 1 / (rrf_k + rank within the db), considering the top rrf_depth texts of each db.
+    """
+
+    def __init__(
+        self,
+        slot_map: dict[str, str | retrieval.DbInfo],
+        max_tokens: int = 2000,
+        max_texts: int = 1000,
+        fusion: str = "score",
+        rrf_k: int = 60,
+        rrf_depth: int = 100,
+        nonmatching_fill: str = "",
+        max_workers: int | None = None,
+    ) -> None:
+        if fusion not in FUSION_METHODS:
+            raise ValueError(f"Unknown fusion method {fusion}; expected one of {FUSION_METHODS}.")
+        self.max_tokens = max_tokens
+        self.max_texts = max_texts
+        self.fusion = fusion
+        self.rrf_k = rrf_k
+        self.rrf_depth = rrf_depth
+        super().__init__(slot_map, nonmatching_fill=nonmatching_fill, max_workers=max_workers)
+
+    def _validate_slot_map(self):
+        super()._validate_slot_map()
+        for value in self.slot_map.values():
+            if type(value) is retrieval.DbInfo and value.use_parent_text:
+                raise ValueError("Parent text retrieval is not supported when fusing results.")
+
+    def get_db_fill_strings(self, db_info_map: dict[str, retrieval.DbInfo], user_query: str) -> dict[str, str]:
+        unique_db_infos = get_unique_db_infos(db_info_map)
+        query_embedding_map = {}
+        for embedding_model, db in get_embedding_model_dbs(unique_db_infos).items():
+            query_embedding_map[embedding_model] = db.compute_query_embedding(user_query)
+        fill_strings = self.get_fused_fill_strings(unique_db_infos, user_query, query_embedding_map)
+        return get_slot_fill_strings(db_info_map, unique_db_infos, fill_strings)
+
+    async def aget_db_fill_strings(self, db_info_map: dict[str, retrieval.DbInfo], user_query: str) -> dict[str, str]:
+        unique_db_infos = get_unique_db_infos(db_info_map)
+        embedding_model_dbs = get_embedding_model_dbs(unique_db_infos)
+        query_embeddings = await asyncio.gather(
+            *[db.acompute_query_embedding(user_query) for db in embedding_model_dbs.values()],
+        )
+        query_embedding_map = dict(zip(embedding_model_dbs.keys(), query_embeddings))
+        fill_strings = await asyncio.to_thread(
+            self.get_fused_fill_strings,
+            unique_db_infos,
+            user_query,
+            query_embedding_map,
+        )
+        return get_slot_fill_strings(db_info_map, unique_db_infos, fill_strings)
+
+    def get_fused_fill_strings(
+        self,
+        db_infos: list[retrieval.DbInfo],
+        user_query: str,
+        query_embedding_map: dict[str, np.array],
+    ) -> list[str]:
+        """Select the best texts across the dbs within the shared budget.
+
+        Returns:
+            list[str]: Fill strings corresponding to db_infos.
+        """
+        db_inds_list = self.get_fused_indices(
+            [get_db_info_distances(db_info, user_query, query_embedding_map) for db_info in db_infos],
+            [db_info.db.n_tokens for db_info in db_infos],
+        )
+        return [db_info.get_fill_string_from_indices(db_inds) for db_info, db_inds in zip(db_infos, db_inds_list)]
+
+    def get_fused_indices(self, distances_list: list[np.array], n_tokens_list: list[np.array]) -> list[np.array]:
+        """Rank the texts of all the dbs together, selecting those that fit in the shared budget.
+
+        Args:
+            distances_list (list[np.array]): Distances to the texts of each db.
+            n_tokens_list (list[np.array]): Token counts of the texts of each db.
+
+        Returns:
+            list[np.array]: For each db, indices of the selected texts, in ascending order of fused distance.
+        """
+        if self.fusion == "rrf":
+            distances_list = [self.get_rrf_distances(distances) for distances in distances_list]
+        offsets = np.cumsum([0] + [len(distances) for distances in distances_list])
+        fused_inds = retrieval.get_top_indices_within_budget(
+            np.concatenate(distances_list),
+            np.concatenate(n_tokens_list),
+            self.max_tokens,
+            self.max_texts,
+        )
+        db_positions = np.searchsorted(offsets, fused_inds, side="right") - 1
+        return [fused_inds[db_positions == i] - offsets[i] for i in range(len(distances_list))]
+
+    def get_rrf_distances(self, distances: np.array) -> np.array:
+        """Negative reciprocal rank fusion scores, so smaller is better; texts beyond rrf_depth get np.inf."""
+        top_inds = retrieval.get_top_k_indices(distances, min(self.rrf_depth, len(distances)))
+        top_inds = top_inds[np.isfinite(distances[top_inds])]
+        rrf_distances = np.full(len(distances), np.inf)
+        rrf_distances[top_inds] = -1 / (self.rrf_k + np.arange(1, len(top_inds) + 1))
+        return rrf_distances
+
+
+class HybridRetrievalStrategy(MappedEmbeddingRetrievalStrategy):
+    """Fill the DbInfo slots in slot_map by blending lexical (BM25) and embedding relevance.
+
+    Both scores are min-max scaled to [0, 1] per query and blended as
+    `embedding_weight * embedding_score + (1 - embedding_weight) * lexical_score`.
+    The lexical scores are computed while the query embedding request is in flight.
+    If the embedding request fails or takes longer than embedding_timeout_s (or if lexical_only is set),
+    texts are ranked on lexical scores alone; texts with no terms in common with the query are then excluded.
+    """
+
+    def __init__(
+        self,
+        slot_map: dict[str, str | retrieval.DbInfo],
+        embedding_weight: float = 0.7,
+        embedding_timeout_s: float | None = None,
+        lexical_only: bool = False,
+        nonmatching_fill: str = "",
+        max_workers: int | None = None,
+    ) -> None:
+        if not 0 <= embedding_weight <= 1:
+            raise ValueError("embedding_weight must be between 0 and 1.")
+        self.embedding_weight = embedding_weight
+        self.embedding_timeout_s = embedding_timeout_s
+        self.lexical_only = lexical_only
+        super().__init__(slot_map, nonmatching_fill=nonmatching_fill, max_workers=max_workers)
+
+    def _validate_slot_map(self):
+        super()._validate_slot_map()
+        for value in self.slot_map.values():
+            if type(value) is retrieval.DbInfo and not hasattr(value.db, "compute_lexical_scores"):
+                raise ValueError("Expected a db with a compute_lexical_scores() method.")
+
+    def get_db_fill_strings(self, db_info_map: dict[str, retrieval.DbInfo], user_query: str) -> dict[str, str]:
+        unique_db_infos = get_unique_db_infos(db_info_map)
+        embedding_model_dbs = {} if self.lexical_only else get_embedding_model_dbs(unique_db_infos)
+        query_embedding_map = None
+        executor = None
+        if len(embedding_model_dbs) > 0:
+            executor = concurrent.futures.ThreadPoolExecutor(max_workers=len(embedding_model_dbs))
+            embedding_futures = {
+                embedding_model: executor.submit(db.compute_query_embedding, user_query)
+                for embedding_model, db in embedding_model_dbs.items()
+            }
+        lexical_scores_list = [db_info.db.compute_lexical_scores(user_query) for db_info in unique_db_infos]
+        if executor is not None:
+            try:
+                query_embedding_map = {
+                    embedding_model: future.result(timeout=self.embedding_timeout_s)
+                    for embedding_model, future in embedding_futures.items()
+                }
+            except (concurrent.futures.TimeoutError, *embedding_utils.RETRYABLE_ERRORS) as ex:
+                logging.warning(f"Query embedding failed ({ex!r}); using lexical scores only.")
+            finally:
+                executor.shutdown(wait=False)
+        fill_strings = [
+            self.get_hybrid_fill_string(db_info, user_query, lexical_scores, query_embedding_map)
+            for db_info, lexical_scores in zip(unique_db_infos, lexical_scores_list)
+        ]
+        return get_slot_fill_strings(db_info_map, unique_db_infos, fill_strings)
+
+    async def aget_db_fill_strings(self, db_info_map: dict[str, retrieval.DbInfo], user_query: str) -> dict[str, str]:
+        unique_db_infos = get_unique_db_infos(db_info_map)
+        embedding_model_dbs = {} if self.lexical_only else get_embedding_model_dbs(unique_db_infos)
+        embeddings_task = asyncio.gather(
+            *[db.acompute_query_embedding(user_query) for db in embedding_model_dbs.values()],
+        )
+        lexical_scores_list = await asyncio.gather(
+            *[asyncio.to_thread(db_info.db.compute_lexical_scores, user_query) for db_info in unique_db_infos],
+        )
+        query_embedding_map = None
+        if len(embedding_model_dbs) > 0:
+            try:
+                query_embeddings = await asyncio.wait_for(embeddings_task, timeout=self.embedding_timeout_s)
+                query_embedding_map = dict(zip(embedding_model_dbs.keys(), query_embeddings))
+            except (asyncio.TimeoutError, *embedding_utils.RETRYABLE_ERRORS) as ex:
+                logging.warning(f"Query embedding failed ({ex!r}); using lexical scores only.")
+        else:
+            await embeddings_task
+        fill_strings = await asyncio.gather(
+            *[
+                asyncio.to_thread(self.get_hybrid_fill_string, db_info, user_query, lexical_scores, query_embedding_map)
+                for db_info, lexical_scores in zip(unique_db_infos, lexical_scores_list)
+            ],
+        )
+        return get_slot_fill_strings(db_info_map, unique_db_infos, fill_strings)
+
+    def get_hybrid_fill_string(
+        self,
+        db_info: retrieval.DbInfo,
+        user_query: str,
+        lexical_scores: np.array,
+        query_embedding_map: dict[str, np.array] | None,
+    ) -> str:
+        embedding_distances = None
+        if query_embedding_map is not None and getattr(db_info.db, "embedding_model", None) in query_embedding_map:
+            embedding_distances = db_info.db.compute_embedding_distances(
+                query_embedding_map[db_info.db.embedding_model]
+            )
+        distances = self.get_hybrid_distances(lexical_scores, embedding_distances)
+        return db_info.get_fill_string_from_distances(distances)
+
+    def get_hybrid_distances(self, lexical_scores: np.array, embedding_distances: np.array | None = None) -> np.array:
+        """Negative blended scores, so smaller is more relevant.
+
+        Args:
+            lexical_scores (np.array): BM25 scores.
+            embedding_distances (np.array | None, optional): Cosine distances. Defaults to None, meaning use lexical scores only.
+
+        Returns:
+            np.array: Distances; np.inf for texts that shouldn't be retrieved.
+        """
+        # texts with no query terms in common (raw BM25 score 0) are excluded by the raw scores,
+        # since scaling maps the lowest matching score, or every score if all are equal, to 0
+        is_nonmatching = lexical_scores <= 0
+        lexical_scores = min_max_scale(lexical_scores)
+        if embedding_distances is None:
+            distances = -lexical_scores
+            distances[is_nonmatching] = np.inf
+            return distances
+        embedding_scores = min_max_scale(-embedding_distances)
+        distances = -(self.embedding_weight * embedding_scores + (1 - self.embedding_weight) * lexical_scores)
+        # texts an approximate index didn't score are only retrievable by their lexical score
+        distances[~np.isfinite(embedding_distances)] = (
+            -(1 - self.embedding_weight) * lexical_scores[~np.isfinite(embedding_distances)]
+        )
+        return distances
+
+
+class CachedRetrievalStrategy(RetrievalStrategy):
+    """Cache the fills produced by another strategy, reusing them for repeated or near-duplicate queries.
+
+    A query whose normalized text was seen before (for the same expected_slots) is answered immediately.
+    Otherwise, the query is embedded and compared to the cached query embeddings;
+    if one is within similarity_threshold, its fills are reused. The query embedding is cached in memory by `embedding_utils`
+    (`get_openai_embeddings_cached` for `do_retrieval`, and the memory cache of `aget_openai_embeddings` for `ado_retrieval`),
+    so on a miss the wrapped strategy doesn't need another embedding request.
+    With similarity_threshold None, only exact matches are used and no embedding is needed to check the cache.
+    Pass a cache to share it, e.g. between sessions; max_entries and ttl_s are then ignored.
+    """
+
+    def __init__(
+        self,
+        retrieval_strategy: RetrievalStrategy,
+        max_entries: int = 1024,
+        ttl_s: float | None = None,
+        similarity_threshold: float | None = 0.97,
+        embedding_model: str = embedding_utils.EMBEDDING_MODEL,
+        cache: query_cache.SemanticQueryCache | None = None,
+    ) -> None:
+        super().__init__()
+        self.retrieval_strategy = retrieval_strategy
+        self.similarity_threshold = similarity_threshold
+        self.embedding_model = embedding_model
+        if cache is None:
+            cache = query_cache.SemanticQueryCache(
+                max_entries=max_entries,
+                ttl_s=ttl_s,
+                similarity_threshold=similarity_threshold if similarity_threshold is not None else np.inf,
+            )
+        self.cache = cache
+
+    def update_map(self, slot_updates: dict):
+        """Update the wrapped strategy's slot map; cached fills may no longer apply, so clears the cache."""
+        self.retrieval_strategy.update_map(slot_updates)
+        self.cache.clear()
+
+    def get_cache_key(self, expected_slots: list[str], user_query: str) -> tuple[str, tuple[str]]:
+        return retrieval.normalize_text(user_query), tuple(expected_slots)
+
+    def do_retrieval(self, expected_slots: list[str], user_query: str, previous_messages: list[dict[str, str]] = []):
+        key = self.get_cache_key(expected_slots, user_query)
+        slot_fill_dict = self.cache.get(key)
+        if slot_fill_dict is not None:
+            return slot_fill_dict.copy()
+        query_embedding = None
+        if self.similarity_threshold is not None:
+            query_embedding = embedding_utils.get_openai_embeddings([key[0]], embedding_model=self.embedding_model)[0]
+        slot_fill_dict = self._get_similar_fill(key, query_embedding)
+        if slot_fill_dict is None:
+            slot_fill_dict = self.retrieval_strategy.do_retrieval(expected_slots, user_query, previous_messages)
+            self.cache.add(key, slot_fill_dict.copy(), query_embedding)
+        return slot_fill_dict
+
+    async def ado_retrieval(
+        self,
+        expected_slots: list[str],
+        user_query: str,
+        previous_messages: list[dict[str, str]] = [],
+    ):
+        key = self.get_cache_key(expected_slots, user_query)
+        slot_fill_dict = self.cache.get(key)
+        if slot_fill_dict is not None:
+            return slot_fill_dict.copy()
+        query_embedding = None
+        if self.similarity_threshold is not None:
+            embedding_list = await embedding_utils.aget_openai_embeddings(
+                [key[0]], embedding_model=self.embedding_model
+            )
+            query_embedding = embedding_list[0]
+        slot_fill_dict = self._get_similar_fill(key, query_embedding)
+        if slot_fill_dict is None:
+            slot_fill_dict = await self.retrieval_strategy.ado_retrieval(expected_slots, user_query, previous_messages)
+            self.cache.add(key, slot_fill_dict.copy(), query_embedding)
+        return slot_fill_dict
+
+    def _get_similar_fill(self, key: tuple[str, tuple[str]], query_embedding: np.array | None) -> dict[str, str] | None:
+        if query_embedding is None:
+            self.cache.record_miss()
+            return None
+        # only reuse fills for the same expected_slots
+        slot_fill_dict = self.cache.get_similar(query_embedding, lambda cached_key: cached_key[1] == key[1])
+        return slot_fill_dict.copy() if slot_fill_dict is not None else None
+
+    def get_cache_stats(self) -> dict[str, float]:
+        return self.cache.get_stats()
+
+
+def min_max_scale(scores: np.array) -> np.array:
+    """Scale the finite scores to [0, 1]; non-finite scores become 0."""
+    scores = np.asarray(scores, dtype=np.float64)
+    is_finite = np.isfinite(scores)
+    scaled_scores = np.zeros(len(scores))
+    if not is_finite.any():
+        return scaled_scores
+    min_score = scores[is_finite].min()
+    score_range = scores[is_finite].max() - min_score
+    if score_range > 0:
+        scaled_scores[is_finite] = (scores[is_finite] - min_score) / score_range
+    return scaled_scores
+
+
+def get_unique_db_infos(db_info_map: dict[str, retrieval.DbInfo]) -> list[retrieval.DbInfo]:
+    # the same DbInfo may fill multiple slots
+    return list({id(db_info): db_info for db_info in db_info_map.values()}.values())
+
+
+def get_embedding_model_dbs(db_infos: list[retrieval.DbInfo]) -> dict[str, retrieval.RetrievalDb]:
+    """Map each embedding model to a db that can embed queries with it."""
+    embedding_model_dbs = {}
+    for db_info in db_infos:
+        embedding_model = getattr(db_info.db, "embedding_model", None)
+        if embedding_model is not None and embedding_model not in embedding_model_dbs:
+            embedding_model_dbs[embedding_model] = db_info.db
+    return embedding_model_dbs
+
+
+def get_db_info_distances(
+    db_info: retrieval.DbInfo,
+    user_query: str,
+    query_embedding_map: dict[str, np.array],
+) -> np.array:
+    embedding_model = getattr(db_info.db, "embedding_model", None)
+    if embedding_model is None:
+        # a db without embedding_model only supports querying by string
+        return db_info.db.compute_string_distances(user_query)
+    return db_info.db.compute_embedding_distances(query_embedding_map[embedding_model])
+
+
+def get_db_info_fill_string(
+    db_info: retrieval.DbInfo,
+    user_query: str,
+    query_embedding_map: dict[str, np.array],
+) -> str:
+    embedding_model = getattr(db_info.db, "embedding_model", None)
+    if embedding_model is not None:
+        return db_info.get_fill_string_from_query_embedding(query_embedding_map[embedding_model])
+    distances = db_info.db.compute_string_distances(user_query)
+    return db_info.get_fill_string_from_distances(distances)
+
+
+def get_slot_fill_strings(
+    db_info_map: dict[str, retrieval.DbInfo],
+    unique_db_infos: list[retrieval.DbInfo],
+    fill_strings: list[str],
+) -> dict[str, str]:
+    fill_string_by_db_info = {id(db_info): fill_string for db_info, fill_string in zip(unique_db_infos, fill_strings)}
+    return {slot: fill_string_by_db_info[id(db_info)] for slot, db_info in db_info_map.items()}
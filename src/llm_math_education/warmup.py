@@ -0,0 +1,79 @@
+# Preload the resources that are otherwise loaded on first use, e.g. during a student's first turn after a cold start.
+from __future__ import annotations
+
+import collections.abc
+import logging
+import threading
+import time
+
+from llm_math_education import embedding_utils, logit_bias, misconceptions
+
+# resource name -> cached loader; each loader is cheap to call again once loaded
+WARM_UP_RESOURCES: dict[str, collections.abc.Callable[[], object]] = {
+    "logit_bias_tokenizer": logit_bias.get_tokenizer,
+    "embedding_tokenizer": embedding_utils.get_tokenizer,
+    "stopword_tokens": logit_bias.get_stopword_tokens,
+    "nonstopword_token_table": logit_bias.get_nonstopword_token_table,
+    "misconceptions_string": misconceptions.get_misconceptions_string,
+}
+
+
+def warm_up(resource_names: list[str] | None = None) -> dict[str, float]:
+    """Load the given resources, timing each one.
+
+    Resources that fail to load are logged and skipped, so they are loaded (and fail) on first use instead.
+
+    Args:
+        resource_names (list[str] | None, optional): Keys of WARM_UP_RESOURCES. Defaults to None, meaning all resources.
+
+    Returns:
+        dict[str, float]: Load time in seconds for each resource that loaded.
+    """
+    if resource_names is None:
+        resource_names = list(WARM_UP_RESOURCES.keys())
+    unknown_names = set(resource_names) - set(WARM_UP_RESOURCES.keys())
+    if len(unknown_names) > 0:
+        raise ValueError(f"Unknown warm-up resources: {sorted(unknown_names)}")
+    timings = {}
+    for resource_name in resource_names:
+        start = time.perf_counter()
+        try:
+            WARM_UP_RESOURCES[resource_name]()
+        except Exception as ex:
+            logging.warning(f"Failed to warm up {resource_name}: {ex}")
+            continue
+        timings[resource_name] = time.perf_counter() - start
+    logging.info("Warm-up timings (s): " + ", ".join(f"{name}={elapsed:.3f}" for name, elapsed in timings.items()))
+    return timings
+
+
+class WarmUpThread(threading.Thread):
+    """Daemon thread that runs `warm_up`, e.g. at process start.
+
+    ```python
+        warm_up_thread = WarmUpThread()
+        warm_up_thread.start()
+        ...
+        timings = warm_up_thread.get_timings()  # waits for the warm-up to finish
+    ```
+    """
+
+    def __init__(self, resource_names: list[str] | None = None):
+        super().__init__(name="warm_up", daemon=True)
+        self.resource_names = resource_names
+        self.timings: dict[str, float] = {}
+
+    def run(self):
+        self.timings = warm_up(self.resource_names)
+
+    def get_timings(self, timeout: float | None = None) -> dict[str, float]:
+        """Wait for the warm-up to finish, returning the timings (empty if it hasn't finished within timeout)."""
+        self.join(timeout)
+        return self.timings
+
+
+def start_warm_up_thread(resource_names: list[str] | None = None) -> WarmUpThread:
+    """Start warming up the given resources in a background thread. See `warm_up`."""
+    warm_up_thread = WarmUpThread(resource_names)
+    warm_up_thread.start()
+    return warm_up_thread
@@ -223,6 +223,8 @@ st.set_page_config(
     page_title="ChatGPT for middle-school math education - Hint generation",
     page_icon="💡",
 )
+data_utils.start_warm_up()
+data_utils.start_embedding_cache()
 
 if auth_utils.check_is_authorized(allow_openai_key=True):
     instantiate_session()
@@ -5,7 +5,15 @@ from pathlib import Path
 import pandas as pd
 import streamlit as st
 
-from llm_math_education import misconceptions, retrieval, retrieval_strategies
+from llm_math_education import (
+    embedding_cache,
+    embedding_utils,
+    misconceptions,
+    query_cache,
+    retrieval,
+    retrieval_strategies,
+    warmup,
+)
 
 DATA_DIR = Path("./data") / "app_data"
 RETRIEVAL_OPTIONS_LIST = [
@@ -17,16 +25,44 @@ RETRIEVAL_OPTIONS_LIST = [
 DB_NAME_LIST = ["rori_microlesson", "openstax_subsection"]
 
 
+@st.cache_resource
+def start_warm_up() -> warmup.WarmUpThread:
+    """Once per process, start loading the tokenizers, stopwords, and misconceptions in the background.
+
+    Pages call this before authorization, so loading overlaps with the rest of the first run.
+    """
+    return warmup.start_warm_up_thread()
+
+
+@st.cache_resource
+def start_embedding_cache() -> embedding_cache.EmbeddingCache | None:
+    """Once per process, persist embeddings in DATA_DIR, so queries embedded before a restart aren't requested again."""
+    if not DATA_DIR.exists():
+        return None
+    try:
+        cache = embedding_cache.EmbeddingCache.in_dir(DATA_DIR)
+    except Exception as ex:
+        logging.warning(f"Failed to open the embedding cache in {DATA_DIR}: {ex}")
+        return None
+    embedding_utils.set_embedding_cache(cache)
+    return cache
+
+
 @st.cache_data
 def create_retrieval_db_map(
     db_name_list: list[str] = DB_NAME_LIST,
     except_on_error: bool = False,
+    mmap_mode: str | None = "r",
 ) -> dict[str, retrieval.RetrievalDb]:
+    """Load the retrieval dbs in DATA_DIR.
+
+    The embeddings are memory-mapped by default, so the copy `st.cache_data` gives each session shares the matrices.
+    """
     retrieval_db_map = {}
     if DATA_DIR.exists():
         for db_name in db_name_list:
             try:
-                db = retrieval.RetrievalDb(DATA_DIR, db_name, "db_string")
+                db = retrieval.RetrievalDb(DATA_DIR, db_name, "db_string", mmap_mode=mmap_mode)
                 retrieval_db_map[db_name] = db
             except Exception as ex:
                 if except_on_error:
@@ -58,6 +94,16 @@ def create_hint_default_retrieval_slot_map() -> dict[str, retrieval.DbInfo]:
     return slot_map
 
 
+@st.cache_resource
+def get_shared_query_cache_map() -> dict[str, query_cache.SemanticQueryCache]:
+    """One query cache per retrieval option, shared by every session in the process.
+
+    Sessions build their own strategies (see `create_mathqa_retrieval_options_map`),
+    so caching is only effective across students if the caches themselves are shared.
+    """
+    return {retrieval_option: query_cache.SemanticQueryCache() for retrieval_option in RETRIEVAL_OPTIONS_LIST[:3]}
+
+
 def create_mathqa_retrieval_options_map(
     retrieval_db_map: dict[str, retrieval.RetrievalDb],
 ) -> dict[str, retrieval_strategies.RetrievalStrategy]:
@@ -85,18 +131,27 @@ def create_mathqa_retrieval_options_map(
                 "openstax_subsection_texts": openstax_subsection_db_info,
             },
         )
-        both_strategy = retrieval_strategies.MappedEmbeddingRetrievalStrategy(
+        # the two dbs share a single budget, so the most relevant texts are used regardless of source
+        both_strategy = retrieval_strategies.FusedEmbeddingRetrievalStrategy(
             {
-                "rori_microlesson_texts": rori_microlesson_db_info.copy(max_tokens=1000),
-                "openstax_subsection_texts": openstax_subsection_db_info.copy(max_tokens=1000),
+                "rori_microlesson_texts": rori_microlesson_db_info,
+                "openstax_subsection_texts": openstax_subsection_db_info,
             },
+            max_tokens=2000,
         )
+        # repeated and near-duplicate student questions reuse earlier retrievals, including other sessions'
+        query_cache_map = get_shared_query_cache_map()
         retrieval_options_map = {
-            RETRIEVAL_OPTIONS_LIST[0]: both_strategy,
-            RETRIEVAL_OPTIONS_LIST[1]: rori_only_strategy,
-            RETRIEVAL_OPTIONS_LIST[2]: openstax_only_strategy,
-            RETRIEVAL_OPTIONS_LIST[3]: retrieval_strategies.NoRetrievalStrategy(),
+            retrieval_option: retrieval_strategies.CachedRetrievalStrategy(
+                strategy,
+                cache=query_cache_map[retrieval_option],
+            )
+            for retrieval_option, strategy in zip(
+                RETRIEVAL_OPTIONS_LIST[:3],
+                [both_strategy, rori_only_strategy, openstax_only_strategy],
+            )
         }
+        retrieval_options_map[RETRIEVAL_OPTIONS_LIST[3]] = retrieval_strategies.NoRetrievalStrategy()
     return retrieval_options_map
 
 
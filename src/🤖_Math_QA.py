@@ -7,11 +7,13 @@ import openai
 import pandas as pd
 import streamlit as st
 
-from llm_math_education import prompt_utils
+from llm_math_education import prompt_utils, retrieval_strategies
 from llm_math_education.prompts import mathqa
 from streamlit_app import auth_utils, chat_utils, custom_textarea, data_utils
 
 MAX_TOKENS = 4096
+# tokens reserved for the assistant's response
+MAX_RESPONSE_TOKENS = 1024
 SAMPLE_QUERY_CATEGORIES = ["Algebra", "Geometry"]
 STUDENT_QUERY_SELECTION_STRING = "(Choose a student question from MathNation)"
 
@@ -108,10 +110,17 @@ def update_temperature_setting():
         st.session_state["temperature_text_input_valid"] = False
 
 
+def get_retrieval_strategy_name(retrieval_strategy: retrieval_strategies.RetrievalStrategy) -> str:
+    # every retrieval option is wrapped in a cache; name the strategy that actually retrieves
+    if isinstance(retrieval_strategy, retrieval_strategies.CachedRetrievalStrategy):
+        retrieval_strategy = retrieval_strategy.retrieval_strategy
+    return retrieval_strategy.__class__.__name__
+
+
 def update_retrieval_setting():
     retrieval_str = st.session_state["retrieval_radio"]
     logging.info(
-        f"Updated retrieval strategy from {st.session_state.retrieval_strategy.__class__.__name__} to {st.session_state.retrieval_options_map[retrieval_str].__class__.__name__}.",
+        f"Updated retrieval strategy from {get_retrieval_strategy_name(st.session_state.retrieval_strategy)} to {get_retrieval_strategy_name(st.session_state.retrieval_options_map[retrieval_str])}.",
     )
     st.session_state["retrieval_strategy"] = st.session_state.retrieval_options_map[retrieval_str]
     st.session_state.prompt_manager.set_retrieval_strategy(st.session_state.retrieval_strategy)
@@ -134,7 +143,9 @@ def instantiate_session():
             st.session_state[key_name] = default_value
 
     if "prompt_manager" not in st.session_state:
-        st.session_state.prompt_manager = prompt_utils.PromptManager()
+        st.session_state.prompt_manager = prompt_utils.PromptManager().set_context_window(
+            MAX_TOKENS - MAX_RESPONSE_TOKENS,
+        )
 
     if "show_expert_controls" in st.query_params:
         if st.query_params["show_expert_controls"].lower() == "true":
@@ -272,9 +283,12 @@ After each query, the associated prompt is included in a drop-down (including an
         if st.session_state.show_expert_controls:
             with st.expander("Advanced"):
                 st.markdown(f"Conversation length: {len(st.session_state.chat_messages)}")
+                used_token_count = st.session_state.prompt_manager.compute_stored_chat_token_count()
                 st.markdown(
-                    f"Used tokens: {st.session_state.prompt_manager.compute_stored_token_counts()} / {MAX_TOKENS}",
+                    f"Used tokens: {used_token_count} / {MAX_TOKENS}",
                 )
+                if used_token_count > MAX_TOKENS:
+                    st.info("Conversation exceeds the token limit; the oldest messages are no longer sent.")
                 st.text_input("Temperature:", key="temperature_text_input", on_change=update_temperature_setting)
                 if not st.session_state["temperature_text_input_valid"]:
                     st.warning("Invalid temperature setting; should be a decimal between 0 and 2.")
@@ -288,6 +302,8 @@ After each query, the associated prompt is included in a drop-down (including an
 
 
 st.set_page_config(page_title="ChatGPT for middle-school math education", page_icon="🤖")
+data_utils.start_warm_up()
+data_utils.start_embedding_cache()
 if auth_utils.check_is_authorized(allow_openai_key=True):
     instantiate_session()
     build_app()
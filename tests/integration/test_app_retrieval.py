@@ -1,7 +1,13 @@
 # Test retrieval with the actual app data
 import conftest
+import numpy as np
 
-from llm_math_education import prompt_utils, retrieval, retrieval_strategies
+from llm_math_education import (
+    prompt_utils,
+    retrieval,
+    retrieval_index,
+    retrieval_strategies,
+)
 
 
 def test_parent_retrieval(monkeypatch, pytestconfig):
@@ -38,3 +44,58 @@ def test_parent_retrieval(monkeypatch, pytestconfig):
     assert len(fill) > 0
 
     assert fill == messages[0]["content"]
+
+
+def test_quantized_retrieval(pytestconfig):
+    app_data_dir = pytestconfig.rootpath / "data" / "app_data"
+    openstax_db = retrieval.RetrievalDb(app_data_dir, "openstax_subsection", "db_string")
+    normalized_embedding_mat = openstax_db.normalized_embedding_mat
+    # perturbed copies of existing texts serve as realistic queries
+    rng = np.random.default_rng(0)
+    query_embeddings = normalized_embedding_mat[rng.choice(len(normalized_embedding_mat), size=50)]
+    query_embeddings = retrieval.normalize_embeddings(query_embeddings + 0.02 * rng.normal(size=query_embeddings.shape))
+
+    exact_distances = retrieval_index.BruteForceIndex().compute_distances(query_embeddings, normalized_embedding_mat)
+    expected_top_k = retrieval.get_top_k_indices(exact_distances, 10)
+    for dtype in ["int8", "float16"]:
+        index = retrieval_index.QuantizedIndex(dtype, n_rerank=50)
+        index.build(normalized_embedding_mat)
+        distances = index.compute_distances(query_embeddings, normalized_embedding_mat)
+        assert np.array_equal(retrieval.get_top_k_indices(distances, 10), expected_top_k)
+
+
+def test_fused_retrieval(monkeypatch, pytestconfig):
+    app_data_dir = pytestconfig.rootpath / "data" / "app_data"
+    openstax_db = retrieval.RetrievalDb(app_data_dir, "openstax_subsection", "db_string")
+    rori_db = retrieval.RetrievalDb(app_data_dir, "rori_microlesson", "db_string")
+    # an existing text serves as a realistic query
+    query_embedding = openstax_db.embedding_mat[0]
+    monkeypatch.setattr(
+        "llm_math_education.embedding_utils.get_openai_embeddings",
+        lambda texts, *args, **kwargs: [query_embedding for _ in texts],
+    )
+    slot_map = {
+        "openstax_subsection_texts": retrieval.DbInfo(openstax_db, prefix="OpenStax:\n"),
+        "rori_microlesson_texts": retrieval.DbInfo(rori_db, prefix="Rori:\n"),
+    }
+    strategy = retrieval_strategies.FusedEmbeddingRetrievalStrategy(slot_map, max_tokens=2000)
+    slot_fill_dict = strategy.do_retrieval(list(slot_map.keys()), "query")
+    assert slot_fill_dict["openstax_subsection_texts"].startswith("OpenStax:\n" + openstax_db.texts[0])
+
+    # equivalent to ranking the texts of both dbs together
+    distances_list = [
+        openstax_db.compute_embedding_distances(query_embedding),
+        rori_db.compute_embedding_distances(query_embedding),
+    ]
+    distances = np.concatenate(distances_list)
+    n_tokens = np.concatenate([openstax_db.n_tokens, rori_db.n_tokens])
+    expected_inds = []
+    total_tokens = 0
+    for ind in np.argsort(distances, kind="stable"):
+        if total_tokens + n_tokens[ind] > 2000:
+            break
+        total_tokens += n_tokens[ind]
+        expected_inds.append(ind)
+    openstax_inds, rori_inds = strategy.get_fused_indices(distances_list, [openstax_db.n_tokens, rori_db.n_tokens])
+    assert sorted(openstax_inds.tolist() + (rori_inds + len(openstax_db.texts)).tolist()) == sorted(expected_inds)
+    assert slot_fill_dict["rori_microlesson_texts"] == "Rori:\n" + "\n".join(rori_db.texts[ind] for ind in rori_inds)
@@ -2,8 +2,14 @@
 # including testing some of the associated utilities in `streamlit_app`
 
 import conftest
+import numpy as np
 
-from llm_math_education import prompt_utils, retrieval_strategies
+from llm_math_education import (
+    embedding_cache,
+    embedding_utils,
+    prompt_utils,
+    retrieval_strategies,
+)
 from llm_math_education.prompts import hints as hint_prompts
 from streamlit_app import auth_utils, data_utils
 
@@ -44,6 +50,8 @@ def test_hint_generation(monkeypatch):
 def test_data_utils():
     retrieval_db_map = data_utils.create_retrieval_db_map()
     assert len(retrieval_db_map) > 1
+    # shared across sessions by memory-mapping the search matrices
+    assert all(isinstance(db.normalized_embedding_mat, np.memmap) for db in retrieval_db_map.values())
 
     slot_map = data_utils.create_hint_default_retrieval_slot_map()
     assert len(slot_map) > 1
@@ -54,6 +62,25 @@ def test_data_utils():
         type(retrieval_strategy) is not retrieval_strategies.NoRetrievalStrategy
         for retrieval_strategy in retrieval_options_map.values()
     )
+    # query caches are shared between sessions, which each create their own options map
+    other_retrieval_options_map = data_utils.create_mathqa_retrieval_options_map(retrieval_db_map)
+    for retrieval_option in data_utils.RETRIEVAL_OPTIONS_LIST[:3]:
+        retrieval_strategy = retrieval_options_map[retrieval_option]
+        assert isinstance(retrieval_strategy, retrieval_strategies.CachedRetrievalStrategy)
+        assert retrieval_strategy.cache is other_retrieval_options_map[retrieval_option].cache
+
+
+def test_start_embedding_cache(tmp_path, monkeypatch):
+    monkeypatch.setattr("streamlit_app.data_utils.DATA_DIR", tmp_path)
+    monkeypatch.setattr("llm_math_education.embedding_utils.embedding_cache", None)
+    data_utils.start_embedding_cache.clear()
+    cache = data_utils.start_embedding_cache()
+    assert cache is not None
+    assert embedding_utils.embedding_cache is cache
+    assert (tmp_path / embedding_cache.DEFAULT_CACHE_FILENAME).exists()
+    # registered once per process
+    assert data_utils.start_embedding_cache() is cache
+    data_utils.start_embedding_cache.clear()
 
 
 def test_auth_utils():
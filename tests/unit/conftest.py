@@ -13,6 +13,7 @@ def mock_get_openai_embeddings(input_text_list, *args, **kwargs):
 def retrieval_db_path(tmp_path, monkeypatch):
     # Creates a retrieval database that can be used by multiple tests
     monkeypatch.setattr("llm_math_education.embedding_utils.get_openai_embeddings", mock_get_openai_embeddings)
+    monkeypatch.setattr("llm_math_education.embedding_utils.request_openai_embeddings", mock_get_openai_embeddings)
 
     df = pd.DataFrame(
         [
@@ -0,0 +1,26 @@
+import numpy as np
+
+from llm_math_education import embedding_cache
+
+
+def test_EmbeddingCache(tmp_path):
+    cache = embedding_cache.EmbeddingCache.in_dir(tmp_path)
+    assert len(cache) == 0
+    assert cache.get_embeddings(["a", "b"], "model") == [None, None]
+
+    embeddings = [np.random.random(4), np.random.random(4)]
+    cache.add_embeddings(["a", "b"], embeddings, "model")
+    assert len(cache) == 2
+    found = cache.get_embeddings(["b", "c", "a", "b"], "model")
+    assert found[1] is None
+    assert np.array_equal(found[0], embeddings[1])
+    assert np.array_equal(found[2], embeddings[0])
+    assert np.array_equal(found[3], embeddings[1])
+
+    # keys include the model
+    assert cache.get_embeddings(["a"], "other_model") == [None]
+
+    # the cache persists across instances
+    cache.close()
+    cache = embedding_cache.EmbeddingCache(tmp_path / embedding_cache.DEFAULT_CACHE_FILENAME)
+    assert np.array_equal(cache.get_embeddings(["a"], "model")[0], embeddings[0])
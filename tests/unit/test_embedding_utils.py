@@ -1,6 +1,15 @@
+import asyncio
+import collections
+import random
+import threading
+import time
+
 import conftest
+import numpy as np
+import openai
+import pytest
 
-from llm_math_education import embedding_utils
+from llm_math_education import embedding_cache, embedding_utils
 
 
 def test_get_token_counts():
@@ -16,7 +25,10 @@ def test_get_openai_embeddings(monkeypatch):
 
 
 def test_batch_embed_texts(monkeypatch):
-    monkeypatch.setattr("llm_math_education.embedding_utils.get_openai_embeddings", conftest.mock_get_openai_embeddings)
+    monkeypatch.setattr(
+        "llm_math_education.embedding_utils.request_openai_embeddings",
+        conftest.mock_get_openai_embeddings,
+    )
 
     max_tokens = embedding_utils.MAX_TOKENS_PER_REQUEST
     input_text_list = ["test"] * (max_tokens + 1)
@@ -26,3 +38,184 @@ def test_batch_embed_texts(monkeypatch):
     )
     assert len(embedding_list) == len(input_text_list)
     assert all(emb.shape[0] == embedding_utils.EMBEDDING_DIM for emb in embedding_list)
+
+
+def test_batch_embed_texts_batch_sizes(monkeypatch):
+    batches = []
+
+    def mock_get_openai_embeddings(input_text_list, *args, **kwargs):
+        batches.append(list(input_text_list))
+        return conftest.mock_get_openai_embeddings(input_text_list)
+
+    monkeypatch.setattr("llm_math_education.embedding_utils.request_openai_embeddings", mock_get_openai_embeddings)
+    max_tokens = embedding_utils.MAX_TOKENS_PER_REQUEST
+    n_tokens_list = [max_tokens // 2 + 1] * 4
+    embedding_list = embedding_utils.batch_embed_texts(["test"] * len(n_tokens_list), n_tokens_list)
+    assert len(embedding_list) == len(n_tokens_list)
+    # each batch stays under the token limit
+    assert [len(batch) for batch in batches] == [1, 1, 1, 1]
+
+
+def test_embedding_cache(tmp_path, monkeypatch):
+    requested_texts = []
+
+    def mock_get_openai_embeddings_cached(texts, *args, **kwargs):
+        requested_texts.extend(texts)
+        return conftest.mock_get_openai_embeddings(texts)
+
+    monkeypatch.setattr(
+        "llm_math_education.embedding_utils.get_openai_embeddings_cached",
+        mock_get_openai_embeddings_cached,
+    )
+    monkeypatch.setattr(
+        "llm_math_education.embedding_utils.request_openai_embeddings",
+        mock_get_openai_embeddings_cached,
+    )
+    monkeypatch.setattr("llm_math_education.embedding_utils.embedding_cache", None)
+    embedding_utils.set_embedding_cache(embedding_cache.EmbeddingCache.in_dir(tmp_path))
+
+    embedding_list = embedding_utils.get_openai_embeddings(["a", "b", "a"])
+    assert requested_texts == ["a", "b"]
+    assert np.array_equal(embedding_list[0], embedding_list[2])
+
+    # only the new text is sent to the API
+    requested_texts.clear()
+    new_embedding_list = embedding_utils.get_openai_embeddings(["b", "c"])
+    assert requested_texts == ["c"]
+    assert np.array_equal(new_embedding_list[0], embedding_list[1])
+
+    requested_texts.clear()
+    embedding_list = embedding_utils.batch_embed_texts(["a", "d", "c"], [1, 1, 1])
+    assert requested_texts == ["d"]
+    assert len(embedding_list) == 3
+
+    # batches are added to the cache, including those from a custom embed_func
+    requested_texts.clear()
+    embedding_list = embedding_utils.batch_embed_texts(["e"], [1], embed_func=conftest.mock_get_openai_embeddings)
+    assert np.array_equal(embedding_utils.get_openai_embeddings(["e", "d"])[0], embedding_list[0])
+    assert requested_texts == []
+
+    # the batch path reads the persistent cache once, rather than again for each batch
+    n_lookups = 0
+    get_embeddings = embedding_utils.embedding_cache.get_embeddings
+
+    def counting_get_embeddings(*args, **kwargs):
+        nonlocal n_lookups
+        n_lookups += 1
+        return get_embeddings(*args, **kwargs)
+
+    monkeypatch.setattr(embedding_utils.embedding_cache, "get_embeddings", counting_get_embeddings)
+    embedding_utils.batch_embed_texts(["f", "g"], [1, 1])
+    assert n_lookups == 1
+    assert requested_texts == ["f", "g"]
+
+
+def test_iterate_batch_embeddings(monkeypatch):
+    monkeypatch.setattr("llm_math_education.embedding_utils.INITIAL_BACKOFF_S", 0)
+    lock = threading.Lock()
+    n_in_flight = 0
+    max_n_in_flight = 0
+    n_calls = 0
+
+    def fake_embed_func(texts):
+        nonlocal n_in_flight, max_n_in_flight, n_calls
+        with lock:
+            n_calls += 1
+            if n_calls == 2:
+                raise openai.error.RateLimitError("Slow down.")
+            n_in_flight += 1
+            max_n_in_flight = max(max_n_in_flight, n_in_flight)
+        time.sleep(random.random() * 0.01)
+        with lock:
+            n_in_flight -= 1
+        return [np.full(3, int(text)) for text in texts]
+
+    max_tokens = embedding_utils.MAX_TOKENS_PER_REQUEST
+    input_text_list = [str(i) for i in range(20)]
+    n_tokens_list = [max_tokens // 3] * len(input_text_list)
+    batches = list(
+        embedding_utils.iterate_batch_embeddings(
+            input_text_list, n_tokens_list, max_in_flight=3, embed_func=fake_embed_func
+        ),
+    )
+    # batches are yielded in order, despite finishing out of order
+    assert [ind for inds, _ in batches for ind in inds] == list(range(len(input_text_list)))
+    assert all(len(inds) <= 3 for inds, _ in batches)
+    for inds, embeddings in batches:
+        assert [int(embedding[0]) for embedding in embeddings] == inds
+    assert 1 < max_n_in_flight <= 3
+    assert n_calls == len(batches) + 1, "Expected one retry."
+
+
+def test_call_with_retry():
+    def always_fails():
+        raise openai.error.APIConnectionError("No connection.")
+
+    with pytest.raises(openai.error.APIConnectionError):
+        embedding_utils.call_with_retry(always_fails, max_retries=2, initial_backoff_s=0)
+
+    # other errors are not retried
+    with pytest.raises(ValueError):
+        embedding_utils.call_with_retry(int, "not an int", initial_backoff_s=0)
+
+
+def test_get_token_counts_batch():
+    text_list = ["test", "A longer test text, with punctuation.", "", "Multiple\nlines\n\n"] * 5
+    tokenizer = embedding_utils.get_tokenizer()
+    assert tokenizer is embedding_utils.get_tokenizer()
+    expected_token_counts = [len(tokenizer.encode(text)) for text in text_list]
+    assert embedding_utils.get_token_counts(text_list) == expected_token_counts
+    assert embedding_utils.get_token_counts(text_list, n_processes=2) == expected_token_counts
+
+
+def test_aget_openai_embeddings(tmp_path, monkeypatch):
+    requested_texts = []
+
+    async def mock_acreate(input, engine):
+        requested_texts.extend(input)
+        embeddings = conftest.mock_get_openai_embeddings(input)
+        return openai.openai_object.OpenAIObject.construct_from(
+            {"data": [{"embedding": embedding.tolist()} for embedding in embeddings]},
+        )
+
+    monkeypatch.setattr("openai.Embedding.acreate", mock_acreate)
+    monkeypatch.setattr("llm_math_education.embedding_utils.embedding_cache", None)
+    monkeypatch.setattr("llm_math_education.embedding_utils.async_memory_cache", collections.OrderedDict())
+    embedding_list = asyncio.run(embedding_utils.aget_openai_embeddings(["a", "b", "a"]))
+    assert requested_texts == ["a", "b"]
+    assert len(embedding_list) == 3
+    assert embedding_list[0].shape == (embedding_utils.EMBEDDING_DIM,)
+    assert np.array_equal(embedding_list[0], embedding_list[2])
+
+    # recently embedded texts are kept in memory
+    requested_texts.clear()
+    assert np.array_equal(asyncio.run(embedding_utils.aget_openai_embeddings(["b"]))[0], embedding_list[1])
+    assert requested_texts == []
+    monkeypatch.setattr("llm_math_education.embedding_utils.ASYNC_MEMORY_CACHE_SIZE", 1)
+    asyncio.run(embedding_utils.aget_openai_embeddings(["d"]))
+    asyncio.run(embedding_utils.aget_openai_embeddings(["a"]))
+    assert requested_texts == ["d", "a"]
+    monkeypatch.setattr("llm_math_education.embedding_utils.ASYNC_MEMORY_CACHE_SIZE", 512)
+    requested_texts.clear()
+
+    # with a persistent cache, only the new text is sent to the API
+    embedding_utils.set_embedding_cache(embedding_cache.EmbeddingCache.in_dir(tmp_path))
+    asyncio.run(embedding_utils.aget_openai_embeddings(["a", "b"]))
+    requested_texts.clear()
+    embedding_list = asyncio.run(embedding_utils.aget_openai_embeddings(["b", "c"]))
+    assert requested_texts == ["c"]
+    assert len(embedding_list) == 2
+
+    # SQLite reads and writes run in worker threads, not on the event loop's thread
+    cache_thread_ids = []
+    for method_name in ["get_embeddings", "add_embeddings"]:
+        method = getattr(embedding_utils.embedding_cache, method_name)
+
+        def record_thread(*args, method=method):
+            cache_thread_ids.append(threading.get_ident())
+            return method(*args)
+
+        monkeypatch.setattr(embedding_utils.embedding_cache, method_name, record_thread)
+    asyncio.run(embedding_utils.aget_openai_embeddings(["e"]))
+    assert len(cache_thread_ids) == 2
+    assert threading.get_ident() not in cache_thread_ids
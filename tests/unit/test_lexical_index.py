@@ -0,0 +1,59 @@
+import numpy as np
+import pytest
+
+from llm_math_education import lexical_index
+
+
+def compute_bm25_scores(texts, query_str, k1=1.5, b=0.75):
+    # straightforward reference implementation
+    docs = [lexical_index.tokenize(text) for text in texts]
+    mean_doc_length = np.mean([len(doc) for doc in docs])
+    scores = np.zeros(len(docs))
+    for term in lexical_index.tokenize(query_str):
+        doc_freq = sum(term in doc for doc in docs)
+        if doc_freq == 0:
+            continue
+        idf = np.log(1 + (len(docs) - doc_freq + 0.5) / (doc_freq + 0.5))
+        for i, doc in enumerate(docs):
+            term_freq = doc.count(term)
+            scores[i] += idf * term_freq * (k1 + 1) / (term_freq + k1 * (1 - b + b * len(doc) / mean_doc_length))
+    return scores
+
+
+def test_tokenize():
+    assert lexical_index.tokenize("Find the LCM of 12 and 18.") == ["find", "the", "lcm", "of", "12", "and", "18"]
+
+
+def test_Bm25Index(tmp_path):
+    texts = [
+        "The least common multiple (LCM) of two numbers.",
+        "The greatest common factor, or GCF, of two numbers.",
+        "Adding fractions with a common denominator uses the LCM. LCM LCM.",
+        "",
+    ]
+    index = lexical_index.Bm25Index()
+    index.build(texts)
+    for query_str in ["LCM", "common factor", "What is the GCF of 12 and 18?", "unknown terms"]:
+        scores = index.compute_scores(query_str)
+        assert scores.shape == (len(texts),)
+        assert np.allclose(scores, compute_bm25_scores(texts, query_str), atol=1e-5)
+    scores = index.compute_scores("GCF")
+    assert np.argmax(scores) == 1
+    assert np.all(index.compute_scores("unknown") == 0)
+
+    filepath = tmp_path / "index.npz"
+    index.save(filepath)
+    loaded_index = lexical_index.Bm25Index()
+    loaded_index.load(filepath)
+    assert loaded_index.vocabulary == index.vocabulary
+    assert loaded_index.texts_fingerprint == lexical_index.get_texts_fingerprint(texts)
+    assert loaded_index.texts_fingerprint != lexical_index.get_texts_fingerprint(texts[::-1])
+    assert lexical_index.get_texts_fingerprint(["ab", "c"]) != lexical_index.get_texts_fingerprint(["a", "bc"])
+    assert np.array_equal(loaded_index.compute_scores("least common LCM"), index.compute_scores("least common LCM"))
+
+
+@pytest.mark.parametrize("texts", [[], ["", ""]])
+def test_Bm25Index_empty(texts):
+    index = lexical_index.Bm25Index()
+    index.build(texts)
+    assert np.all(index.compute_scores("query") == 0)
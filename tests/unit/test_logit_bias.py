@@ -1,3 +1,7 @@
+import collections
+
+import numpy as np
+
 from llm_math_education import logit_bias
 
 THE_TOKEN = 1820  # token for string "the"
@@ -16,6 +20,8 @@ def test_load_stopwords():
     assert stopword_tokens == logit_bias.get_stopword_tokens()
     # test caching
     assert logit_bias.get_stopword_tokens() == logit_bias.get_stopword_tokens()
+    # the binary resource matches the JSON resource it was created from
+    assert stopword_tokens == logit_bias.load_stopword_tokens_json()
 
 
 def test_get_nonstopword_tokens():
@@ -54,3 +60,92 @@ def test_create_stopword_token_set_from_word_list():
     stopword_tokens = logit_bias.create_stopword_token_set_from_word_list(word_list)
     assert len(stopword_tokens) > 1
     assert THE_TOKEN in stopword_tokens
+
+
+def test_nonstopword_token_table():
+    table = logit_bias.get_nonstopword_token_table()
+    assert table.dtype == bool
+    assert table.shape == (logit_bias.get_tokenizer().n_vocab,)
+    assert not table[THE_TOKEN]
+    # the shipped resource matches the current stopwords and tokenizer
+    assert np.array_equal(table, logit_bias.create_nonstopword_token_table())
+
+
+def test_get_nonstopword_tokens_matches_per_token_filter():
+    tokenizer = logit_bias.get_tokenizer()
+    stopword_tokens = logit_bias.get_stopword_tokens()
+    text = "The LCM of 12 and 18 is 36. Verily, the hypotenuse's length (in cm) is √2 ≈ 1.414; ¿qué?\n\tOsmogorp!"
+    expected_tokens = [
+        token for token in tokenizer.encode(text) if logit_bias.is_nonstopword_token(token, stopword_tokens)
+    ]
+    assert len(expected_tokens) > 0
+    assert logit_bias.get_nonstopword_tokens(text) == expected_tokens
+    assert logit_bias.get_nonstopword_tokens("") == []
+
+
+def get_counter_logit_bias(tokens, min_count=2, n_tokens=None, max_tokens=50, min_bias=1.0, max_bias=5.0):
+    # reference implementation, using collections.Counter
+    if len(tokens) == 0:
+        return {}
+    logit_bias_dict = {}
+    c = collections.Counter(tokens).most_common(max_tokens)
+    max_count = c[0][1]
+    if max_count >= min_count:
+        for token, count in c:
+            if count < min_count:
+                continue
+            logit_bias_dict[token] = min_bias + (max_bias - min_bias) * (count / max_count)
+            if n_tokens is not None and len(logit_bias_dict) >= n_tokens:
+                break
+    return logit_bias_dict
+
+
+def test_get_logit_bias_matches_counter():
+    rng = np.random.default_rng(0)
+    for _ in range(200):
+        tokens = rng.integers(0, rng.integers(1, 100), size=rng.integers(0, 300)).tolist()
+        kwargs = {
+            "min_count": int(rng.integers(1, 5)),
+            "n_tokens": [None, 0, 1, 10][rng.integers(0, 4)],
+            "max_tokens": int(rng.integers(1, 60)),
+        }
+        expected_logit_bias = get_counter_logit_bias(tokens, **kwargs)
+        logit_bias_dict = logit_bias.get_logit_bias(tokens, **kwargs)
+        assert list(logit_bias_dict.items()) == list(expected_logit_bias.items())
+        assert logit_bias.get_logit_bias(np.array(tokens, dtype=np.int32), **kwargs) == expected_logit_bias
+
+
+def test_get_logit_bias_from_slot_tokens():
+    recent_slot_fill_dict = [
+        {
+            "slot1": "verily verily verily",
+            "slot2": "the",
+        },
+        {
+            "slot3": "hypotenuse hypotenuse",
+        },
+    ]
+    slot_tokens = logit_bias.get_slot_tokens(recent_slot_fill_dict)
+    assert slot_tokens[0]["slot2"].tolist() == []
+    # tokenization is cached
+    assert logit_bias.get_slot_tokens(recent_slot_fill_dict)[0]["slot1"] is slot_tokens[0]["slot1"]
+    assert logit_bias.get_logit_bias_from_slot_tokens(slot_tokens) == logit_bias.get_logit_bias_from_slot(
+        recent_slot_fill_dict,
+    )
+    assert logit_bias.get_logit_bias_from_slot_tokens(
+        slot_tokens,
+        exclude=["slot3"],
+    ) == logit_bias.get_logit_bias_from_slot(recent_slot_fill_dict, exclude=["slot3"])
+    assert logit_bias.get_logit_bias_from_slot_tokens(slot_tokens, include=["slot2"]) == {}
+
+
+def test_get_ragged_nonstopword_tokens():
+    texts = ["The osmogorp verily eats.", "", "the was and were thus", "Another osmogorp text, with numbers 12."]
+    tokens, offsets = logit_bias.get_ragged_nonstopword_tokens(texts)
+    assert tokens.dtype == np.int32
+    assert len(offsets) == len(texts) + 1
+    for i, text in enumerate(texts):
+        assert tokens[offsets[i] : offsets[i + 1]].tolist() == logit_bias.get_nonstopword_tokens(text)
+    tokens, offsets = logit_bias.get_ragged_nonstopword_tokens([])
+    assert len(tokens) == 0
+    assert offsets.tolist() == [0]
@@ -1,8 +1,176 @@
+import hashlib
+import http.server
+import json
+import threading
+import time
+
 import pytest
+import requests
 
 from llm_math_education import openstax
 
 
+class FixtureRequestHandler(http.server.BaseHTTPRequestHandler):
+    """Serves the fixture pages in tests/resources/openstax_fixture, with ETag validation.
+
+    Paths in server.n_throttled are answered with 429 (and a Retry-After of server.retry_after) that many times.
+    """
+
+    def do_GET(self):
+        page_filepath = self.server.fixture_dir / (self.path.split("/")[-1] + ".html")
+        with self.server.lock:
+            self.server.request_paths.append(self.path)
+            is_throttled = self.server.n_throttled.get(self.path, 0) > 0
+            if is_throttled:
+                self.server.n_throttled[self.path] -= 1
+        if is_throttled:
+            self.send_response(429)
+            self.send_header("Retry-After", self.server.retry_after)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        if not page_filepath.exists():
+            self.send_error(404)
+            return
+        content = page_filepath.read_bytes()
+        etag = '"' + hashlib.md5(content).hexdigest() + '"'
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "text/html; charset=utf-8")
+        self.send_header("Content-Length", str(len(content)))
+        self.send_header("ETag", etag)
+        self.send_header("Last-Modified", "Mon, 02 Oct 2023 00:00:00 GMT")
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def fixture_server(pytestconfig):
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), FixtureRequestHandler)
+    server.fixture_dir = pytestconfig.rootpath / "tests" / "resources" / "openstax_fixture"
+    server.request_paths = []
+    server.n_throttled = {}
+    server.retry_after = "1"
+    server.lock = threading.Lock()
+    server_thread = threading.Thread(target=server.serve_forever, daemon=True)
+    server_thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def get_fixture_url(server) -> str:
+    return f"http://127.0.0.1:{server.server_address[1]}/books/fixture/pages/1-introduction"
+
+
+def test_cache_openstax_textbook_contents_local(fixture_server, tmp_path):
+    url = get_fixture_url(fixture_server)
+    textbook_data = openstax.cache_openstax_textbook_contents(url, tmp_path, requests_per_s=1000)
+    assert [chapter_data["href"] for chapter_data in textbook_data] == [
+        "1-1-introduction-to-whole-numbers",
+        "1-2-add-whole-numbers",
+        "1-key-terms",
+        "2-1-use-the-language-of-algebra",
+    ]
+    assert textbook_data[2]["section"] == "key_terms"
+    assert len(fixture_server.request_paths) == 5
+    df = openstax.get_subsection_dataframe(textbook_data)
+    assert len(df) == 6
+    assert df.title.iloc[0] == "Identify Counting Numbers and Whole Numbers"
+
+    with open(tmp_path / openstax.MANIFEST_FILENAME) as infile:
+        manifest = json.load(infile)
+    assert set(manifest.keys()) == {"intro.html", "part0.html", "part1.html", "part2.html", "part3.html"}
+    assert manifest["part3.html"]["url"].endswith("2-1-use-the-language-of-algebra")
+    assert manifest["part3.html"]["etag"] is not None
+
+    # cached pages are reused without any requests
+    openstax.cache_openstax_textbook_contents(url, tmp_path)
+    assert len(fixture_server.request_paths) == 5
+
+    # a missing part is resumed by fetching only that page
+    (tmp_path / "part1.html").unlink()
+    textbook_data = openstax.cache_openstax_textbook_contents(url, tmp_path, requests_per_s=1000)
+    assert fixture_server.request_paths[5:] == ["/books/fixture/pages/1-2-add-whole-numbers"]
+    assert len(openstax.get_subsection_dataframe(textbook_data)) == 6
+
+    # with overwrite, pages are re-requested conditionally, and unchanged pages are read from disk
+    part0_mtime = (tmp_path / "part0.html").stat().st_mtime
+    textbook_data = openstax.cache_openstax_textbook_contents(url, tmp_path, overwrite=True, requests_per_s=1000)
+    assert len(fixture_server.request_paths) == 11
+    assert (tmp_path / "part0.html").stat().st_mtime == part0_mtime
+    assert len(openstax.get_subsection_dataframe(textbook_data)) == 6
+
+
+def test_OpenStaxFetcher_fetch_all_error(fixture_server, tmp_path):
+    root_url = get_fixture_url(fixture_server).split("pages")[0] + "pages/"
+    fetcher = openstax.OpenStaxFetcher(tmp_path, max_workers=2, requests_per_s=1000, max_retries=0)
+    with pytest.raises(Exception):
+        fetcher.fetch_all(
+            [(root_url + "1-key-terms", "part0.html"), (root_url + "not-a-page", "part1.html")],
+        )
+    # the completed page is recorded, so a retry doesn't fetch it again
+    assert set(fetcher.load_manifest().keys()) == {"part0.html"}
+    assert not (tmp_path / "part1.html").exists()
+
+
+def test_OpenStaxFetcher_retry_after(fixture_server, tmp_path):
+    root_url = get_fixture_url(fixture_server).split("pages")[0] + "pages/"
+    fixture_server.n_throttled["/books/fixture/pages/1-key-terms"] = 1
+    fetcher = openstax.OpenStaxFetcher(tmp_path, max_workers=2, requests_per_s=1000)
+    start = time.monotonic()
+    html_docs = fetcher.fetch_all(
+        [(root_url + "1-key-terms", "part0.html"), (root_url + "1-2-add-whole-numbers", "part1.html")],
+    )
+    # the retry waits for the Retry-After through the shared rate limiter
+    assert time.monotonic() - start >= 0.9
+    assert len(fixture_server.request_paths) == 3
+    assert fixture_server.request_paths.count("/books/fixture/pages/1-key-terms") == 2
+    assert all(len(html_doc) > 0 for html_doc in html_docs)
+    assert set(fetcher.load_manifest().keys()) == {"part0.html", "part1.html"}
+
+    # once retries are exhausted, the error is raised
+    fixture_server.n_throttled["/books/fixture/pages/1-key-terms"] = 2
+    fixture_server.retry_after = "0"
+    fetcher = openstax.OpenStaxFetcher(tmp_path / "retry", requests_per_s=1000, max_retries=1)
+    with pytest.raises(Exception):
+        fetcher.fetch(root_url + "1-key-terms", "part0.html")
+    assert fixture_server.request_paths.count("/books/fixture/pages/1-key-terms") == 4
+
+
+def test_get_retry_after_s():
+    response = requests.Response()
+    assert openstax.get_retry_after_s(response) is None
+    response.headers["Retry-After"] = "2"
+    assert openstax.get_retry_after_s(response) == 2
+    response.headers["Retry-After"] = "Mon, 02 Oct 2023 00:00:00 GMT"
+    assert openstax.get_retry_after_s(response) == 0
+
+
+def test_TokenBucket():
+    rate_limiter = openstax.TokenBucket(rate=50)
+    start = time.monotonic()
+    for _ in range(6):
+        rate_limiter.acquire()
+    elapsed = time.monotonic() - start
+    # the first token is available immediately; each of the other 5 takes 1 / rate
+    assert elapsed >= 5 / 50 * 0.9
+
+    # a pause holds back the next acquire, even with a token available
+    rate_limiter = openstax.TokenBucket(rate=1000)
+    rate_limiter.pause(0.1)
+    start = time.monotonic()
+    rate_limiter.acquire()
+    assert time.monotonic() - start >= 0.1 * 0.9
+
+
 @pytest.mark.skip(reason="Long test (15s, even with caching), not on the core functionality path")
 def test_openstax(pytestconfig):
     cache_dir = pytestconfig.rootpath / "tests" / "resources" / "openstax_prealgebra"
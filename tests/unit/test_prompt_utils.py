@@ -1,4 +1,12 @@
-from llm_math_education import prompt_utils, retrieval_strategies
+import asyncio
+
+import pytest
+
+from llm_math_education import (
+    embedding_utils,
+    prompt_utils,
+    retrieval_strategies,
+)
 
 
 def test_conversion():
@@ -130,3 +138,191 @@ def test_user_query_replacement():
     assert len(messages) == 2
     assert messages[0]["content"] == "Question: "
     assert messages[1]["content"] == "Test"
+
+
+def test_PromptManager_token_counts():
+    def count_tokens(messages):
+        return sum(embedding_utils.get_token_counts([message["content"] for message in messages]))
+
+    test_intro_messages = [
+        {
+            "role": "system",
+            "content": "System prompt {slot1}",
+        },
+        {
+            "role": "user",
+            "content": "Question: {user_query}",
+        },
+    ]
+    retrieval_strategy = retrieval_strategies.StaticRetrievalStrategy("with a longer fill")
+    pm = prompt_utils.PromptManager().set_intro_messages(test_intro_messages).set_retrieval_strategy(retrieval_strategy)
+    assert pm.compute_stored_token_counts() == 0
+    assert pm.compute_stored_chat_token_count() == 0
+    messages = pm.build_query("What is 2 + 2?")
+    assert len(messages) == 2
+    assert len(pm.stored_messages) == 2
+    assert pm.compute_stored_token_counts() == count_tokens(pm.stored_messages)
+    pm.add_stored_message({"role": "assistant", "content": "4"})
+    pm.build_query("And 3 + 3?")
+    assert len(pm.stored_messages) == 4
+    assert pm.stored_token_counts == embedding_utils.get_token_counts([m["content"] for m in pm.stored_messages])
+    assert pm.compute_stored_token_counts() == count_tokens(pm.stored_messages)
+    # each message has 3 tokens of overhead plus 1 token for the role, and the reply is primed with 3 tokens
+    assert pm.compute_stored_chat_token_count() == count_tokens(pm.stored_messages) + 4 * 4 + 3
+
+    # direct modification of stored_messages is detected
+    pm.stored_messages.append({"role": "assistant", "content": "6"})
+    assert pm.compute_stored_token_counts() == count_tokens(pm.stored_messages)
+
+    pm.clear_stored_messages()
+    assert pm.compute_stored_token_counts() == 0
+    assert pm.stored_overhead_token_count == 0
+
+
+def test_PromptManager_token_counts_counted_once(monkeypatch):
+    test_intro_messages = [
+        {
+            "role": "system",
+            "content": "System",
+        },
+    ]
+    pm = prompt_utils.PromptManager().set_intro_messages(test_intro_messages)
+    pm.build_query("User")
+    pm.add_stored_message({"role": "assistant", "content": "Assistant"}).build_query("User2")
+    expected_token_count = pm.compute_stored_token_counts()
+
+    def fail(*args, **kwargs):
+        raise AssertionError("Unexpected re-tokenization.")
+
+    monkeypatch.setattr(embedding_utils, "get_token_counts", fail)
+    for _ in range(3):
+        pm.set_intro_messages(test_intro_messages)
+        assert pm.compute_stored_token_counts() == expected_token_count
+        pm.compute_stored_chat_token_count()
+
+
+def test_PromptManager_context_window():
+    test_intro_messages = [
+        {
+            "role": "system",
+            "content": "System prompt",
+        },
+    ]
+    pm = prompt_utils.PromptManager().set_intro_messages(test_intro_messages)
+    pm.set_context_window(60)
+    for i in range(10):
+        messages = pm.build_query(f"Question {i}: what is {i} + {i}?")
+        assert messages[0]["content"] == "System prompt"
+        assert messages[-1]["content"] == f"Question {i}: what is {i} + {i}?"
+        message_token_counts = embedding_utils.get_token_counts([message["content"] for message in messages])
+        total_token_count = sum(message_token_counts) + 4 * len(messages) + prompt_utils.TOKENS_PER_REPLY
+        assert total_token_count <= 60
+        pm.add_stored_message({"role": "assistant", "content": f"The answer is {i * 2}."})
+    assert len(pm.stored_messages) == 21
+    assert len(messages) < len(pm.stored_messages) - 1
+    # only the most recent messages are retained
+    assert messages[1:] == pm.stored_messages[pm.context_window_start : -1]
+
+    # the window start only moves forward
+    window_start = pm.context_window_start
+    pm.build_query("Another question")
+    assert pm.context_window_start >= window_start
+
+    pm.clear_stored_messages()
+    messages = pm.build_query("New conversation")
+    assert len(messages) == 2
+
+
+def test_PromptManager_context_window_summary():
+    summarizer_calls = []
+
+    def summarizer(evicted_messages, previous_summary):
+        summarizer_calls.append(evicted_messages)
+        n_previous = 0 if previous_summary is None else int(previous_summary.split()[0])
+        return f"{n_previous + len(evicted_messages)} messages"
+
+    test_intro_messages = [
+        {
+            "role": "system",
+            "content": "System prompt",
+        },
+    ]
+    pm = prompt_utils.PromptManager().set_intro_messages(test_intro_messages).set_context_window(80, summarizer)
+    for i in range(10):
+        messages = pm.build_query(f"Question {i}: what is {i} + {i}?")
+        pm.add_stored_message({"role": "assistant", "content": f"The answer is {i * 2}."})
+    assert len(summarizer_calls) > 0
+    assert messages[1]["role"] == "system"
+    assert messages[1]["content"].startswith(prompt_utils.CONTEXT_SUMMARY_PREFIX)
+    # each evicted message is summarized exactly once
+    n_evicted = sum(len(evicted_messages) for evicted_messages in summarizer_calls)
+    assert n_evicted == pm.context_window_start - 1
+    assert messages[1]["content"] == prompt_utils.CONTEXT_SUMMARY_PREFIX + f"{n_evicted} messages"
+    assert messages[2:] == pm.stored_messages[pm.context_window_start : -1]
+
+
+def test_PromptTemplate():
+    for template_string, slot_fill_dict in [
+        ("No slots", {}),
+        ("test {test1} {test2} {test1}", {"test1": "A", "test2": "B"}),
+        ("{test1}", {"test1": "A"}),
+        ("Escaped {{braces}} and {slot}", {"slot": "fill"}),
+        ("Format spec {value:>5} {value!r}", {"value": "x"}),
+        ("Attribute {value.real}", {"value": 3}),
+    ]:
+        template = prompt_utils.PromptTemplate(template_string)
+        assert template.slots == prompt_utils.PromptManager.identify_slots(template_string)
+        assert template.render(slot_fill_dict) == template_string.format(**slot_fill_dict)
+    with pytest.raises(KeyError):
+        prompt_utils.PromptTemplate("{slot1} {slot2}").render({"slot1": "A"})
+    with pytest.raises(ValueError):
+        prompt_utils.PromptTemplate("Unbalanced {slot1} }").render({"slot1": "A"})
+
+    assert prompt_utils.get_prompt_template("test {test1}") is prompt_utils.get_prompt_template("test {test1}")
+
+
+def test_PromptManager_parses_templates_once(monkeypatch):
+    test_intro_messages = [
+        {
+            "role": "system",
+            "content": "Test {slot1}",
+        },
+    ]
+    retrieval_strategy = retrieval_strategies.StaticRetrievalStrategy("Fill")
+    pm = prompt_utils.PromptManager().set_intro_messages(test_intro_messages).set_retrieval_strategy(retrieval_strategy)
+    prompt_utils.get_prompt_template.cache_clear()
+    for i in range(30):
+        pm.clear_stored_messages()
+        messages = pm.build_query(f"User {i}")
+        assert messages[0]["content"] == "Test Fill"
+    # one parse for the intro message, plus one per distinct user message
+    assert prompt_utils.get_prompt_template.cache_info().misses == 1 + 30
+
+
+def test_PromptManager_abuild_query():
+    test_intro_messages = [
+        {
+            "role": "system",
+            "content": "Test {slot1} {slot2}",
+        },
+        {
+            "role": "user",
+            "content": "Question: {user_query}",
+        },
+    ]
+    retrieval_strategy = retrieval_strategies.StaticRetrievalStrategy("Fill")
+    pm = prompt_utils.PromptManager().set_intro_messages(test_intro_messages).set_retrieval_strategy(retrieval_strategy)
+    expected_messages = pm.build_query("User")
+    pm.add_stored_message({"role": "assistant", "content": "Assistant"})
+    expected_continued_messages = pm.build_query("User2")
+
+    apm = (
+        prompt_utils.PromptManager().set_intro_messages(test_intro_messages).set_retrieval_strategy(retrieval_strategy)
+    )
+    messages = asyncio.run(apm.abuild_query("User"))
+    assert messages == expected_messages
+    assert messages[1]["content"] == "Question: User"
+    apm.add_stored_message({"role": "assistant", "content": "Assistant"})
+    assert asyncio.run(apm.abuild_query("User2")) == expected_continued_messages
+    assert apm.stored_messages == pm.stored_messages
+    assert apm.compute_stored_token_counts() == pm.compute_stored_token_counts()
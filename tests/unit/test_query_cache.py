@@ -0,0 +1,63 @@
+import numpy as np
+import pytest
+
+from llm_math_education import query_cache
+
+
+def test_SemanticQueryCache():
+    cache = query_cache.SemanticQueryCache(max_entries=2, similarity_threshold=0.9, embedding_dim=3)
+    assert cache.get(("a",)) is None
+    cache.add(("a",), "A", np.array([1.0, 0, 0]))
+    cache.add(("b",), "B", np.array([0, 1.0, 0]))
+    assert cache.get(("a",)) == "A"
+    # near-duplicate embeddings
+    assert cache.get_similar(np.array([1.0, 0.1, 0]), lambda key: True) == "A"
+    assert cache.get_similar(np.array([0.1, 2.0, 0]), lambda key: True) == "B"
+    assert cache.get_similar(np.array([0.1, 2.0, 0]), lambda key: key != ("b",)) is None
+    assert cache.get_similar(np.array([1.0, 1.0, 0]), lambda key: True) is None
+
+    # least recently used entry is evicted
+    cache.get(("a",))
+    cache.add(("c",), "C")
+    assert len(cache) == 2
+    assert cache.get(("b",)) is None
+    assert cache.get_similar(np.array([0, 1.0, 0]), lambda key: True) is None
+    assert cache.get(("a",)) == "A"
+    assert cache.get(("c",)) == "C"
+    # the evicted entry's embedding row is reused
+    cache.add(("d",), "D", np.array([0, 0, 1.0]))
+    assert cache.get_similar(np.array([0, 0, 1.0]), lambda key: True) == "D"
+
+    stats = cache.get_stats()
+    assert stats["exact_hits"] == 4
+    assert stats["similar_hits"] == 3
+    assert stats["misses"] == 3
+    assert stats["evictions"] == 2
+    assert stats["hit_rate"] == 7 / 10
+
+    cache.clear()
+    assert len(cache) == 0
+    assert len(cache.free_rows) == 2
+
+
+def test_SemanticQueryCache_max_entries():
+    with pytest.raises(ValueError):
+        query_cache.SemanticQueryCache(max_entries=0)
+    cache = query_cache.SemanticQueryCache(max_entries=1, embedding_dim=2)
+    cache.add(("a",), "A", np.array([1.0, 0.0]))
+    cache.add(("b",), "B", np.array([0.0, 1.0]))
+    assert cache.get(("a",)) is None
+    assert cache.get(("b",)) == "B"
+
+
+def test_SemanticQueryCache_ttl(monkeypatch):
+    current_time = [0.0]
+    monkeypatch.setattr("llm_math_education.query_cache.time.monotonic", lambda: current_time[0])
+    cache = query_cache.SemanticQueryCache(max_entries=2, ttl_s=10, embedding_dim=3)
+    cache.add(("a",), "A", np.array([1.0, 0, 0]))
+    current_time[0] = 5
+    assert cache.get(("a",)) == "A"
+    current_time[0] = 11
+    assert cache.get(("a",)) is None
+    assert cache.get_similar(np.array([1.0, 0, 0]), lambda key: True) is None
+    assert len(cache) == 0
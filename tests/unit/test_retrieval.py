@@ -1,10 +1,17 @@
+import pickle
 import re
 
 import numpy as np
 import pandas as pd
 import pytest
+import scipy
 
-from llm_math_education import embedding_utils, retrieval
+from llm_math_education import (
+    embedding_cache,
+    embedding_utils,
+    logit_bias,
+    retrieval,
+)
 
 
 def mock_get_openai_embeddings(input_text_list, *args, **kwargs):
@@ -13,6 +20,7 @@ def mock_get_openai_embeddings(input_text_list, *args, **kwargs):
 
 def test_RetrievalDb(tmp_path, monkeypatch):
     monkeypatch.setattr("llm_math_education.embedding_utils.get_openai_embeddings", mock_get_openai_embeddings)
+    monkeypatch.setattr("llm_math_education.embedding_utils.request_openai_embeddings", mock_get_openai_embeddings)
 
     df = pd.DataFrame(
         [
@@ -119,3 +127,330 @@ def test_DbInfo_get_parent_text(retrieval_db):
     token_budget = db_info.db.df[db_info.db.n_tokens_col].iloc[0:1].sum()
     text, n_tokens, used_inds = db_info.get_parent_text(0, token_budget)
     assert len(used_inds - {0, 1}) == 0
+
+
+def test_get_top_k_indices():
+    distances = np.array([0.5, 0.1, 0.9, 0.3, 0.7])
+    assert list(retrieval.get_top_k_indices(distances, 2)) == [1, 3]
+    assert list(retrieval.get_top_k_indices(distances, 10)) == list(np.argsort(distances))
+    assert len(retrieval.get_top_k_indices(distances, 0)) == 0
+
+    # 2D distances produce one row of indices per query
+    top_k_indices = retrieval.get_top_k_indices(np.stack([distances, -distances]), 2)
+    assert top_k_indices.tolist() == [[1, 3], [2, 4]]
+
+
+def test_iterate_distance_sort_indices():
+    rng = np.random.default_rng(0)
+    distances = rng.random(100)
+    sort_inds = list(retrieval.iterate_distance_sort_indices(distances, initial_k=3))
+    assert sort_inds == list(np.argsort(distances))
+
+    # ties across the growing partition boundary are neither dropped nor duplicated
+    distances = np.array([1, 0, 1, 0, 1, 1, 0, 1])
+    sort_inds = list(retrieval.iterate_distance_sort_indices(distances, initial_k=2))
+    assert sorted(sort_inds) == list(range(len(distances)))
+    assert list(distances[sort_inds]) == sorted(distances)
+
+
+def test_RetrievalDb_compute_embedding_distances(retrieval_db):
+    normalized_embedding_mat = retrieval_db.normalized_embedding_mat
+    assert normalized_embedding_mat.dtype == np.float32
+    assert normalized_embedding_mat.flags["C_CONTIGUOUS"]
+    assert np.allclose(np.linalg.norm(normalized_embedding_mat, axis=1), 1)
+
+    # distances keep the meaning of scipy's cosine distance
+    query_embedding = np.random.random(size=embedding_utils.EMBEDDING_DIM)
+    expected_distances = scipy.spatial.distance.cdist(
+        query_embedding.reshape(1, -1),
+        retrieval_db.embedding_mat,
+        metric="cosine",
+    )[0]
+    distances = retrieval_db.compute_embedding_distances(query_embedding)
+    assert distances.shape == expected_distances.shape
+    assert np.allclose(distances, expected_distances, atol=1e-5)
+    assert np.allclose(retrieval_db.compute_embedding_distances(query_embedding.reshape(1, -1)), distances)
+
+
+def test_RetrievalDb_mmap_mode(retrieval_db_path, retrieval_db):
+    query_embedding = np.random.random(size=embedding_utils.EMBEDDING_DIM)
+    expected_distances = retrieval_db.compute_embedding_distances(query_embedding)
+
+    db = retrieval.RetrievalDb(retrieval_db_path, "conftestDb", "text", mmap_mode="r")
+    assert isinstance(db.embedding_mat, np.memmap)
+    assert isinstance(db.normalized_embedding_mat, np.memmap)
+    assert np.allclose(db.compute_embedding_distances(query_embedding), expected_distances)
+
+    # pickling (e.g. by st.cache_data) re-maps the files rather than copying the matrices
+    db = pickle.loads(pickle.dumps(db))
+    assert isinstance(db.embedding_mat, np.memmap)
+    assert np.allclose(db.compute_embedding_distances(query_embedding), expected_distances)
+
+    # float32 on-disk format, without a saved search matrix: it is saved on load, so it can be mapped
+    db.normalized_embedding_filepath.unlink()
+    np.save(db.embedding_filepath, retrieval_db.embedding_mat.astype(np.float32))
+    db = retrieval.RetrievalDb(retrieval_db_path, "conftestDb", "text", mmap_mode="r")
+    assert db.embedding_mat.dtype == np.float32
+    assert isinstance(db.embedding_mat, np.memmap)
+    assert db.is_current(db.normalized_embedding_filepath)
+    assert isinstance(db.normalized_embedding_mat, np.memmap)
+    assert np.allclose(db.compute_embedding_distances(query_embedding), expected_distances, atol=1e-5)
+    normalized_mtime = db.normalized_embedding_filepath.stat().st_mtime
+    db = pickle.loads(pickle.dumps(db))
+    assert isinstance(db.normalized_embedding_mat, np.memmap)
+    assert db.normalized_embedding_filepath.stat().st_mtime == normalized_mtime
+
+
+def test_RetrievalDb_embedding_mat_not_resident(retrieval_db_path, retrieval_db):
+    # by default, only the float32 search matrix is read into memory; the raw matrix is mapped on access
+    db = retrieval.RetrievalDb(retrieval_db_path, "conftestDb", "text")
+    assert db._embedding_mat is None
+    assert not isinstance(db.normalized_embedding_mat, np.memmap)
+    assert db.normalized_embedding_mat.dtype == np.float32
+    assert isinstance(db.embedding_mat, np.memmap)
+    assert db.embedding_mat.dtype == np.float64
+    assert np.array_equal(db.embedding_mat, retrieval_db.embedding_mat)
+
+    # pickles carry the search matrix but not the raw matrix
+    db = pickle.loads(pickle.dumps(db))
+    assert db._embedding_mat is None
+    assert db.embedding_mat.shape == retrieval_db.embedding_mat.shape
+
+    new_db = retrieval.RetrievalDb(retrieval_db_path, "newDb", "text", db.df)
+    with pytest.raises(AttributeError):
+        new_db.embedding_mat
+
+
+def test_RetrievalDb_batch_search(retrieval_db, monkeypatch):
+    monkeypatch.setattr("llm_math_education.embedding_utils.get_openai_embeddings", mock_get_openai_embeddings)
+    monkeypatch.setattr("llm_math_education.embedding_utils.request_openai_embeddings", mock_get_openai_embeddings)
+    n_texts = len(retrieval_db.df)
+    query_embeddings = np.random.random(size=(5, embedding_utils.EMBEDDING_DIM))
+    top_k_indices, top_k_distances = retrieval_db.batch_search(query_embeddings, k=2, query_chunk_size=2)
+    assert top_k_indices.shape == (5, 2)
+    assert top_k_distances.shape == (5, 2)
+    for query_embedding, indices, distances in zip(query_embeddings, top_k_indices, top_k_distances):
+        expected_distances = retrieval_db.compute_embedding_distances(query_embedding)
+        assert list(indices) == list(np.argsort(expected_distances)[:2])
+        assert np.allclose(distances, expected_distances[indices])
+
+    # k is capped at the number of texts
+    top_k_indices, _ = retrieval_db.batch_search(query_embeddings, k=n_texts + 1)
+    assert top_k_indices.shape == (5, n_texts)
+
+    top_k_indices, top_k_distances = retrieval_db.batch_search(["Query 1", "Query 2\n", "Query 3"], k=1)
+    assert top_k_indices.shape == (3, 1)
+
+
+def test_ParentGroupIndex(retrieval_db):
+    n_tokens = retrieval_db.df[retrieval_db.n_tokens_col]
+    parent_group_index = retrieval.ParentGroupIndex(retrieval_db, ["group_var"], ["group_var", "categorical_var"])
+    rows, total_tokens = parent_group_index.get_parent_rows(1, 1000)
+    assert rows.tolist() == [0, 1]
+    assert total_tokens == n_tokens.iloc[:2].sum()
+    # only the row itself and the rows before it are included when the whole group doesn't fit
+    rows, total_tokens = parent_group_index.get_parent_rows(1, n_tokens.iloc[1])
+    assert rows.tolist() == [1]
+    assert parent_group_index.get_parent_rows(2, 0) is None
+
+    # without group columns, the whole db is one group
+    parent_group_index = retrieval.ParentGroupIndex(retrieval_db, [], [])
+    rows, _ = parent_group_index.get_parent_rows(2, 1000)
+    assert rows.tolist() == [0, 1, 2]
+
+
+def test_DbInfo_get_parent_text_budget(retrieval_db):
+    # retrieval stops, rather than failing, once a parent text no longer fits the budget
+    max_tokens = retrieval_db.df[retrieval_db.n_tokens_col].iloc[:2].sum()
+    db_info = retrieval.DbInfo(
+        retrieval_db, max_tokens=max_tokens, use_parent_text=True, parent_group_cols=["group_var"]
+    )
+    fill_string = db_info.get_fill_string_from_distances(np.array([0, 1, 2]))
+    assert fill_string == "\n".join(retrieval_db.df[retrieval_db.embed_col].iloc[:2])
+
+
+def test_RetrievalDb_get_top_indices_within_budget(retrieval_db):
+    assert retrieval_db.texts == retrieval_db.df[retrieval_db.embed_col].tolist()
+    assert list(retrieval_db.n_tokens) == retrieval_db.df[retrieval_db.n_tokens_col].tolist()
+
+    distances = np.array([0.2, 0.1, 0.3])
+    n_tokens = retrieval_db.n_tokens
+    inds = retrieval_db.get_top_indices_within_budget(distances, max_tokens=1000)
+    assert list(inds) == [1, 0, 2]
+    inds = retrieval_db.get_top_indices_within_budget(distances, max_tokens=1000, max_texts=2)
+    assert list(inds) == [1, 0]
+    inds = retrieval_db.get_top_indices_within_budget(distances, max_tokens=n_tokens[1] + n_tokens[0])
+    assert list(inds) == [1, 0]
+    inds = retrieval_db.get_top_indices_within_budget(distances, max_tokens=n_tokens[1] - 1)
+    assert len(inds) == 0
+
+
+def test_RetrievalDb_create_embeddings_concurrent(tmp_path, monkeypatch):
+    monkeypatch.setattr("llm_math_education.embedding_utils.get_openai_embeddings", mock_get_openai_embeddings)
+    monkeypatch.setattr("llm_math_education.embedding_utils.request_openai_embeddings", mock_get_openai_embeddings)
+    df = pd.DataFrame(
+        [{"text": f"Test text {i}.", "n_tokens": embedding_utils.MAX_TOKENS_PER_REQUEST // 2} for i in range(7)]
+    )
+    db = retrieval.RetrievalDb(tmp_path, "testDb", "text", df)
+    db.create_embeddings(dtype=np.float32, max_in_flight=3)
+    assert db.embedding_mat.shape == (len(df), embedding_utils.EMBEDDING_DIM)
+    assert db.embedding_mat.dtype == np.float32
+    assert np.array_equal(np.load(db.embedding_filepath), db.embedding_mat)
+    # every row was written
+    assert (np.abs(db.embedding_mat).sum(axis=1) > 0).all()
+
+
+def test_RetrievalDb_get_lexical_index(retrieval_db_path, retrieval_db):
+    assert not retrieval_db.lexical_index_filepath.exists()
+    scores = retrieval_db.compute_lexical_scores("text 2")
+    assert scores.shape == (len(retrieval_db.texts),)
+    assert np.argmax(scores) == 1
+    # saved next to the parquet file, and loaded by later instances
+    assert retrieval_db.lexical_index_filepath.exists()
+    db = retrieval.RetrievalDb(retrieval_db_path, "conftestDb", "text")
+    lexical_index = db.get_lexical_index()
+    assert lexical_index.vocabulary == retrieval_db.lexical_index.vocabulary
+    assert np.array_equal(db.compute_lexical_scores("text 2"), scores)
+
+    # a df that differs from the parquet file (same row count, so row ids would silently mismatch) rebuilds the index
+    index_mtime = db.lexical_index_filepath.stat().st_mtime
+    df = db.df.copy()
+    df["text"] = ["Test text 2.", "Test text 3.", "Test text 1."]
+    db = retrieval.RetrievalDb(retrieval_db_path, "conftestDb", "text", df)
+    assert np.argmax(db.compute_lexical_scores("text 2")) == 0
+    db.df["text"] = ["Other 1.", "Other 2.", "Test text 2."]
+    db.prepare_columns()
+    assert np.argmax(db.compute_lexical_scores("text 2")) == 2
+    # without overwriting the index saved for the parquet file, which is still reused
+    assert db.lexical_index_filepath.stat().st_mtime == index_mtime
+    db = retrieval.RetrievalDb(retrieval_db_path, "conftestDb", "text")
+    assert np.array_equal(db.compute_lexical_scores("text 2"), scores)
+
+
+def test_DbInfo_get_fill_string_from_query_embedding(retrieval_db, monkeypatch):
+    n_searches = [0]
+    compute_embedding_distances = retrieval_db.compute_embedding_distances
+
+    def counting_compute_embedding_distances(query_embedding):
+        n_searches[0] += 1
+        return compute_embedding_distances(query_embedding)
+
+    monkeypatch.setattr(retrieval_db, "compute_embedding_distances", counting_compute_embedding_distances)
+    query_embedding = retrieval_db.embedding_mat[1]
+    db_info = retrieval.DbInfo(retrieval_db, max_tokens=5, fill_memo_size=2)
+    fill_string = db_info.get_fill_string_from_query_embedding(query_embedding)
+    assert fill_string == db_info.get_fill_string_from_distances(compute_embedding_distances(query_embedding))
+    assert db_info.get_fill_string_from_query_embedding(query_embedding.copy()) == fill_string
+    assert n_searches[0] == 1
+
+    # a different query, or modified settings, are not memoized
+    db_info.get_fill_string_from_query_embedding(retrieval_db.embedding_mat[0])
+    assert n_searches[0] == 2
+    db_info.prefix = "Prefix: "
+    assert db_info.get_fill_string_from_query_embedding(query_embedding) == "Prefix: " + fill_string
+    assert n_searches[0] == 3
+    assert len(db_info.fill_memo) == 2
+
+    # copies have their own memo
+    db_info_copy = db_info.copy(max_tokens=1000)
+    assert len(db_info_copy.get_fill_string_from_query_embedding(query_embedding)) > len("Prefix: " + fill_string)
+    assert n_searches[0] == 4
+
+    # reloading the db invalidates the memo
+    retrieval_db.load()
+    db_info.get_fill_string_from_query_embedding(query_embedding)
+    assert n_searches[0] == 5
+
+    # the memo isn't pickled
+    monkeypatch.undo()
+    unpickled_db_info = pickle.loads(pickle.dumps(db_info))
+    assert len(unpickled_db_info.fill_memo) == 0
+    assert unpickled_db_info.get_fill_string_from_query_embedding(query_embedding) == "Prefix: " + fill_string
+
+
+def test_DbInfo_parent_group_index_reload(retrieval_db):
+    db_info = retrieval.DbInfo(retrieval_db, use_parent_text=True, parent_group_cols=["group_var"])
+    assert db_info.get_parent_text(0, 1000)[2] == {0, 1}
+    retrieval_db.df["group_var"] = [1, 2, 2]
+    retrieval_db.prepare_columns()
+    assert db_info.get_parent_text(0, 1000)[2] == {0}
+
+
+def test_RetrievalDb_get_nonstopword_token_arrays(retrieval_db_path, retrieval_db):
+    assert not retrieval_db.token_array_filepath.exists()
+    tokens, offsets = retrieval_db.get_nonstopword_token_arrays()
+    assert len(offsets) == len(retrieval_db.texts) + 1
+    for i, text in enumerate(retrieval_db.texts):
+        assert tokens[offsets[i] : offsets[i + 1]].tolist() == logit_bias.get_nonstopword_tokens(text)
+    assert retrieval_db.get_rows_nonstopword_tokens(np.array([2, 0])).tolist() == (
+        logit_bias.get_nonstopword_tokens(retrieval_db.texts[2])
+        + logit_bias.get_nonstopword_tokens(retrieval_db.texts[0])
+    )
+    assert len(retrieval_db.get_rows_nonstopword_tokens(np.array([], dtype=int))) == 0
+    # saved next to the parquet file, and loaded by later instances
+    assert retrieval_db.token_array_filepath.exists()
+    db = retrieval.RetrievalDb(retrieval_db_path, "conftestDb", "text")
+    loaded_tokens, loaded_offsets = db.get_nonstopword_token_arrays()
+    assert np.array_equal(loaded_tokens, tokens)
+    assert np.array_equal(loaded_offsets, offsets)
+
+    # a changed text with the same row count isn't given the saved arrays, nor overwrites them
+    token_array_mtime = db.token_array_filepath.stat().st_mtime
+    df = db.df.copy()
+    df.loc[1, "text"] = "Osmogorp verily."
+    db = retrieval.RetrievalDb(retrieval_db_path, "conftestDb", "text", df)
+    changed_tokens, changed_offsets = db.get_nonstopword_token_arrays()
+    assert len(changed_offsets) == len(offsets)
+    assert db.get_rows_nonstopword_tokens(np.array([1])).tolist() == logit_bias.get_nonstopword_tokens(
+        "Osmogorp verily."
+    )
+    assert db.token_array_filepath.stat().st_mtime == token_array_mtime
+    db = retrieval.RetrievalDb(retrieval_db_path, "conftestDb", "text")
+    assert np.array_equal(db.get_nonstopword_token_arrays()[0], tokens)
+
+
+def test_DbInfo_get_fill_nonstopword_tokens(retrieval_db):
+    db_info = retrieval.DbInfo(retrieval_db, prefix="Osmogorp texts:\n")
+    query_embedding = retrieval_db.embedding_mat[1]
+    fill_string = db_info.get_fill_string_from_query_embedding(query_embedding)
+    tokens = db_info.get_fill_nonstopword_tokens(fill_string)
+    assert sorted(tokens.tolist()) == sorted(logit_bias.get_nonstopword_tokens(fill_string))
+    assert db_info.get_fill_nonstopword_tokens("Not a fill string.") is None
+    slot_tokens = logit_bias.get_slot_tokens([{"texts": fill_string}], slot_map={"texts": db_info})
+    assert np.array_equal(slot_tokens[0]["texts"], tokens)
+
+    parent_db_info = retrieval.DbInfo(
+        retrieval_db,
+        use_parent_text=True,
+        parent_group_cols=["group_var"],
+        parent_sort_cols=["categorical_var"],
+    )
+    fill_string = parent_db_info.get_fill_string_from_distances(
+        retrieval_db.compute_embedding_distances(query_embedding)
+    )
+    tokens = parent_db_info.get_fill_nonstopword_tokens(fill_string)
+    assert sorted(tokens.tolist()) == sorted(logit_bias.get_nonstopword_tokens(fill_string))
+    parent_db_info.clear_fill_memo()
+    assert parent_db_info.get_fill_nonstopword_tokens(fill_string) is None
+
+
+def test_RetrievalDb_embedding_model(tmp_path, monkeypatch):
+    requested_models = []
+
+    def mock_request_openai_embeddings(input_text_list, embedding_model=embedding_utils.EMBEDDING_MODEL):
+        requested_models.append(embedding_model)
+        return mock_get_openai_embeddings(input_text_list)
+
+    monkeypatch.setattr("llm_math_education.embedding_utils.request_openai_embeddings", mock_request_openai_embeddings)
+    monkeypatch.setattr("llm_math_education.embedding_utils.embedding_cache", None)
+    embedding_utils.set_embedding_cache(embedding_cache.EmbeddingCache.in_dir(tmp_path))
+    df = pd.DataFrame([{"text": "Test text 1."}, {"text": "Test text 2."}])
+    db = retrieval.RetrievalDb(tmp_path, "testDb", "text", df, embedding_model="other-embedding-model")
+    db.create_embeddings()
+    db.batch_search(["Query 1", "Query 2"], k=1)
+    db.compute_query_embedding("Query 3")
+    assert requested_models == ["other-embedding-model"] * 3
+    # cached under the db's model, not the default
+    cache = embedding_utils.embedding_cache
+    assert all(embedding is not None for embedding in cache.get_embeddings(db.texts, "other-embedding-model"))
+    assert all(embedding is None for embedding in cache.get_embeddings(db.texts, embedding_utils.EMBEDDING_MODEL))
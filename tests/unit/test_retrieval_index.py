@@ -0,0 +1,194 @@
+import pickle
+
+import numpy as np
+import pytest
+
+from llm_math_education import retrieval, retrieval_index
+
+
+@pytest.fixture
+def clustered_embedding_mat() -> np.array:
+    rng = np.random.default_rng(0)
+    centers = rng.normal(size=(10, 32))
+    mat = np.concatenate([center + 0.1 * rng.normal(size=(50, 32)) for center in centers])
+    return retrieval.normalize_embeddings(mat)
+
+
+def get_recall(index, normalized_embedding_mat, query_embeddings, k=10):
+    exact = retrieval_index.BruteForceIndex().compute_distances(query_embeddings, normalized_embedding_mat)
+    approximate = index.compute_distances(query_embeddings, normalized_embedding_mat)
+    exact_top_k = retrieval.get_top_k_indices(exact, k)
+    approximate_top_k = retrieval.get_top_k_indices(approximate, k)
+    n_found = sum(len(set(e) & set(a)) for e, a in zip(exact_top_k, approximate_top_k))
+    return n_found / exact_top_k.size
+
+
+def test_kmeans(clustered_embedding_mat):
+    centroids = retrieval_index.kmeans(clustered_embedding_mat, 10, spherical=True)
+    assert centroids.shape == (10, clustered_embedding_mat.shape[1])
+    assert np.allclose(np.linalg.norm(centroids, axis=1), 1, atol=1e-5)
+    assignments = retrieval_index.assign_to_centroids(clustered_embedding_mat, centroids, spherical=True)
+    assert len(np.unique(assignments)) == 10
+
+
+def test_IvfIndex(clustered_embedding_mat, tmp_path):
+    query_embeddings = clustered_embedding_mat[::25]
+    index = retrieval_index.IvfIndex(n_lists=10, n_probe=10)
+    index.build(clustered_embedding_mat)
+    # probing every list is exact search
+    assert get_recall(index, clustered_embedding_mat, query_embeddings) == 1
+
+    index.n_probe = 1
+    distances = index.compute_distances(query_embeddings, clustered_embedding_mat)
+    assert distances.shape == (len(query_embeddings), len(clustered_embedding_mat))
+    assert np.isinf(distances).any(), "Expected some rows to be skipped."
+    assert get_recall(index, clustered_embedding_mat, query_embeddings) >= 0.9
+
+    index_filepath = tmp_path / "index.npz"
+    index.save(index_filepath)
+    loaded_index = retrieval_index.IvfIndex(n_probe=1)
+    loaded_index.load(index_filepath)
+    assert np.array_equal(
+        loaded_index.compute_distances(query_embeddings, clustered_embedding_mat),
+        distances,
+    )
+
+
+@pytest.mark.parametrize("index_class", [retrieval_index.IvfIndex, retrieval_index.IvfPqIndex])
+def test_IvfIndex_small(clustered_embedding_mat, index_class):
+    query_embeddings = clustered_embedding_mat[:2]
+    # an empty index scores nothing
+    index = index_class(n_subvectors=8) if index_class is retrieval_index.IvfPqIndex else index_class()
+    index.build(clustered_embedding_mat[:0])
+    assert index.compute_distances(query_embeddings, clustered_embedding_mat[:0]).shape == (2, 0)
+
+    # n_lists and n_probe are clamped to the number of rows
+    mat = clustered_embedding_mat[:3]
+    for n_probe in [0, 20]:
+        kwargs = {"n_lists": 10, "n_probe": n_probe}
+        if index_class is retrieval_index.IvfPqIndex:
+            kwargs["n_subvectors"] = 8
+        index = index_class(**kwargs)
+        index.build(mat)
+        assert len(index.centroids) == 3
+        distances = index.compute_distances(query_embeddings, mat)
+        assert distances.shape == (2, 3)
+        assert (np.isfinite(distances).sum(axis=1) >= 1).all()
+        if n_probe == 20:
+            assert np.isfinite(distances).all()
+
+
+def test_IvfPqIndex(clustered_embedding_mat, tmp_path):
+    query_embeddings = clustered_embedding_mat[::25]
+    index = retrieval_index.IvfPqIndex(n_subvectors=8, n_codes=64, n_lists=10, n_probe=3)
+    index.build(clustered_embedding_mat)
+    assert index.codes.dtype == np.uint8
+    assert index.codes.shape == (len(clustered_embedding_mat), 8)
+    # quantized distances approximate the exact distances of the scored rows
+    distances = index.compute_distances(query_embeddings, clustered_embedding_mat)
+    exact_distances = 1 - query_embeddings @ clustered_embedding_mat.T
+    is_scored = np.isfinite(distances)
+    assert np.abs(distances - exact_distances)[is_scored].mean() < 0.02
+
+    index_filepath = tmp_path / "index.npz"
+    index.save(index_filepath)
+    loaded_index = retrieval_index.IvfPqIndex(n_probe=3)
+    loaded_index.load(index_filepath)
+    assert np.allclose(
+        loaded_index.compute_distances(query_embeddings, clustered_embedding_mat),
+        index.compute_distances(query_embeddings, clustered_embedding_mat),
+    )
+
+    with pytest.raises(ValueError):
+        retrieval_index.IvfPqIndex(n_subvectors=5).build(clustered_embedding_mat)
+
+
+def test_RetrievalDb_index(retrieval_db_path):
+    index = retrieval_index.IvfIndex(n_lists=2, n_probe=1)
+    db = retrieval.RetrievalDb(retrieval_db_path, "conftestDb", "text", index=index)
+    assert db.get_index_filepath(index).exists()
+    distances = db.compute_string_distances("Test query.")
+    assert len(distances) == len(db.df)
+    assert np.isfinite(distances).sum() >= 1
+
+    # DbInfo only uses the rows the index scored
+    db_info = retrieval.DbInfo(db)
+    fill_string = db_info.get_fill_string_from_distances(distances)
+    assert fill_string.count("Test text") == np.isfinite(distances).sum()
+
+    # a later load reuses the saved index, with the new query-time settings
+    index_filepath = db.get_index_filepath(index)
+    index_mtime = index_filepath.stat().st_mtime
+    index = retrieval_index.IvfIndex(n_lists=2, n_probe=2)
+    db = retrieval.RetrievalDb(retrieval_db_path, "conftestDb", "text", index=index)
+    assert db.get_index_filepath(index) == index_filepath
+    assert index_filepath.stat().st_mtime == index_mtime
+    assert np.isfinite(db.compute_string_distances("Test query.")).all()
+
+    # different build settings are built and saved separately, rather than loading the saved index
+    index = retrieval_index.IvfIndex(n_lists=1, n_probe=1)
+    db = retrieval.RetrievalDb(retrieval_db_path, "conftestDb", "text", index=index)
+    assert db.get_index_filepath(index) != index_filepath
+    assert db.get_index_filepath(index).exists()
+    assert len(db.index.centroids) == 1
+    pq_index = retrieval_index.IvfPqIndex(n_subvectors=8, n_codes=2, n_lists=1)
+    assert db.get_index_filepath(pq_index) != db.get_index_filepath(retrieval_index.IvfPqIndex(n_lists=1))
+
+
+@pytest.mark.parametrize("dtype", ["int8", "float16"])
+def test_QuantizedIndex(clustered_embedding_mat, tmp_path, dtype):
+    query_embeddings = clustered_embedding_mat[::25]
+    index = retrieval_index.QuantizedIndex(dtype, n_rerank=20)
+    index.build(clustered_embedding_mat)
+    assert index.quantized_mat.dtype == np.dtype(dtype)
+    assert index.quantized_mat.nbytes <= clustered_embedding_mat.nbytes / 2
+
+    # re-ranked candidates have exact distances; other rows are not scored
+    distances = index.compute_distances(query_embeddings, clustered_embedding_mat)
+    exact_distances = 1 - query_embeddings @ clustered_embedding_mat.T
+    assert (np.isfinite(distances).sum(axis=1) == 20).all()
+    is_scored = np.isfinite(distances)
+    assert np.allclose(distances[is_scored], exact_distances[is_scored], atol=1e-6)
+    assert get_recall(index, clustered_embedding_mat, query_embeddings) >= 0.9
+
+    index_filepath = tmp_path / "index.npz"
+    index.save(index_filepath)
+    loaded_index = retrieval_index.QuantizedIndex(dtype, n_rerank=20)
+    loaded_index.load(index_filepath)
+    assert np.array_equal(loaded_index.compute_distances(query_embeddings, clustered_embedding_mat), distances)
+
+
+def test_RetrievalDb_QuantizedIndex(retrieval_db_path):
+    exact_db = retrieval.RetrievalDb(retrieval_db_path, "conftestDb", "text")
+    exact_db.normalized_embedding_filepath.unlink()
+    query_embedding = np.random.random(size=exact_db.normalized_embedding_mat.shape[1])
+    exact_distances = exact_db.compute_embedding_distances(query_embedding)
+
+    # without mmap_mode, the search matrix is still saved and mapped rather than held in memory
+    index = retrieval_index.QuantizedIndex("int8", n_rerank=2)
+    db = retrieval.RetrievalDb(retrieval_db_path, "conftestDb", "text", index=index)
+    assert db.is_current(db.normalized_embedding_filepath)
+    assert isinstance(db.normalized_embedding_mat, np.memmap)
+    distances = db.compute_embedding_distances(query_embedding)
+    is_scored = np.isfinite(distances)
+    assert is_scored.sum() == 2
+    assert np.allclose(distances[is_scored], exact_distances[is_scored], atol=1e-5)
+    db = pickle.loads(pickle.dumps(db))
+    assert isinstance(db.normalized_embedding_mat, np.memmap)
+
+    # switching indexes switches whether the search matrix is resident
+    exact_db.set_index(retrieval_index.QuantizedIndex("float16"))
+    assert isinstance(exact_db.normalized_embedding_mat, np.memmap)
+    exact_db.set_index(retrieval_index.BruteForceIndex())
+    assert not isinstance(exact_db.normalized_embedding_mat, np.memmap)
+    assert np.allclose(exact_db.compute_embedding_distances(query_embedding), exact_distances)
+
+
+def test_quantize():
+    mat = np.array([[0.5, -0.25, 0], [0, 0, 0]])
+    quantized_mat, scales = retrieval_index.quantize(mat, "int8")
+    assert quantized_mat.tolist() == [[127, -64, 0], [0, 0, 0]]
+    assert np.allclose(quantized_mat * scales[:, None], mat, atol=0.01)
+    quantized_mat, scales = retrieval_index.quantize(mat, "float16")
+    assert scales is None
+    assert np.array_equal(quantized_mat, mat)
@@ -1,4 +1,18 @@
-from llm_math_education import retrieval, retrieval_strategies
+import asyncio
+import collections
+import threading
+import time
+
+import numpy as np
+import openai
+import pytest
+
+from llm_math_education import (
+    embedding_utils,
+    query_cache,
+    retrieval,
+    retrieval_strategies,
+)
 
 
 def test_NoRetrievalStrategy():
@@ -50,3 +64,296 @@ def test_MappedEmbeddingRetrievalStrategy(retrieval_db):
     retriever.update_map({"slot2": "fill2"})
     filled_slots = retriever.do_retrieval(["slot1", "slot2"], "")
     assert filled_slots["slot2"] == "fill2"
+
+
+def test_MappedEmbeddingRetrievalStrategy_shared_embedding(retrieval_db, monkeypatch):
+    query_embedding = np.random.random(size=embedding_utils.EMBEDDING_DIM)
+    embedded_texts = []
+
+    def mock_get_openai_embeddings(input_text_list, *args, **kwargs):
+        embedded_texts.extend(input_text_list)
+        return [query_embedding for _ in input_text_list]
+
+    monkeypatch.setattr("llm_math_education.embedding_utils.get_openai_embeddings", mock_get_openai_embeddings)
+    db_info = retrieval.DbInfo(retrieval_db, max_tokens=5)
+    slot_map = {
+        "slot1": db_info,
+        "slot2": db_info.copy(max_tokens=1000),
+        "slot3": db_info,
+        "slot4": "fill4",
+    }
+    retriever = retrieval_strategies.MappedEmbeddingRetrievalStrategy(slot_map)
+    filled_slots = retriever.do_retrieval(["slot4", "slot3", "slot2", "slot1"], "testQuery")
+    assert list(filled_slots.keys()) == ["slot4", "slot3", "slot2", "slot1"]
+    assert embedded_texts == ["testQuery"]
+    distances = retrieval_db.compute_embedding_distances(query_embedding)
+    assert filled_slots["slot1"] == db_info.get_fill_string_from_distances(distances)
+    assert filled_slots["slot2"] == slot_map["slot2"].get_fill_string_from_distances(distances)
+    assert filled_slots["slot3"] == filled_slots["slot1"]
+    assert filled_slots["slot4"] == "fill4"
+    assert len(filled_slots["slot2"]) > len(filled_slots["slot1"])
+
+
+def test_ado_retrieval(retrieval_db, monkeypatch):
+    query_embedding = np.random.random(size=embedding_utils.EMBEDDING_DIM)
+    embedded_texts = []
+
+    def mock_get_openai_embeddings(input_text_list, *args, **kwargs):
+        return [query_embedding for _ in input_text_list]
+
+    async def mock_aget_openai_embeddings(input_text_list, *args, **kwargs):
+        embedded_texts.extend(input_text_list)
+        return [query_embedding for _ in input_text_list]
+
+    monkeypatch.setattr("llm_math_education.embedding_utils.get_openai_embeddings", mock_get_openai_embeddings)
+    monkeypatch.setattr("llm_math_education.embedding_utils.aget_openai_embeddings", mock_aget_openai_embeddings)
+
+    retriever = retrieval_strategies.NoRetrievalStrategy()
+    assert asyncio.run(retriever.ado_retrieval(["test"], "user")) == {"test": ""}
+    retriever = retrieval_strategies.StaticRetrievalStrategy("TestVal")
+    assert asyncio.run(retriever.ado_retrieval(["test"], "user")) == {"test": "TestVal"}
+
+    retriever = retrieval_strategies.EmbeddingRetrievalStrategy(retrieval_db, max_tokens=5)
+    assert asyncio.run(retriever.ado_retrieval(["testSlot"], "testQuery")) == retriever.do_retrieval(
+        ["testSlot"],
+        "testQuery",
+    )
+    assert embedded_texts == ["testQuery"]
+
+    embedded_texts.clear()
+    db_info = retrieval.DbInfo(retrieval_db, max_tokens=5)
+    slot_map = {
+        "slot1": db_info,
+        "slot2": db_info.copy(max_tokens=1000),
+        "slot3": "fill3",
+    }
+    retriever = retrieval_strategies.MappedEmbeddingRetrievalStrategy(slot_map, nonmatching_fill="nomatch")
+    expected_slots = ["slot1", "slot2", "slot3", "slot4"]
+    filled_slots = asyncio.run(retriever.ado_retrieval(expected_slots, "testQuery"))
+    assert filled_slots == retriever.do_retrieval(expected_slots, "testQuery")
+    assert filled_slots["slot4"] == "nomatch"
+    assert embedded_texts == ["testQuery"]
+
+
+def test_ado_retrieval_default():
+    class CustomRetrievalStrategy(retrieval_strategies.RetrievalStrategy):
+        def do_retrieval(self, expected_slots, user_query, previous_messages=[]):
+            return {expected_slot: threading.current_thread().name for expected_slot in expected_slots}
+
+    async def do_concurrent_retrievals():
+        retriever = CustomRetrievalStrategy()
+        return await asyncio.gather(*[retriever.ado_retrieval(["test"], "user") for _ in range(3)])
+
+    filled_slots_list = asyncio.run(do_concurrent_retrievals())
+    assert len(filled_slots_list) == 3
+    # runs off the event loop's thread
+    assert all(filled_slots["test"] != threading.current_thread().name for filled_slots in filled_slots_list)
+
+
+def test_FusedEmbeddingRetrievalStrategy():
+    strategy = retrieval_strategies.FusedEmbeddingRetrievalStrategy({}, max_tokens=4)
+    distances_list = [np.array([0.1, 0.5, 0.3]), np.array([0.2, 0.05])]
+    n_tokens_list = [np.array([1, 1, 1]), np.array([1, 1])]
+    db_inds_list = strategy.get_fused_indices(distances_list, n_tokens_list)
+    assert [db_inds.tolist() for db_inds in db_inds_list] == [[0, 2], [1, 0]]
+
+    # the budget is shared
+    n_tokens_list = [np.array([1, 1, 1]), np.array([3, 2])]
+    db_inds_list = strategy.get_fused_indices(distances_list, n_tokens_list)
+    assert [db_inds.tolist() for db_inds in db_inds_list] == [[0], [1]]
+
+    # reciprocal rank fusion interleaves the dbs by rank
+    strategy = retrieval_strategies.FusedEmbeddingRetrievalStrategy({}, max_tokens=3, fusion="rrf")
+    distances_list = [np.array([0.1, 0.2, 0.3]), np.array([0.9])]
+    n_tokens_list = [np.array([1, 1, 1]), np.array([1])]
+    db_inds_list = strategy.get_fused_indices(distances_list, n_tokens_list)
+    assert db_inds_list[0].tolist() == [0, 1]
+    assert db_inds_list[1].tolist() == [0]
+
+    with pytest.raises(ValueError):
+        retrieval_strategies.FusedEmbeddingRetrievalStrategy({}, fusion="unknown")
+
+
+def test_FusedEmbeddingRetrievalStrategy_db(retrieval_db, monkeypatch):
+    query_embedding = np.random.random(size=embedding_utils.EMBEDDING_DIM)
+    embedded_texts = []
+
+    def mock_get_openai_embeddings(input_text_list, *args, **kwargs):
+        embedded_texts.extend(input_text_list)
+        return [query_embedding for _ in input_text_list]
+
+    async def mock_aget_openai_embeddings(input_text_list, *args, **kwargs):
+        return mock_get_openai_embeddings(input_text_list)
+
+    monkeypatch.setattr("llm_math_education.embedding_utils.get_openai_embeddings", mock_get_openai_embeddings)
+    monkeypatch.setattr("llm_math_education.embedding_utils.aget_openai_embeddings", mock_aget_openai_embeddings)
+    slot_map = {
+        "slot1": retrieval.DbInfo(retrieval_db, prefix="1:"),
+        "slot2": retrieval.DbInfo(retrieval_db, prefix="2:"),
+        "slot3": "fill3",
+    }
+    strategy = retrieval_strategies.FusedEmbeddingRetrievalStrategy(slot_map, max_tokens=1000)
+    filled_slots = strategy.do_retrieval(["slot1", "slot2", "slot3"], "testQuery")
+    assert embedded_texts == ["testQuery"]
+    assert filled_slots["slot3"] == "fill3"
+    # each db text is selected exactly once in total
+    fill_texts = filled_slots["slot1"][2:].split("\n") + filled_slots["slot2"][2:].split("\n")
+    assert sorted(fill_text for fill_text in fill_texts if fill_text != "") == sorted(retrieval_db.texts * 2)
+    assert asyncio.run(strategy.ado_retrieval(["slot1", "slot2", "slot3"], "testQuery")) == filled_slots
+
+    with pytest.raises(ValueError):
+        retrieval_strategies.FusedEmbeddingRetrievalStrategy(
+            {"slot1": retrieval.DbInfo(retrieval_db, use_parent_text=True, parent_group_cols=["group_var"])},
+        )
+
+
+def test_HybridRetrievalStrategy(retrieval_db, monkeypatch):
+    query_embedding = retrieval_db.embedding_mat[0]
+    monkeypatch.setattr(
+        "llm_math_education.embedding_utils.get_openai_embeddings",
+        lambda input_text_list, *args, **kwargs: [query_embedding for _ in input_text_list],
+    )
+
+    async def mock_aget_openai_embeddings(input_text_list, *args, **kwargs):
+        return [query_embedding for _ in input_text_list]
+
+    monkeypatch.setattr("llm_math_education.embedding_utils.aget_openai_embeddings", mock_aget_openai_embeddings)
+    slot_map = {"slot1": retrieval.DbInfo(retrieval_db, max_texts=1)}
+
+    # the embedding matches text 1, while the lexical query matches text 3
+    retriever = retrieval_strategies.HybridRetrievalStrategy(slot_map, embedding_weight=1)
+    assert retriever.do_retrieval(["slot1"], "3") == {"slot1": "Test text 1."}
+    retriever = retrieval_strategies.HybridRetrievalStrategy(slot_map, embedding_weight=0)
+    assert retriever.do_retrieval(["slot1"], "3") == {"slot1": "Test text 3."}
+    assert asyncio.run(retriever.ado_retrieval(["slot1"], "3")) == {"slot1": "Test text 3."}
+    retriever = retrieval_strategies.HybridRetrievalStrategy(slot_map, lexical_only=True)
+    assert retriever.do_retrieval(["slot1"], "3") == {"slot1": "Test text 3."}
+
+    # lexical only: texts without query terms are not retrieved
+    slot_map = {"slot1": retrieval.DbInfo(retrieval_db)}
+    retriever = retrieval_strategies.HybridRetrievalStrategy(slot_map, lexical_only=True)
+    assert retriever.do_retrieval(["slot1"], "unknown") == {"slot1": ""}
+
+    # the lowest-scoring matching text is still retrieved
+    distances = retriever.get_hybrid_distances(np.array([0.0, 2.0, 1.0]))
+    assert np.isinf(distances[0])
+    assert np.isfinite(distances[1:]).all()
+    assert distances[1] < distances[2]
+    # as are texts with equal nonzero scores
+    assert np.isfinite(retriever.get_hybrid_distances(np.array([1.5, 1.5, 1.5]))).all()
+    assert retriever.do_retrieval(["slot1"], "test") == {"slot1": "Test text 1.\nTest text 2.\nTest text 3."}
+
+    with pytest.raises(ValueError):
+        retrieval_strategies.HybridRetrievalStrategy(slot_map, embedding_weight=2)
+
+
+def test_HybridRetrievalStrategy_fallback(retrieval_db, monkeypatch):
+    def slow_get_openai_embeddings(input_text_list, *args, **kwargs):
+        time.sleep(1)
+        return [retrieval_db.embedding_mat[0] for _ in input_text_list]
+
+    async def slow_aget_openai_embeddings(input_text_list, *args, **kwargs):
+        await asyncio.sleep(1)
+        return [retrieval_db.embedding_mat[0] for _ in input_text_list]
+
+    def failing_get_openai_embeddings(input_text_list, *args, **kwargs):
+        raise openai.error.APIConnectionError("Unavailable")
+
+    slot_map = {"slot1": retrieval.DbInfo(retrieval_db, max_texts=1)}
+    retriever = retrieval_strategies.HybridRetrievalStrategy(slot_map, embedding_weight=0.9, embedding_timeout_s=0.05)
+    monkeypatch.setattr("llm_math_education.embedding_utils.get_openai_embeddings", slow_get_openai_embeddings)
+    monkeypatch.setattr("llm_math_education.embedding_utils.aget_openai_embeddings", slow_aget_openai_embeddings)
+    start_time = time.time()
+    assert retriever.do_retrieval(["slot1"], "3") == {"slot1": "Test text 3."}
+    assert asyncio.run(retriever.ado_retrieval(["slot1"], "3")) == {"slot1": "Test text 3."}
+    assert time.time() - start_time < 1.5
+
+    monkeypatch.setattr("llm_math_education.embedding_utils.get_openai_embeddings", failing_get_openai_embeddings)
+    assert retriever.do_retrieval(["slot1"], "3") == {"slot1": "Test text 3."}
+
+
+def test_min_max_scale():
+    scores = retrieval_strategies.min_max_scale(np.array([1.0, 3.0, np.inf, 2.0]))
+    assert np.array_equal(scores, [0, 1, 0, 0.5])
+    assert np.array_equal(retrieval_strategies.min_max_scale(np.array([1.0, 1.0])), [0, 0])
+
+
+def test_CachedRetrievalStrategy(monkeypatch):
+    query_embeddings = {
+        "what is a fraction?": np.array([1.0, 0, 0]),
+        "what is a fraction": np.array([1.0, 0.01, 0]),
+        "what is a ratio?": np.array([0, 1.0, 0]),
+    }
+    embedded_texts = []
+
+    def mock_get_openai_embeddings(input_text_list, *args, **kwargs):
+        embedded_texts.extend(input_text_list)
+        return [query_embeddings[text] for text in input_text_list]
+
+    async def mock_aget_openai_embeddings(input_text_list, *args, **kwargs):
+        return mock_get_openai_embeddings(input_text_list)
+
+    monkeypatch.setattr("llm_math_education.embedding_utils.get_openai_embeddings", mock_get_openai_embeddings)
+    monkeypatch.setattr("llm_math_education.embedding_utils.aget_openai_embeddings", mock_aget_openai_embeddings)
+
+    class CountingRetrievalStrategy(retrieval_strategies.MappedEmbeddingRetrievalStrategy):
+        def __init__(self, slot_map):
+            super().__init__(slot_map)
+            self.queries = []
+
+        def do_retrieval(self, expected_slots, user_query, previous_messages=[]):
+            self.queries.append(user_query)
+            return {expected_slot: f"{self.slot_map[expected_slot]} {user_query}" for expected_slot in expected_slots}
+
+    inner_retriever = CountingRetrievalStrategy({"slot1": "fill1"})
+    cache = query_cache.SemanticQueryCache(similarity_threshold=0.99, embedding_dim=3)
+    retriever = retrieval_strategies.CachedRetrievalStrategy(inner_retriever, similarity_threshold=0.99, cache=cache)
+    assert retriever.do_retrieval(["slot1"], "what is a fraction?") == {"slot1": "fill1 what is a fraction?"}
+    # exact hit, after normalization; no embedding needed
+    slot_fill_dict = retriever.do_retrieval(["slot1"], "  what is a fraction?")
+    assert slot_fill_dict == {"slot1": "fill1 what is a fraction?"}
+    assert embedded_texts == ["what is a fraction?"]
+    # returned fills can be modified without affecting the cache
+    slot_fill_dict["slot1"] = "modified"
+    # near-duplicate hit
+    assert retriever.do_retrieval(["slot1"], "what is a fraction") == {"slot1": "fill1 what is a fraction?"}
+    # miss
+    assert retriever.do_retrieval(["slot1"], "what is a ratio?") == {"slot1": "fill1 what is a ratio?"}
+    assert asyncio.run(retriever.ado_retrieval(["slot1"], "what is a ratio?")) == {"slot1": "fill1 what is a ratio?"}
+    assert inner_retriever.queries == ["what is a fraction?", "what is a ratio?"]
+    stats = retriever.get_cache_stats()
+    assert stats["exact_hits"] == 2 and stats["similar_hits"] == 1 and stats["misses"] == 2
+
+    # updating the map invalidates cached fills
+    retriever.update_map({"slot1": "fill2"})
+    assert retriever.do_retrieval(["slot1"], "what is a fraction?") == {"slot1": "fill2 what is a fraction?"}
+
+    # exact matches only
+    embedded_texts.clear()
+    retriever = retrieval_strategies.CachedRetrievalStrategy(inner_retriever, similarity_threshold=None)
+    retriever.do_retrieval(["slot1"], "what is a fraction?")
+    retriever.do_retrieval(["slot1"], "what is a fraction?")
+    assert embedded_texts == []
+    assert retriever.get_cache_stats()["hit_rate"] == 0.5
+
+
+def test_CachedRetrievalStrategy_ado_retrieval_single_embedding(retrieval_db, monkeypatch):
+    requested_texts = []
+
+    async def mock_acreate(input, engine):
+        requested_texts.extend(input)
+        return openai.openai_object.OpenAIObject.construct_from(
+            {"data": [{"embedding": retrieval_db.embedding_mat[1].tolist()} for _ in input]},
+        )
+
+    monkeypatch.setattr("openai.Embedding.acreate", mock_acreate)
+    monkeypatch.setattr("llm_math_education.embedding_utils.embedding_cache", None)
+    monkeypatch.setattr("llm_math_education.embedding_utils.async_memory_cache", collections.OrderedDict())
+    db_info = retrieval.DbInfo(retrieval_db, max_tokens=5)
+    retriever = retrieval_strategies.CachedRetrievalStrategy(
+        retrieval_strategies.MappedEmbeddingRetrievalStrategy({"texts": db_info}),
+    )
+    slot_fill_dict = asyncio.run(retriever.ado_retrieval(["texts"], "A query about text 2?"))
+    assert slot_fill_dict["texts"] == db_info.get_fill_string_from_query_embedding(retrieval_db.embedding_mat[1])
+    # the query is embedded once, for both the cache lookup and the wrapped strategy
+    assert requested_texts == ["A query about text 2?"]
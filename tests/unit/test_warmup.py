@@ -0,0 +1,31 @@
+import pytest
+
+from llm_math_education import logit_bias, warmup
+
+
+def test_warm_up():
+    timings = warmup.warm_up()
+    assert set(timings.keys()) == set(warmup.WARM_UP_RESOURCES.keys())
+    assert all(elapsed >= 0 for elapsed in timings.values())
+    assert logit_bias.get_stopword_tokens.cache_info().currsize == 1
+
+    timings = warmup.warm_up(["stopword_tokens"])
+    assert list(timings.keys()) == ["stopword_tokens"]
+    with pytest.raises(ValueError):
+        warmup.warm_up(["not_a_resource"])
+
+
+def test_warm_up_failure(monkeypatch):
+    def failing_loader():
+        raise ValueError("Failed to load.")
+
+    monkeypatch.setitem(warmup.WARM_UP_RESOURCES, "failing", failing_loader)
+    timings = warmup.warm_up(["failing", "misconceptions_string"])
+    assert list(timings.keys()) == ["misconceptions_string"]
+
+
+def test_start_warm_up_thread():
+    warm_up_thread = warmup.start_warm_up_thread(["logit_bias_tokenizer", "nonstopword_token_table"])
+    timings = warm_up_thread.get_timings(timeout=60)
+    assert not warm_up_thread.is_alive()
+    assert set(timings.keys()) == {"logit_bias_tokenizer", "nonstopword_token_table"}